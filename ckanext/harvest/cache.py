@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    A bounded, thread-safe mapping that discards the least recently used
+    items when it is full.
+
+    Items can optionally expire ``ttl`` seconds after being set. The number
+    of lookups that found (``hits``) or did not find (``misses``) a value is
+    recorded, see `stats`.
+    '''
+
+    _missing = object()
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def __contains__(self, key):
+        return self._lookup(key, count=False) is not self._missing
+
+    def _lookup(self, key, count=True):
+        with self._lock:
+            item = self._items.get(key, self._missing)
+            if item is not self._missing:
+                value, expires = item
+                if expires is not None and expires < time.time():
+                    del self._items[key]
+                    item = self._missing
+            if item is self._missing:
+                if count:
+                    self.misses += 1
+                return self._missing
+            # Mark as the most recently used
+            self._items.pop(key)
+            self._items[key] = item
+            if count:
+                self.hits += 1
+            return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is self._missing else value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get_or_set(self, key, func):
+        '''
+        Returns the value cached for the key, or calls ``func`` to work it out
+        and caches it. Exceptions raised by ``func`` are not cached.
+        '''
+        value = self._lookup(key)
+        if value is self._missing:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, self._missing)
+        return default if item is self._missing else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._items), 'maxsize': self.maxsize}
@@ -28,6 +28,18 @@ def initdb():
     click.secho(u"DB tables created", fg=u"green")
 
 
+@harvester.command()
+def create_indexes():
+    """Creates the indexes of the harvest tables.
+
+    They are built concurrently, so harvesting can go on meanwhile. Run it
+    after upgrading, the missing indexes are logged when CKAN starts.
+
+    """
+    utils.create_indexes()
+    click.secho(u"Indexes created", fg=u"green")
+
+
 @harvester.group()
 def source():
     """Manage harvest sources
@@ -234,19 +246,58 @@ def purge_queues():
 
 
 @harvester.command()
-def gather_consumer():
+@click.option(
+    "--workers",
+    default=1,
+    type=int,
+    help="Number of gathers to run at the same time.",
+)
+def gather_consumer(workers):
     """Starts the consumer for the gathering queue.
 
+    With more than one worker, each gather runs in a forked worker process.
+    The gathers running at the same time for the same remote host can be
+    limited with ckan.harvest.gather.max_per_host.
+
     """
-    utils.gather_consumer()
+    utils.gather_consumer(workers=workers)
 
 
 @harvester.command()
-def fetch_consumer():
+@click.option(
+    "--workers",
+    default=1,
+    type=int,
+    help="Number of worker processes to fork.",
+)
+@click.option(
+    "--threads",
+    default=1,
+    type=int,
+    help="Number of consumer threads in each worker process.",
+)
+@click.option(
+    "--max-messages",
+    default=0,
+    type=int,
+    help="Restart a worker after it has processed this number of messages.",
+)
+@click.option(
+    "--max-rss",
+    default=0,
+    type=int,
+    help="Restart a worker once its memory usage is over this number of MB.",
+)
+def fetch_consumer(workers, threads, max_messages, max_rss):
     """Starts the consumer for the fetching queue.
 
+    With more than one worker or thread, or with any of the limits, the
+    workers are forked from this process and restarted when they reach the
+    limits. On SIGTERM the messages in progress are finished before exiting.
+
     """
-    utils.fetch_consumer()
+    utils.fetch_consumer(workers=workers, threads=threads,
+                         max_messages=max_messages, max_rss=max_rss)
 
 
 @harvester.command()
@@ -368,6 +419,22 @@ def clean_harvest_log(ctx):
         utils.clean_harvest_log()
 
 
+@harvester.command()
+@click.argument("id", metavar="JOB_ID", required=False)
+@click.pass_context
+def rebuild_job_stats(ctx, id):
+    """Works out again the progress counters of the harvest jobs.
+
+    They are kept up to date as the harvest objects change, but not when
+    these are changed directly in the database. If no job id is provided,
+    the counters of all the jobs are rebuilt.
+
+    """
+    flask_app = ctx.meta["flask_app"]
+    with flask_app.test_request_context():
+        utils.rebuild_job_stats(id)
+
+
 @harvester.command("job-all")
 @click.pass_context
 def job_all(ctx):
@@ -18,6 +18,10 @@ class Harvester(CkanCommand):
       harvester initdb
         - Creates the necessary tables in the database
 
+      harvester create_indexes
+        - Creates the missing indexes of the harvest tables concurrently
+          (run it after upgrading)
+
       harvester source {name} {url} {type} [{title}] [{active}] [{owner_org}] [{frequency}] [{config}]
         - create new harvest source
 
@@ -68,12 +72,20 @@ class Harvester(CkanCommand):
           useful for testing a harvester without having to fire up
           gather/fetch_consumer processes, as is done in production.
 
-      harvester gather_consumer
+      harvester [--workers={n}] gather_consumer
         - starts the consumer for the gathering queue
 
-      harvester fetch_consumer
+          With more than one worker, each gather runs in a forked worker
+          process.
+
+      harvester [--workers={n}] [--threads={n}] [--max-messages={n}] [--max-rss={mb}] fetch_consumer
         - starts the consumer for the fetching queue
 
+          With more than one worker or thread, or with any of the limits, the
+          workers are forked from this process and restarted when they reach
+          the limits. On SIGTERM the messages in progress are finished before
+          exiting.
+
       harvester purge_queues
         - removes all jobs from fetch and gather queue
 
@@ -198,6 +210,38 @@ class Harvester(CkanCommand):
             help="Do not delete relevant harvest objects",
         )
 
+        self.parser.add_option(
+            "--workers",
+            dest="workers",
+            type="int",
+            default=1,
+            help="Number of consumer worker processes to fork",
+        )
+
+        self.parser.add_option(
+            "--threads",
+            dest="threads",
+            type="int",
+            default=1,
+            help="Number of consumer threads in each fetch worker process",
+        )
+
+        self.parser.add_option(
+            "--max-messages",
+            dest="max_messages",
+            type="int",
+            default=0,
+            help="Restart a fetch worker after it has processed this number of messages",
+        )
+
+        self.parser.add_option(
+            "--max-rss",
+            dest="max_rss",
+            type="int",
+            default=0,
+            help="Restart a fetch worker once its memory usage is over this number of MB",
+        )
+
     def command(self):
         self._load_config()
 
@@ -240,15 +284,21 @@ class Harvester(CkanCommand):
         elif cmd == "run_test":
             self.run_test_harvest()
         elif cmd == "gather_consumer":
-            utils.gather_consumer()
+            utils.gather_consumer(workers=self.options.workers)
         elif cmd == "fetch_consumer":
-            utils.fetch_consumer()
+            utils.fetch_consumer(workers=self.options.workers,
+                                 threads=self.options.threads,
+                                 max_messages=self.options.max_messages,
+                                 max_rss=self.options.max_rss)
         elif cmd == "purge_queues":
             self.purge_queues()
         elif cmd == "abort_failed_jobs":
             self.abort_failed_jobs()
         elif cmd == "initdb":
             self.initdb()
+        elif cmd == "create_indexes":
+            utils.create_indexes()
+            print("Indexes created")
         elif cmd == "import":
             self.initdb()
             self.import_stage()
@@ -1,25 +1,38 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import hashlib
+import itertools
+import json
 import logging
 import re
+import threading
+import time
 import uuid
 
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urlparse
+from urllib3.contrib import pyopenssl
+from urllib3.util.retry import Retry
+
 from sqlalchemy import exists, and_
-from sqlalchemy.sql import update, bindparam
-from sqlalchemy.orm import contains_eager
+from sqlalchemy.sql import update, bindparam, text
 
 from ckantoolkit import config
 
 from ckan import plugins as p
 from ckan import model
 from ckan.model import Session, Package, PACKAGE_NAME_MAX_LENGTH
+from ckan.model.types import make_uuid
 
 from ckan.logic.schema import default_create_package_schema
 from ckan.lib.navl.validators import ignore_missing, ignore
 from ckan.lib.munge import munge_title_to_name, substitute_ascii_equivalents
 
 from ckanext.harvest.model import (HarvestObject, HarvestGatherError,
-                                   HarvestObjectError, HarvestJob)
+                                   HarvestObjectError, HarvestJob,
+                                   HarvestGuidState)
 
 from ckan.plugins.core import SingletonPlugin, implements
 from ckanext.harvest.interfaces import IHarvester
@@ -47,6 +60,15 @@ else:
 
 log = logging.getLogger(__name__)
 
+# Defaults for the HTTP options of the source config (see _get_http_session)
+DEFAULT_HTTP_TIMEOUT = (10, 60)
+DEFAULT_HTTP_RETRIES = 3
+DEFAULT_HTTP_BACKOFF_FACTOR = 0.5
+DEFAULT_HTTP_POOL_MAXSIZE = 10
+
+_http_lock = threading.Lock()
+_pyopenssl_injected = False
+
 
 class HarvesterBase(SingletonPlugin):
     '''
@@ -62,6 +84,9 @@ class HarvesterBase(SingletonPlugin):
 
     _user_name = None
 
+    _http_sessions = None
+    _http_stats = None
+
     @classmethod
     def _gen_new_name(cls, title, existing_name=None,
                       append_type=None):
@@ -209,6 +234,111 @@ class HarvesterBase(SingletonPlugin):
 
         return self._user_name
 
+    def _get_http_option(self, key, default):
+        value = (self.config or {}).get(key)
+        return default if value is None else value
+
+    def _get_http_timeout(self):
+        '''
+        Returns the (connect, read) timeout for requests to the remote
+        server, as set in the ``http_timeout`` option of the source config.
+        It can be a single number of seconds for both or a two item list.
+        '''
+        timeout = self._get_http_option('http_timeout', DEFAULT_HTTP_TIMEOUT)
+        if isinstance(timeout, (list, tuple)):
+            return tuple(float(t) for t in timeout)
+        return float(timeout)
+
+    def _get_http_session(self, url):
+        '''
+        Returns the requests Session used to talk to the host of the given
+        URL.
+
+        Sessions are kept for the lifetime of the harvester, one for each
+        remote host and retry policy, so connections (and TLS sessions) are
+        reused across pages and group and organization lookups. The retry
+        policy and pool size can be set with the ``http_retries``,
+        ``http_backoff_factor`` and ``http_pool_maxsize`` options of the
+        source config.
+        '''
+        global _pyopenssl_injected
+
+        retries = int(self._get_http_option('http_retries', DEFAULT_HTTP_RETRIES))
+        backoff_factor = float(
+            self._get_http_option('http_backoff_factor', DEFAULT_HTTP_BACKOFF_FACTOR))
+        pool_maxsize = int(
+            self._get_http_option('http_pool_maxsize', DEFAULT_HTTP_POOL_MAXSIZE))
+
+        parsed_url = urlparse(url)
+        key = (parsed_url.scheme, parsed_url.netloc,
+               retries, backoff_factor, pool_maxsize)
+
+        with _http_lock:
+            if self._http_sessions is None:
+                self._http_sessions = {}
+            session = self._http_sessions.get(key)
+            if session is not None:
+                return session
+
+            if not _pyopenssl_injected:
+                pyopenssl.inject_into_urllib3()
+                _pyopenssl_injected = True
+
+            retry = Retry(total=retries,
+                          backoff_factor=backoff_factor,
+                          status_forcelist=(500, 502, 503, 504),
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=pool_maxsize,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            session.mount('%s://' % parsed_url.scheme, adapter)
+            self._http_sessions[key] = session
+            log.debug('Created HTTP session for %s://%s',
+                      parsed_url.scheme, parsed_url.netloc)
+            return session
+
+    def _http_get(self, url, **kwargs):
+        '''
+        Performs a GET request on the pooled session for the URL's host,
+        using the timeout from the source config, and updates the HTTP
+        counters (see `get_http_stats`).
+        '''
+        kwargs.setdefault('timeout', self._get_http_timeout())
+        session = self._get_http_session(url)
+
+        start = time.time()
+        try:
+            response = session.get(url, **kwargs)
+        except Exception:
+            self._update_http_stats(time.time() - start, error=True)
+            raise
+        self._update_http_stats(time.time() - start,
+                                num_bytes=len(response.content))
+        return response
+
+    def _update_http_stats(self, seconds, num_bytes=0, error=False):
+        with _http_lock:
+            if self._http_stats is None:
+                self._http_stats = dict.fromkeys(
+                    ('requests', 'errors', 'bytes', 'seconds'), 0)
+            self._http_stats['requests'] += 1
+            self._http_stats['bytes'] += num_bytes
+            self._http_stats['seconds'] += seconds
+            if error:
+                self._http_stats['errors'] += 1
+
+    def get_http_stats(self):
+        '''
+        Returns the counters for the HTTP requests made by this harvester: the
+        number of ``requests`` and ``errors``, the ``bytes`` received and the
+        total ``seconds`` spent waiting for responses.
+        '''
+        with _http_lock:
+            return dict(self._http_stats or dict.fromkeys(
+                ('requests', 'errors', 'bytes', 'seconds'), 0))
+
     def _create_harvest_objects(self, remote_ids, harvest_job):
         '''
         Given a list of remote ids and a Harvest Job, create as many Harvest Objects and
@@ -217,19 +347,174 @@ class HarvesterBase(SingletonPlugin):
         TODO: Not sure it is worth keeping this function
         '''
         try:
-            object_ids = []
             if len(remote_ids):
-                for remote_id in remote_ids:
-                    # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid=remote_id, job=harvest_job)
-                    obj.save()
-                    object_ids.append(obj.id)
-                return object_ids
+                return self._bulk_create_harvest_objects(
+                    harvest_job, [{'guid': remote_id} for remote_id in remote_ids])
             else:
                 self._save_gather_error('No remote datasets could be identified', harvest_job)
         except Exception as e:
             self._save_gather_error('%r' % e.message, harvest_job)
 
+    def _bulk_create_harvest_objects(self, harvest_job, rows, batch_size=None):
+        '''
+        Creates Harvest Objects for a Harvest Job in batches and returns a
+        list of their ids, in the same order as the rows.
+
+        Each row is a dict with the ``guid`` of the object and optionally its
+        ``content``, ``content_hash`` (see `_get_content_hash`) and ``extras``
+        (a dict of extra keys and values). The
+        objects and their extras are inserted with one multi-row INSERT per
+        table and committed once per batch, instead of flushing and
+        committing each object separately. The batch size can be set with
+        the ``ckan.harvest.gather.batch_size`` config option (default 1000).
+        '''
+        from ckanext.harvest.model import (harvest_object_table,
+                                           harvest_object_extra_table)
+
+        if batch_size is None:
+            batch_size = p.toolkit.asint(
+                config.get('ckan.harvest.gather.batch_size', 1000))
+        harvest_source_id = harvest_job.source.id
+        harvest_job_id = harvest_job.id
+
+        object_ids = []
+        batch = []
+        batch_extras = []
+        for row in rows:
+            object_id = make_uuid()
+            batch.append({
+                'id': object_id,
+                'guid': row['guid'],
+                'content': row.get('content'),
+                'content_hash': row.get('content_hash'),
+                'current': False,
+                'gathered': datetime.datetime.utcnow(),
+                'state': u'WAITING',
+                'retry_times': 0,
+                'harvest_job_id': harvest_job_id,
+                'harvest_source_id': harvest_source_id,
+            })
+            for key, value in (row.get('extras') or {}).items():
+                batch_extras.append({
+                    'id': make_uuid(),
+                    'harvest_object_id': object_id,
+                    'key': key,
+                    'value': value,
+                })
+            object_ids.append(object_id)
+
+            if len(batch) >= batch_size:
+                self._insert_harvest_objects_batch(
+                    harvest_object_table, harvest_object_extra_table,
+                    batch, batch_extras)
+                batch = []
+                batch_extras = []
+
+        if batch:
+            self._insert_harvest_objects_batch(
+                harvest_object_table, harvest_object_extra_table,
+                batch, batch_extras)
+
+        return object_ids
+
+    @staticmethod
+    def _insert_harvest_objects_batch(harvest_object_table,
+                                      harvest_object_extra_table,
+                                      objects, extras):
+        from ckanext.harvest.model import add_objects_job_stats
+
+        Session.execute(harvest_object_table.insert().values(objects))
+        if extras:
+            Session.execute(harvest_object_extra_table.insert().values(extras))
+        # The ORM listeners that keep the job stats don't see these inserts
+        add_objects_job_stats(Session.connection(), objects)
+        Session.commit()
+
+    @staticmethod
+    def _get_content_hash(content, *args):
+        '''
+        Returns a stable fingerprint of the content of a harvest object (a
+        dict or list), computed from its canonical JSON form. Anything else
+        that affects how the object is imported (eg the source config) can
+        be passed as extra arguments.
+        '''
+        canonical = json.dumps([content] + list(args), sort_keys=True,
+                               separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _is_unchanged(self, harvest_object):
+        '''
+        Returns True if the object has the same content hash as the current
+        object for its guid and the dataset imported from it is still active,
+        ie there is no need to import it again.
+
+        Objects flagged with ``force_import``, or from a job flagged with it
+        (eg by ``run_test_harvester``), are never considered unchanged.
+        '''
+        if not harvest_object.content_hash or \
+                getattr(harvest_object, 'force_import', False) or \
+                getattr(harvest_object.job, 'force_import', False) or \
+                getattr(self, 'force_import', False):
+            return False
+
+        guid_state = HarvestGuidState.get_for_guid(
+            harvest_object.harvest_source_id, harvest_object.guid)
+        if not guid_state or \
+                guid_state.harvest_object_id == harvest_object.id or \
+                guid_state.content_hash != harvest_object.content_hash:
+            return False
+
+        # Check that the dataset has not been deleted locally in the meantime
+        package_state = Session.query(Package.state) \
+            .filter(Package.id == guid_state.package_id) \
+            .scalar()
+        return package_state == u'active'
+
+    def _get_packages_not_in(self, harvest_source_id, package_ids,
+                             batch_size=1000):
+        '''
+        Returns the id and name of the active datasets currently harvested
+        by the source whose ids are not in ``package_ids``, eg the ones no
+        longer available on the remote source.
+
+        The ids are copied to a temporary table so the comparison is done
+        by the database with a single anti-join, and the results are read
+        with a server-side cursor. The table is dropped afterwards, leaving
+        the transaction to the caller.
+        '''
+        conn = Session.connection()
+        conn.execute(text('''
+            CREATE TEMPORARY TABLE IF NOT EXISTS harvest_remote_package_id
+                (id text PRIMARY KEY) ON COMMIT DROP'''))
+        conn.execute(text('TRUNCATE harvest_remote_package_id'))
+
+        insert = text('''
+            INSERT INTO harvest_remote_package_id (id) VALUES (:id)
+            ON CONFLICT DO NOTHING''')
+        package_ids = iter(package_ids)
+        while True:
+            batch = [{'id': package_id}
+                     for package_id in itertools.islice(package_ids, batch_size)]
+            if not batch:
+                break
+            conn.execute(insert, batch)
+
+        result = conn.execution_options(stream_results=True).execute(text('''
+            SELECT DISTINCT package.id, package.name
+            FROM harvest_object
+            JOIN package ON package.id = harvest_object.package_id
+            LEFT JOIN harvest_remote_package_id AS remote
+                ON remote.id = package.id
+            WHERE harvest_object.harvest_source_id = :source_id
+                AND harvest_object.current = true
+                AND package.state = 'active'
+                AND remote.id IS NULL'''), source_id=harvest_source_id)
+        packages = [{'id': row.id, 'name': row.name} for row in result]
+
+        conn.execute(text('DROP TABLE harvest_remote_package_id'))
+
+        return packages
+
     def _create_or_update_package(self, package_dict, harvest_object,
                                   package_dict_form='rest'):
         '''
@@ -334,12 +619,20 @@ class HarvesterBase(SingletonPlugin):
                     return 'unchanged'
 
                 # Flag the other objects linking to this package as not current anymore
-                from ckanext.harvest.model import harvest_object_table
+                from ckanext.harvest.model import (harvest_object_table,
+                                                   harvest_guid_state_table)
                 conn = Session.connection()
                 u = update(harvest_object_table)\
                     .where(harvest_object_table.c.package_id == bindparam('b_package_id')) \
                     .values(current=False)
                 conn.execute(u, b_package_id=new_package['id'])
+                # The update above bypasses the ORM, so forget their guid
+                # state as well
+                d = harvest_guid_state_table.delete()\
+                    .where(harvest_guid_state_table.c.package_id == bindparam('b_package_id')) \
+                    .where(harvest_guid_state_table.c.harvest_object_id != bindparam('b_object_id'))
+                conn.execute(d, b_package_id=new_package['id'],
+                             b_object_id=harvest_object.id)
 
                 # Flag this as the current harvest object
 
@@ -421,7 +714,9 @@ class HarvesterBase(SingletonPlugin):
     def last_error_free_job(cls, harvest_job):
         # TODO weed out cancelled jobs somehow.
         # look for jobs with no gather errors
-        jobs = (model.Session.query(HarvestJob)
+        # and no fetch/import errors, checked in the database so the objects
+        # of the jobs don't need to be loaded
+        return (model.Session.query(HarvestJob)
                 .filter(HarvestJob.source == harvest_job.source)
                 .filter(HarvestJob.gather_started != None)  # noqa: E711
                 .filter(HarvestJob.status == 'Finished')
@@ -429,14 +724,10 @@ class HarvesterBase(SingletonPlugin):
                 .filter(
             ~exists().where(
                 HarvestGatherError.harvest_job_id == HarvestJob.id))
-                .outerjoin(HarvestObject,
-                           and_(HarvestObject.harvest_job_id == HarvestJob.id,
-                                HarvestObject.current == False,  # noqa: E712
-                                HarvestObject.report_status != 'not modified'))
-                .options(contains_eager(HarvestJob.objects))
-                .order_by(HarvestJob.gather_started.desc()))
-        # now check them until we find one with no fetch/import errors
-        # if objects count is 0, job was error free
-        for job in jobs:
-            if len(job.objects) == 0:
-                return job
+                .filter(
+            ~exists().where(
+                and_(HarvestObject.harvest_job_id == HarvestJob.id,
+                     HarvestObject.current == False,  # noqa: E712
+                     HarvestObject.report_status != 'not modified')))
+                .order_by(HarvestJob.gather_started.desc())
+                .first())
@@ -1,38 +1,189 @@
 from __future__ import absolute_import
 import six
-import requests
 from requests.exceptions import HTTPError, RequestException
 
 import datetime
-from urllib3.contrib import pyopenssl
 
-from six.moves.urllib.parse import urlencode, quote_plus
+from six.moves.urllib.parse import urlencode, urlparse, quote_plus
 from ckan import model
 from ckan.logic import ValidationError, NotFound, get_action
 from ckan.lib.helpers import json
 from ckan.lib.search import SearchError
-from ckanext.harvest import helpers as harvest_helpers
 from ckan.plugins import toolkit
 
-from ckanext.harvest.model import HarvestObject
-from ckanext.harvest.model import HarvestObjectExtra as HOExtra
+from ckanext.harvest.cache import LRUCache
 from .base import HarvesterBase
 
 import collections
+import copy
+import hashlib
+import itertools
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport
+    ThreadPoolExecutor = None
 
 import logging
+import threading
+import weakref
 log = logging.getLogger(__name__)
 
+# Default ckan.search.rows_max of the remote CKAN sites, ie the maximum number
+# of datasets they return per search page
+MAX_SEARCH_ROWS = 1000
+
+_job_caches_lock = threading.Lock()
+# Harvesters holding import caches, which are dropped when their job finishes
+_job_cache_owners = weakref.WeakSet()
+_job_cache_owners_registered = False
+
+
+def _drop_finished_job_caches(job_id):
+    for harvester in list(_job_cache_owners):
+        harvester._drop_job_caches(job_id)
+
+# Semaphores limiting the search requests sent at the same time to each remote
+# host, see _get_host_semaphore
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+
+def _get_host_semaphore(url, limit):
+    '''
+    Returns the semaphore that limits the concurrent search requests sent to
+    the host of ``url``, shared by all the sources harvested from that host
+    in this process. It allows the ``search_concurrency`` of the first source
+    that uses it.
+    '''
+    host = urlparse(url).netloc.lower()
+    with _host_semaphores_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = _host_semaphores[host] = \
+                threading.BoundedSemaphore(limit)
+    return semaphore
+
+
+class _ReadOnlyDict(dict):
+    '''A dict that can not be modified once created.'''
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('The harvest source config can not be modified')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+
+class CKANSourceConfig(object):
+    '''
+    The parsed configuration of a CKAN harvest source, together with the
+    values derived from it that the gather and import stages need.
+
+    Instances are cached and shared by all the threads harvesting the source
+    (see `get_source_config`), so they must not be modified.
+    '''
+
+    def __init__(self, config):
+        self.config = _ReadOnlyDict(config)
+        self.fq_terms = tuple(self._build_fq_terms(config))
+        self.default_tags = tuple(config.get('default_tags', []))
+        self.default_group_dicts = tuple(config.get('default_group_dicts', []))
+        # (key, value, whether the value has replacement strings)
+        self.default_extras = tuple(
+            (key, value, isinstance(value, six.string_types) and
+             ('{' in value or '}' in value))
+            for key, value in config.get('default_extras', {}).items())
+        self.override_extras = config.get('override_extras', False)
+
+    @staticmethod
+    def _build_fq_terms(config):
+        # Filter in/out datasets from particular organizations
+        fq_terms = []
+        org_filter_include = config.get('organizations_filter_include', [])
+        org_filter_exclude = config.get('organizations_filter_exclude', [])
+        if org_filter_include:
+            fq_terms.append(' OR '.join(
+                'organization:%s' % org_name for org_name in org_filter_include))
+        elif org_filter_exclude:
+            fq_terms.extend(
+                '-organization:%s' % org_name for org_name in org_filter_exclude)
+
+        groups_filter_include = config.get('groups_filter_include', [])
+        groups_filter_exclude = config.get('groups_filter_exclude', [])
+        if groups_filter_include:
+            fq_terms.append('groups:(%s)' % ' OR '.join(groups_filter_include))
+        elif groups_filter_exclude:
+            fq_terms.append('-groups:(%s)' % ' OR '.join(groups_filter_include))
+
+        field_filter_include = config.get('field_filter_include', [])
+        field_filter_exclude = config.get('field_filter_exclude', [])
+        if field_filter_include:
+            result = collections.defaultdict(list)
+            for item in field_filter_include:
+                result[item['field']].append(item['value'])
+            fq_terms.append(' OR '.join(
+                '%s:(%s)' % (key, ' OR '.join(result[key])) for key in result.keys()
+            ))
+        elif field_filter_exclude:
+            result = collections.defaultdict(list)
+            for item in field_filter_exclude:
+                result[item['field']].append(item['value'])
+            fq_terms.extend(
+                '-%s:(%s)' % (key, ' OR '.join(result[key])) for key in result.keys()
+            )
+        return fq_terms
+
+
+_source_configs = LRUCache(maxsize=100)
+
+
+def get_source_config(source_id, config_str):
+    '''
+    Returns the `CKANSourceConfig` for a harvest source config string,
+    parsing it only the first time it is seen for the source.
+    '''
+    key = (source_id,
+           hashlib.sha1(six.ensure_binary(config_str or '')).hexdigest())
+
+    def parse():
+        config = json.loads(config_str) if config_str else {}
+        log.debug('Using config: %r', config)
+        return CKANSourceConfig(config)
+
+    return _source_configs.get_or_set(key, parse)
+
 
 class CKANHarvester(HarvesterBase):
     '''
     A Harvester for CKAN instances
     '''
-    config = None
-
     api_version = 2
     action_api_version = 3
 
+    _job_caches = None
+    _job_cache_sources = None
+
+    @property
+    def _local(self):
+        # The config of the source being harvested is kept per thread, as the
+        # same harvester instance is shared by all of them
+        return self.__dict__.setdefault('_local_state', threading.local())
+
+    @property
+    def config(self):
+        return getattr(self._local, 'config', None)
+
+    @config.setter
+    def config(self, value):
+        self._local.config = value
+
     def _get_action_api_offset(self):
         return '/api/%d/action' % self.action_api_version
 
@@ -46,10 +197,8 @@ class CKANHarvester(HarvesterBase):
         if api_key:
             headers['Authorization'] = api_key
 
-        pyopenssl.inject_into_urllib3()
-
         try:
-            http_request = requests.get(url, headers=headers, params=params)
+            http_request = self._http_get(url, headers=headers, params=params)
         except HTTPError as e:
             raise ContentFetchError('HTTP error: %s %s' % (e.response.status_code, e.request.url))
         except RequestException as e:
@@ -83,15 +232,24 @@ class CKANHarvester(HarvesterBase):
             raise RemoteResourceError(
                 'Could not fetch/decode remote organization')
 
-    def _set_config(self, config_str):
-        if config_str:
-            self.config = json.loads(config_str)
-            if 'api_version' in self.config:
-                self.api_version = int(self.config['api_version'])
+    def _set_config(self, config_str, source_id=None):
+        source_config = get_source_config(source_id, config_str)
+        self._local.source_config = source_config
+        # The cached config is shared, give the harvester its own copy
+        self.config = copy.deepcopy(source_config.config)
+        if 'api_version' in self.config:
+            self.api_version = int(self.config['api_version'])
 
-            log.debug('Using config: %r', self.config)
-        else:
-            self.config = {}
+    def _get_source_config(self):
+        '''
+        Returns the `CKANSourceConfig` matching the current config.
+        '''
+        source_config = getattr(self._local, 'source_config', None)
+        if source_config is None or source_config.config != self.config:
+            # The config was set directly rather than with _set_config, or
+            # it has been modified since
+            source_config = CKANSourceConfig(self.config or {})
+        return source_config
 
     def info(self):
         return {
@@ -174,11 +332,53 @@ class CKANHarvester(HarvesterBase):
                 except NotFound:
                     raise ValueError('User not found')
 
-            for key in ('read_only', 'force_all'):
+            for key in ('read_only', 'force_all', 'stream_gather', 'skip_unchanged'):
                 if key in config_obj:
                     if not isinstance(config_obj[key], bool):
                         raise ValueError('%s must be boolean' % key)
 
+            if 'http_timeout' in config_obj:
+                timeout = config_obj['http_timeout']
+                if isinstance(timeout, list):
+                    if len(timeout) != 2 or not all(
+                            isinstance(t, (int, float)) for t in timeout):
+                        raise ValueError('http_timeout must be a number or '
+                                         'a list of two numbers')
+                elif not isinstance(timeout, (int, float)):
+                    raise ValueError('http_timeout must be a number or '
+                                     'a list of two numbers')
+
+            for key in ('http_retries', 'http_pool_maxsize'):
+                if key in config_obj:
+                    if not isinstance(config_obj[key], int):
+                        raise ValueError('%s must be an integer' % key)
+
+            if 'search_rows' in config_obj:
+                if not isinstance(config_obj['search_rows'], int) or \
+                        config_obj['search_rows'] < 1:
+                    raise ValueError('search_rows must be a positive integer')
+
+            if 'search_concurrency' in config_obj:
+                if not isinstance(config_obj['search_concurrency'], int) or \
+                        config_obj['search_concurrency'] < 1:
+                    raise ValueError('search_concurrency must be a positive '
+                                     'integer')
+
+            if 'fetch_weight' in config_obj:
+                if not isinstance(config_obj['fetch_weight'], int) or \
+                        config_obj['fetch_weight'] < 1:
+                    raise ValueError('fetch_weight must be a positive integer')
+
+            if 'search_paging' in config_obj:
+                if config_obj['search_paging'] not in ('offset', 'keyset'):
+                    raise ValueError('search_paging must be "offset" or '
+                                     '"keyset"')
+
+            if 'http_backoff_factor' in config_obj:
+                if not isinstance(config_obj['http_backoff_factor'],
+                                  (int, float)):
+                    raise ValueError('http_backoff_factor must be a number')
+
         except ValueError as e:
             raise e
 
@@ -215,73 +415,131 @@ class CKANHarvester(HarvesterBase):
                 return extra.value
         return None
 
+    def _get_job_cache(self, harvest_job, name):
+        '''
+        Returns the cache called ``name`` for the given harvest job, creating
+        it if necessary.
+
+        Import stages use these caches to avoid looking up the same groups,
+        organizations and source details for every object of a job. They are
+        bounded (see ``ckan.harvest.import_cache_size``) and dropped when
+        the job finishes, when a new job of the same source is imported, or
+        after being unused for a day.
+        '''
+        with _job_caches_lock:
+            if self._job_caches is None:
+                self._job_caches = LRUCache(maxsize=20, ttl=24 * 60 * 60)
+                self._job_cache_sources = {}
+                self._register_job_cache_owner()
+            job_caches = self._job_caches.get(harvest_job.id)
+            if job_caches is None:
+                # A new job for the source means previous ones are over
+                for job_id, source_id in list(self._job_cache_sources.items()):
+                    if source_id == harvest_job.source_id or \
+                            job_id not in self._job_caches:
+                        self._job_caches.pop(job_id)
+                        del self._job_cache_sources[job_id]
+                job_caches = {}
+                self._job_caches.set(harvest_job.id, job_caches)
+                self._job_cache_sources[harvest_job.id] = harvest_job.source_id
+            if name not in job_caches:
+                maxsize = toolkit.asint(
+                    toolkit.config.get('ckan.harvest.import_cache_size', 1000))
+                job_caches[name] = LRUCache(maxsize=maxsize)
+            # Refresh the expiry of the job caches
+            self._job_caches.set(harvest_job.id, job_caches)
+            return job_caches[name]
+
+    def _register_job_cache_owner(self):
+        # Called with _job_caches_lock held
+        global _job_cache_owners_registered
+        if not _job_cache_owners_registered:
+            from ckanext.harvest.queue import on_job_finished
+            on_job_finished(_drop_finished_job_caches)
+            _job_cache_owners_registered = True
+        _job_cache_owners.add(self)
+
+    def _drop_job_caches(self, harvest_job_id):
+        '''
+        Drops the import caches of a harvest job, eg once it has finished.
+        '''
+        with _job_caches_lock:
+            if self._job_caches is None:
+                return
+            self._job_caches.pop(harvest_job_id)
+            self._job_cache_sources.pop(harvest_job_id, None)
+
+    def get_job_cache_stats(self, harvest_job_id):
+        '''
+        Returns the hit and miss counters of the import caches of a harvest
+        job, keyed by cache name.
+        '''
+        with _job_caches_lock:
+            job_caches = self._job_caches.get(harvest_job_id) \
+                if self._job_caches is not None else None
+            return dict((name, cache.stats())
+                        for name, cache in (job_caches or {}).items())
+
+    def _find_local_group(self, context, group_ref):
+        try:
+            group = get_action('group_show')(context.copy(), {'id': group_ref})
+        except NotFound:
+            return None
+        return {'id': group['id'], 'name': group['name']}
+
+    def _find_local_organization_id(self, context, org_ref):
+        try:
+            org = get_action('organization_show')(context.copy(), {'id': org_ref})
+        except NotFound:
+            return None
+        return org['id']
+
+    def _get_remote_group_or_none(self, base_url, group):
+        try:
+            return self._get_group(base_url, group)
+        except RemoteResourceError:
+            return None
+
+    def _get_remote_organization_or_none(self, base_url, org_name):
+        try:
+            return self._get_organization(base_url, org_name)
+        except RemoteResourceError:
+            # fallback if remote CKAN exposes organizations as groups
+            # this especially targets older versions of CKAN
+            try:
+                return self._get_group(base_url, org_name)
+            except RemoteResourceError:
+                return None
+
     def gather_stage(self, harvest_job):
         log.debug('In CKANHarvester gather_stage (%s)',
                   harvest_job.source.url)
         toolkit.requires_ckan_version(min_version='2.0')
         get_all_packages = True
 
-        self._set_config(harvest_job.source.config)
+        self._set_config(harvest_job.source.config, harvest_job.source.id)
 
         # Get source URL
         remote_ckan_base_url = harvest_job.source.url.rstrip('/')
 
-        # Filter in/out datasets from particular organizations
-        fq_terms = []
-        org_filter_include = self.config.get('organizations_filter_include', [])
-        org_filter_exclude = self.config.get('organizations_filter_exclude', [])
-        if org_filter_include:
-            fq_terms.append(' OR '.join(
-                'organization:%s' % org_name for org_name in org_filter_include))
-        elif org_filter_exclude:
-            fq_terms.extend(
-                '-organization:%s' % org_name for org_name in org_filter_exclude)
-
-        groups_filter_include = self.config.get('groups_filter_include', [])
-        groups_filter_exclude = self.config.get('groups_filter_exclude', [])
-        if groups_filter_include:
-            fq_terms.append('groups:(%s)' % ' OR '.join(groups_filter_include))
-        elif groups_filter_exclude:
-            fq_terms.append('-groups:(%s)' % ' OR '.join(groups_filter_include))
+        fq_terms = list(self._get_source_config().fq_terms)
 
-        field_filter_include = self.config.get('field_filter_include', [])
-        field_filter_exclude = self.config.get('field_filter_exclude', [])
-        if field_filter_include:
-            result = collections.defaultdict(list)
-            for item in field_filter_include:
-                result[item['field']].append(item['value'])
-            fq_terms.append(' OR '.join(
-                '%s:(%s)' % (key, ' OR '.join(result[key])) for key in result.keys()
-            ))
-        elif field_filter_exclude:
-            result = collections.defaultdict(list)
-            for item in field_filter_exclude:
-                result[item['field']].append(item['value'])
-            fq_terms.extend(
-                '-%s:(%s)' % (key, ' OR '.join(result[key])) for key in result.keys()
-            )
+        if self.config.get('stream_gather', False):
+            if self._overrides_modify_search():
+                # modify_search expects all the search results at once
+                log.info('Not streaming the gather stage of %s, as '
+                         'modify_search is overridden',
+                         harvest_job.source.url)
+            else:
+                return self._gather_stage_streaming(
+                    harvest_job, remote_ckan_base_url, fq_terms)
 
         # Ideally we can request from the remote CKAN only those datasets
         # modified since the last completely successful harvest.
-        last_error_free_job = self.last_error_free_job(harvest_job)
-        log.debug('Last error-free job: %r', last_error_free_job)
-        if (last_error_free_job and
-                not self.config.get('force_all', False)):
+        fq_since_last_time = self._get_fq_since_last_time(harvest_job)
+        if fq_since_last_time:
             get_all_packages = False
 
-            # Request only the datasets modified since
-            last_time = last_error_free_job.gather_started
-            # Note: SOLR works in UTC, and gather_started is also UTC, so
-            # this should work as long as local and remote clocks are
-            # relatively accurate. Going back a little earlier, just in case.
-            get_changes_since = \
-                (last_time - datetime.timedelta(hours=1)).isoformat()
-            log.info('Searching for datasets modified since: %s UTC',
-                     get_changes_since)
-
-            fq_since_last_time = 'metadata_modified:[{since}Z TO *]' \
-                .format(since=get_changes_since)
-
             try:
                 pkg_dicts = self._search_for_datasets(
                     remote_ckan_base_url,
@@ -293,8 +551,7 @@ class CKANHarvester(HarvesterBase):
 
             if not get_all_packages and not pkg_dicts:
                 log.info('No datasets have been updated on the remote '
-                         'CKAN instance since the last harvest job %s',
-                         last_time)
+                         'CKAN instance since the last harvest job')
                 return []
 
         # Fall-back option - request all the datasets from the remote CKAN
@@ -313,13 +570,8 @@ class CKANHarvester(HarvesterBase):
                 return None
 
             all_remote_pkg_ids = set([x['id'] for x in pkg_dicts])
-            # get all local packages for this harvest source
-            all_local_source_pkg = harvest_helpers.all_packages_for_source(harvest_job.source.id)
-            all_local_source_pkg_ids = set([x['id'] for x in all_local_source_pkg])
-            # id's of packages no longer available on remote
-            to_delete_id = all_local_source_pkg_ids - all_remote_pkg_ids
-            # packages no longer available on remote
-            to_delete_pkg = [x for x in all_local_source_pkg if x['id'] in to_delete_id]
+            to_delete_pkg = self._get_packages_to_delete(harvest_job,
+                                                         all_remote_pkg_ids)
 
         if not pkg_dicts:
             self._save_gather_error(
@@ -333,57 +585,214 @@ class CKANHarvester(HarvesterBase):
             object_ids = []
 
             # delete missing datasets
-            for pkg_dict in to_delete_pkg:
-                if pkg_dict['id'] in package_ids:
-                    log.info('Discarding duplicate dataset %s - probably due '
-                             'to datasets being changed at the same time as '
-                             'when the harvester was paging through',
-                             pkg_dict['id'])
-                    continue
-                package_ids.add(pkg_dict['id'])
-
-                log.debug('Creating HarvestObject for %s %s with status "delete"',
-                          pkg_dict['name'], pkg_dict['id'])
-                obj = HarvestObject(guid=pkg_dict['id'],
-                                    extras=[HOExtra(key='status', value='delete')],
-                                    job=harvest_job,
-                                    content=json.dumps(pkg_dict))
-                obj.save()
-                object_ids.append(obj.id)
+            object_ids.extend(self._create_harvest_objects_for_page(
+                harvest_job, to_delete_pkg, package_ids, status='delete'))
 
             # process rest of datasets
-            for pkg_dict in pkg_dicts:
-                if pkg_dict['id'] in package_ids:
-                    log.info('Discarding duplicate dataset %s - probably due '
-                             'to datasets being changed at the same time as '
-                             'when the harvester was paging through',
-                             pkg_dict['id'])
-                    continue
-                package_ids.add(pkg_dict['id'])
-
-                log.debug('Creating HarvestObject for %s %s',
-                          pkg_dict['name'], pkg_dict['id'])
-                obj = HarvestObject(guid=pkg_dict['id'],
-                                    job=harvest_job,
-                                    content=json.dumps(pkg_dict))
-                obj.save()
-                object_ids.append(obj.id)
+            object_ids.extend(self._create_harvest_objects_for_page(
+                harvest_job, pkg_dicts, package_ids))
 
             return object_ids
         except Exception as e:
             self._save_gather_error('%r' % e.message, harvest_job)
 
+    def _gather_stage_streaming(self, harvest_job, remote_ckan_base_url,
+                                fq_terms):
+        '''
+        Streaming version of the gather stage, used when ``stream_gather`` is
+        set in the source configuration.
+
+        Instead of collecting the whole remote catalogue before creating any
+        harvest object, the objects for each page of search results are
+        created as soon as the page arrives and their ids are yielded, so
+        they can be sent to the fetch queue straight away. Only the ids of
+        the remote datasets are kept in memory between pages.
+        '''
+        pages = None
+        fq_since_last_time = self._get_fq_since_last_time(harvest_job)
+        if fq_since_last_time:
+            pages = self._search_for_datasets_pages(
+                remote_ckan_base_url, fq_terms + [fq_since_last_time])
+            try:
+                first_page = next(pages, None)
+            except SearchError as e:
+                log.info('Searching for datasets changed since last time '
+                         'gave an error: %s', e)
+                pages = None
+            else:
+                if first_page is None:
+                    log.info('No datasets have been updated on the remote '
+                             'CKAN instance since the last harvest job')
+                    return
+                pages = itertools.chain([first_page], pages)
+
+        get_all_packages = pages is None
+        if get_all_packages:
+            pages = self._search_for_datasets_pages(remote_ckan_base_url,
+                                                    fq_terms)
+
+        package_ids = set()
+        try:
+            for pkg_dicts in pages:
+                try:
+                    object_ids = self._create_harvest_objects_for_page(
+                        harvest_job, pkg_dicts, package_ids)
+                except Exception as e:
+                    self._save_gather_error('%r' % e.message, harvest_job)
+                    return
+                yield object_ids
+        except SearchError as e:
+            log.info('Searching for datasets gave an error: %s', e)
+            self._save_gather_error(
+                'Unable to search remote CKAN for datasets:%s url:%s'
+                'terms:%s' % (e, remote_ckan_base_url, fq_terms),
+                harvest_job)
+            return
+
+        if not package_ids:
+            if get_all_packages:
+                self._save_gather_error(
+                    'No datasets found at CKAN: %s' % remote_ckan_base_url,
+                    harvest_job)
+            return
+
+        if get_all_packages:
+            to_delete_pkg = self._get_packages_to_delete(harvest_job,
+                                                         package_ids)
+            try:
+                object_ids = self._create_harvest_objects_for_page(
+                    harvest_job, to_delete_pkg, package_ids, status='delete')
+            except Exception as e:
+                self._save_gather_error('%r' % e.message, harvest_job)
+                return
+            yield object_ids
+
+    def _overrides_modify_search(self):
+        '''
+        Returns whether a subclass overrides `modify_search`, which is called
+        once with all the search results, so the gather stage can't be
+        streamed.
+        '''
+        return getattr(type(self).modify_search, '__func__',
+                       type(self).modify_search) is not \
+            getattr(CKANHarvester.modify_search, '__func__',
+                    CKANHarvester.modify_search)
+
+    def _get_fq_since_last_time(self, harvest_job):
+        '''
+        Returns the search filter that requests only the datasets modified
+        since the last completely successful harvest, or None if all the
+        datasets need to be requested.
+        '''
+        last_error_free_job = self.last_error_free_job(harvest_job)
+        log.debug('Last error-free job: %r', last_error_free_job)
+        if (not last_error_free_job or
+                self.config.get('force_all', False)):
+            return None
+
+        # Request only the datasets modified since
+        last_time = last_error_free_job.gather_started
+        # Note: SOLR works in UTC, and gather_started is also UTC, so
+        # this should work as long as local and remote clocks are
+        # relatively accurate. Going back a little earlier, just in case.
+        get_changes_since = \
+            (last_time - datetime.timedelta(hours=1)).isoformat()
+        log.info('Searching for datasets modified since: %s UTC',
+                 get_changes_since)
+
+        return 'metadata_modified:[{since}Z TO *]' \
+            .format(since=get_changes_since)
+
+    def _get_packages_to_delete(self, harvest_job, remote_pkg_ids):
+        '''
+        Returns the local datasets of the harvest source that are no longer
+        available on the remote CKAN.
+        '''
+        return self._get_packages_not_in(harvest_job.source.id,
+                                          remote_pkg_ids)
+
+    def _create_harvest_objects_for_page(self, harvest_job, pkg_dicts,
+                                         package_ids, status=None):
+        '''
+        Creates a harvest object for each of the given datasets and returns
+        their ids.
+
+        Datasets whose id is already in ``package_ids`` are discarded and the
+        ids of the new ones are added to it, so the same set can be passed in
+        for all the pages of a search.
+        '''
+        rows = []
+        for pkg_dict in pkg_dicts:
+            if pkg_dict['id'] in package_ids:
+                log.info('Discarding duplicate dataset %s - probably due '
+                         'to datasets being changed at the same time as '
+                         'when the harvester was paging through',
+                         pkg_dict['id'])
+                continue
+            package_ids.add(pkg_dict['id'])
+
+            if status:
+                log.debug('Creating HarvestObject for %s %s with status "%s"',
+                          pkg_dict['name'], pkg_dict['id'], status)
+                extras = {'status': status}
+            else:
+                log.debug('Creating HarvestObject for %s %s',
+                          pkg_dict['name'], pkg_dict['id'])
+                extras = None
+            rows.append({'guid': pkg_dict['id'],
+                         'content': json.dumps(pkg_dict),
+                         'content_hash': None if status else
+                         self._get_content_hash(pkg_dict, self.config),
+                         'extras': extras})
+
+        return self._bulk_create_harvest_objects(harvest_job, rows)
+
     def _search_for_datasets(self, remote_ckan_base_url, fq_terms=None):
         '''Does a dataset search on a remote CKAN and returns the results.
 
         Deals with paging to return all the results, not just the first page.
         '''
+        pkg_dicts = []
+        for pkg_dicts_page in self._search_for_datasets_pages(
+                remote_ckan_base_url, fq_terms):
+            pkg_dicts.extend(pkg_dicts_page)
+
+        pkg_dicts = self.modify_search(pkg_dicts, remote_ckan_base_url, fq_terms)
+
+        return pkg_dicts
+
+    def _search_for_datasets_pages(self, remote_ckan_base_url, fq_terms=None):
+        '''Does a dataset search on a remote CKAN and yields the results one
+        page at a time.
+
+        Datasets already returned in a previous page are left out.
+
+        The number of datasets requested per page can be set with the
+        ``search_rows`` option and the way of paging through the results with
+        ``search_paging``:
+
+        * ``offset`` (default): increasing ``start`` offsets.
+        * ``keyset``: each page asks for the datasets with an id greater than
+          the last one of the previous page, so the remote never has to skip
+          over the earlier results.
+
+        The remote CKAN returns at most ``ckan.search.rows_max`` datasets per
+        page (1000 by default) whatever is requested, so the paging relies on
+        the number of datasets actually returned, and only stops when a page
+        comes back empty.
+
+        With offset paging, setting ``search_concurrency`` to more than 1
+        requests the following pages in parallel once the first page has
+        returned the total count. Pages are still yielded in order. The
+        requests sent at the same time to a remote host are limited to that
+        number for all the sources harvested from it (see
+        `_get_host_semaphore`).
+        '''
         base_search_url = remote_ckan_base_url + self._get_search_api_offset()
-        params = {'rows': '100', 'start': '0'}
+        rows = min(int(self.config.get('search_rows', 100)), MAX_SEARCH_ROWS)
+        params = {'rows': str(rows), 'start': '0'}
         # There is the worry that datasets will be changed whilst we are paging
         # through them.
-        # * In SOLR 4.7 there is a cursor, but not using that yet
-        #   because few CKANs are running that version yet.
         # * However we sort, then new names added or removed before the current
         #   page would cause existing names on the next page to be missed or
         #   double counted.
@@ -395,9 +804,11 @@ class CKANHarvester(HarvesterBase):
         #   datasets are only missed if some are removed, which is far less
         #   likely than any being added. If some are missed then it is assumed
         #   they will harvested the next time anyway. When datasets are added,
-        #   we are at risk of seeing datasets twice in the paging, so we detect
-        #   and remove any duplicates.
+        #   we are at risk of seeing datasets twice in the offset paging, so we
+        #   detect and remove any duplicates. Keyset paging doesn't have this
+        #   problem, as every page starts after the last id seen.
         params['sort'] = 'id asc'
+        fq_terms = list(fq_terms or [])
         if fq_terms:
             params['fq'] = ' '.join(fq_terms)
 
@@ -406,58 +817,116 @@ class CKANHarvester(HarvesterBase):
         if use_default_schema:
             params['use_default_schema'] = use_default_schema
 
-        pkg_dicts = []
+        paging = self.config.get('search_paging', 'offset')
+
         pkg_ids = set()
         previous_content = None
-        while True:
-            url = base_search_url + '?' + urlencode(params)
-            log.debug('Searching for CKAN datasets: %s', url)
-            try:
-                content = self._get_content(url)
-            except ContentFetchError as e:
-                raise SearchError(
-                    'Error sending request to search remote '
-                    'CKAN instance %s using URL %r. Error: %s' %
-                    (remote_ckan_base_url, url, e))
-
-            if previous_content and content == previous_content:
-                raise SearchError('The paging doesn\'t seem to work. URL: %s' %
-                                  url)
-            try:
-                response_dict = json.loads(content)
-            except ValueError:
-                raise SearchError('Response from remote CKAN was not JSON: %r'
-                                  % content)
-            try:
-                pkg_dicts_page = response_dict.get('result', {}).get('results',
-                                                                     [])
-            except ValueError:
-                raise SearchError('Response JSON did not contain '
-                                  'result/results: %r' % response_dict)
-
-            # Weed out any datasets found on previous pages (should datasets be
-            # changing while we page)
-            ids_in_page = set(p['id'] for p in pkg_dicts_page)
-            duplicate_ids = ids_in_page & pkg_ids
-            if duplicate_ids:
-                pkg_dicts_page = [p for p in pkg_dicts_page
-                                  if p['id'] not in duplicate_ids]
-            pkg_ids |= ids_in_page
-
-            pkg_dicts.extend(pkg_dicts_page)
-
-            if len(pkg_dicts_page) == 0:
-                break
-
-            for p in pkg_dicts_page:
-                if p.get('type') and package_type:
-                    p['type'] = package_type
-
-            params['start'] = str(int(params['start']) + int(params['rows']))
+        concurrency = int(self.config.get('search_concurrency', 1))
+        semaphore = _get_host_semaphore(remote_ckan_base_url, concurrency)
+        if paging != 'offset':
+            concurrency = 1
+        executor = None
+        prefetched = collections.deque()
+        try:
+            while True:
+                if prefetched:
+                    url, content = prefetched.popleft().result()
+                else:
+                    url, content = self._fetch_search_page(
+                        remote_ckan_base_url, base_search_url, params,
+                        semaphore=semaphore)
+
+                if previous_content and content == previous_content:
+                    raise SearchError('The paging doesn\'t seem to work. URL: %s' %
+                                      url)
+                previous_content = content
+                try:
+                    response_dict = json.loads(content)
+                except ValueError:
+                    response_dict = None
 
-        pkg_dicts = self.modify_search(pkg_dicts, remote_ckan_base_url, fq_terms)
+                if response_dict is None:
+                    raise SearchError('Response from remote CKAN was not JSON: %r'
+                                      % content)
+                try:
+                    result = response_dict.get('result', {})
+                    pkg_dicts_page = result.get('results', [])
+                except (ValueError, AttributeError):
+                    raise SearchError('Response JSON did not contain '
+                                      'result/results: %r' % response_dict)
+
+                if len(pkg_dicts_page) == 0:
+                    break
+                page_size = len(pkg_dicts_page)
+                last_id = pkg_dicts_page[-1]['id']
+
+                if paging == 'offset':
+                    # Weed out any datasets found on previous pages (should
+                    # datasets be changing while we page)
+                    ids_in_page = set(p['id'] for p in pkg_dicts_page)
+                    duplicate_ids = ids_in_page & pkg_ids
+                    if duplicate_ids:
+                        pkg_dicts_page = [p for p in pkg_dicts_page
+                                          if p['id'] not in duplicate_ids]
+                    pkg_ids |= ids_in_page
+
+                for p in pkg_dicts_page:
+                    if p.get('type') and package_type:
+                        p['type'] = package_type
+
+                if pkg_dicts_page:
+                    yield pkg_dicts_page
+
+                if paging == 'offset':
+                    params['start'] = str(int(params['start']) + page_size)
+                    if executor is None and page_size < rows:
+                        # The remote returns fewer rows per page than
+                        # requested (see ckan.search.rows_max)
+                        rows = page_size
+                    if concurrency > 1 and ThreadPoolExecutor:
+                        # The total number of results is known, so request the
+                        # following pages in parallel, keeping a bounded number
+                        # of them in flight
+                        if executor is None:
+                            executor = ThreadPoolExecutor(max_workers=concurrency)
+                            next_start = int(params['start'])
+                        count = result.get('count') or 0
+                        while len(prefetched) < 2 * concurrency and \
+                                next_start < count:
+                            prefetched.append(executor.submit(
+                                self._fetch_search_page, remote_ckan_base_url,
+                                base_search_url, dict(params, start=str(next_start)),
+                                config=self.config, semaphore=semaphore))
+                            next_start += rows
+                    continue
 
-        return pkg_dicts
+                params['fq'] = ' '.join(
+                    fq_terms + ['+id:{"%s" TO *]' % last_id])
+        finally:
+            if executor is not None:
+                for future in prefetched:
+                    future.cancel()
+                executor.shutdown(wait=False)
+
+    def _fetch_search_page(self, remote_ckan_base_url, base_search_url,
+                           params, config=None, semaphore=None):
+        if config is not None:
+            # Running on a prefetch thread, which has no config of its own
+            self.config = config
+        url = base_search_url + '?' + urlencode(params)
+        log.debug('Searching for CKAN datasets: %s', url)
+        try:
+            if semaphore is not None:
+                with semaphore:
+                    content = self._get_content(url)
+            else:
+                content = self._get_content(url)
+        except ContentFetchError as e:
+            raise SearchError(
+                'Error sending request to search remote '
+                'CKAN instance %s using URL %r. Error: %s' %
+                (remote_ckan_base_url, url, e))
+        return url, content
 
     def fetch_stage(self, harvest_object):
         # Nothing to do here - we got the package dict in the search in the
@@ -479,7 +948,9 @@ class CKANHarvester(HarvesterBase):
                                     harvest_object, 'Import')
             return False
 
-        self._set_config(harvest_object.job.source.config)
+        self._set_config(harvest_object.job.source.config,
+                         harvest_object.job.source.id)
+        source_config = self._get_source_config()
 
         try:
             package_dict = json.loads(harvest_object.content)
@@ -500,13 +971,24 @@ class CKANHarvester(HarvesterBase):
 
                 return True
 
+            if self.config.get('skip_unchanged', False) and \
+                    not self.config.get('force_all', False):
+                if not harvest_object.content_hash:
+                    harvest_object.content_hash = self._get_content_hash(
+                        package_dict, self.config)
+                if self._is_unchanged(harvest_object):
+                    log.info('Dataset %s has not changed since it was last '
+                             'imported, skipping', harvest_object.guid)
+                    return 'unchanged'
+
             # Set default tags if needed
-            default_tags = self.config.get('default_tags', [])
+            default_tags = source_config.default_tags
             if default_tags:
                 if 'tags' not in package_dict:
                     package_dict['tags'] = []
                 package_dict['tags'].extend(
-                    [t for t in default_tags if t not in package_dict['tags']])
+                    [copy.deepcopy(t) for t in default_tags
+                     if t not in package_dict['tags']])
 
             remote_groups = self.config.get('remote_groups', None)
             if remote_groups not in ('only_local', 'create'):
@@ -518,46 +1000,51 @@ class CKANHarvester(HarvesterBase):
 
                 # check if remote groups exist locally, otherwise remove
                 validated_groups = []
+                local_groups = self._get_job_cache(harvest_object.job, 'local_groups')
+                remote_group_dicts = self._get_job_cache(harvest_object.job, 'remote_groups')
 
                 for group_ in package_dict['groups']:
-                    try:
-                        try:
-                            if 'id' in group_:
-                                data_dict = {'id': group_['id']}
-                                group = get_action('group_show')(base_context.copy(), data_dict)
-                            else:
-                                raise NotFound
-
-                        except NotFound:
-                            if 'name' in group_:
-                                data_dict = {'id': group_['name']}
-                                group = get_action('group_show')(base_context.copy(), data_dict)
-                            else:
-                                raise NotFound
+                    group = None
+                    for key in ('id', 'name'):
+                        if key in group_:
+                            group = local_groups.get_or_set(
+                                group_[key],
+                                lambda: self._find_local_group(base_context, group_[key]))
+                        if group:
+                            break
+                    if group:
                         # Found local group
-                        validated_groups.append({'id': group['id'], 'name': group['name']})
-
-                    except NotFound:
-                        log.info('Group %s is not available', group_)
-                        if remote_groups == 'create':
-                            try:
-                                group = self._get_group(harvest_object.source.url, group_)
-                            except RemoteResourceError:
-                                log.error('Could not get remote group %s', group_)
-                                continue
-
-                            for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name']:
-                                group.pop(key, None)
-
-                            get_action('group_create')(base_context.copy(), group)
-                            log.info('Group %s has been newly created', group_)
-                            validated_groups.append({'id': group['id'], 'name': group['name']})
+                        validated_groups.append(dict(group))
+                        continue
+
+                    log.info('Group %s is not available', group_)
+                    if remote_groups == 'create':
+                        group = remote_group_dicts.get_or_set(
+                            group_.get('id'),
+                            lambda: self._get_remote_group_or_none(
+                                harvest_object.source.url, group_))
+                        if group is None:
+                            log.error('Could not get remote group %s', group_)
+                            continue
+                        group = dict(group)
+
+                        for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name']:
+                            group.pop(key, None)
+
+                        get_action('group_create')(base_context.copy(), group)
+                        log.info('Group %s has been newly created', group_)
+                        group = {'id': group['id'], 'name': group['name']}
+                        local_groups.set(group['id'], group)
+                        local_groups.set(group['name'], group)
+                        validated_groups.append(dict(group))
 
                 package_dict['groups'] = validated_groups
 
             # Local harvest source organization
-            source_dataset = get_action('package_show')(base_context.copy(), {'id': harvest_object.source.id})
-            local_org = source_dataset.get('owner_org')
+            local_org = self._get_job_cache(harvest_object.job, 'source').get_or_set(
+                'owner_org',
+                lambda: get_action('package_show')(
+                    base_context.copy(), {'id': harvest_object.source.id}).get('owner_org'))
 
             remote_orgs = self.config.get('remote_orgs', None)
 
@@ -575,27 +1062,29 @@ class CKANHarvester(HarvesterBase):
                 remote_org = self.modify_remote_organization(remote_org, package_dict, base_context.copy())
 
                 if remote_org:
-                    try:
-                        data_dict = {'id': remote_org}
-                        org = get_action('organization_show')(base_context.copy(), data_dict)
-                        validated_org = org['id']
-                    except NotFound:
+                    local_orgs = self._get_job_cache(harvest_object.job, 'local_orgs')
+                    validated_org = local_orgs.get_or_set(
+                        remote_org,
+                        lambda: self._find_local_organization_id(base_context, remote_org))
+                    if not validated_org:
                         log.info('Organization %s is not available', remote_org)
                         if remote_orgs == 'create':
+                            org = self._get_job_cache(harvest_object.job, 'remote_orgs').get_or_set(
+                                remote_org,
+                                lambda: self._get_remote_organization_or_none(
+                                    harvest_object.source.url, remote_org))
                             try:
-                                try:
-                                    org = self._get_organization(harvest_object.source.url, remote_org)
-                                except RemoteResourceError:
-                                    # fallback if remote CKAN exposes organizations as groups
-                                    # this especially targets older versions of CKAN
-                                    org = self._get_group(harvest_object.source.url, remote_org)
-
+                                if org is None:
+                                    raise RemoteResourceError(
+                                        'Could not fetch/decode remote organization')
+                                org = dict(org)
                                 for key in ['packages', 'created', 'users', 'groups', 'tags',
                                             'extras', 'display_name', 'type']:
                                     org.pop(key, None)
                                 get_action('organization_create')(base_context.copy(), org)
                                 log.info('Organization %s has been newly created', remote_org)
                                 validated_org = org['id']
+                                local_orgs.set(remote_org, validated_org)
                             except (RemoteResourceError, ValidationError):
                                 log.error('Could not get remote org %s', remote_org)
 
@@ -608,28 +1097,28 @@ class CKANHarvester(HarvesterBase):
                     package_dict['groups'] = []
                 existing_group_ids = [g['id'] for g in package_dict['groups']]
                 package_dict['groups'].extend(
-                    [g for g in self.config['default_group_dicts']
+                    [copy.deepcopy(g) for g in source_config.default_group_dicts
                      if g['id'] not in existing_group_ids])
 
             # Set default extras if needed
-            default_extras = self.config.get('default_extras', {})
+            default_extras = source_config.default_extras
 
             def get_extra(key, package_dict):
                 for extra in package_dict.get('extras', []):
                     if extra['key'] == key:
                         return extra
             if default_extras:
-                override_extras = self.config.get('override_extras', False)
+                override_extras = source_config.override_extras
                 if 'extras' not in package_dict:
                     package_dict['extras'] = []
-                for key, value in default_extras.items():
+                for key, value, is_template in default_extras:
                     existing_extra = get_extra(key, package_dict)
                     if existing_extra and not override_extras:
                         continue  # no need for the default
                     if existing_extra:
                         package_dict['extras'].remove(existing_extra)
                     # Look for replacement strings
-                    if isinstance(value, six.string_types):
+                    if is_template:
                         value = value.format(
                             harvest_source_id=harvest_object.job.source.id,
                             harvest_source_url=harvest_object.job.source.url.strip('/'),
@@ -637,6 +1126,8 @@ class CKANHarvester(HarvesterBase):
                             harvest_job_id=harvest_object.job.id,
                             harvest_object_id=harvest_object.id,
                             dataset_id=package_dict['id'])
+                    elif not isinstance(value, six.string_types):
+                        value = copy.deepcopy(value)
 
                     package_dict['extras'].append({'key': key, 'value': value})
 
@@ -1,12 +1,10 @@
 import requests
 import datetime
-from urllib3.contrib import pyopenssl
 
 from ckan import model
 from ckan.logic import ValidationError, NotFound, get_action
 from ckan.lib.helpers import json
 from ckan.plugins import toolkit
-from ckanext.harvest.model import HarvestObject
 from .base import HarvesterBase
 
 import logging
@@ -34,10 +32,8 @@ class CKANSchemaHarvester(HarvesterBase):
         if api_key:
             headers['Authorization'] = api_key
 
-        pyopenssl.inject_into_urllib3()
-
         try:
-            http_response = requests.get(url, headers = headers, params = params)
+            http_response = self._http_get(url, headers=headers, params=params)
             http_response.raise_for_status()
         except requests.exceptions.HTTPError as e:
             if e.getcode() == 404:
@@ -266,7 +262,7 @@ class CKANSchemaHarvester(HarvesterBase):
         # Create harvest objects for each dataset
         try:
             package_ids = set()
-            object_ids = []
+            rows = []
             for pkg_dict in pkg_dicts:
                 if pkg_dict['id'] in package_ids:
                     log.info('Discarding duplicate dataset %s - probably due '
@@ -278,13 +274,10 @@ class CKANSchemaHarvester(HarvesterBase):
 
                 log.debug('Creating HarvestObject for %s %s',
                           pkg_dict['name'], pkg_dict['id'])
-                obj = HarvestObject(guid=pkg_dict['id'],
-                                    job=harvest_job,
-                                    content=json.dumps(pkg_dict))
-                obj.save()
-                object_ids.append(obj.id)
+                rows.append({'guid': pkg_dict['id'],
+                             'content': json.dumps(pkg_dict)})
 
-            return object_ids
+            return self._bulk_create_harvest_objects(harvest_job, rows)
         except Exception as e:
             self._save_gather_error('%r' % e.message, harvest_job)
 
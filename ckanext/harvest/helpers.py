@@ -8,7 +8,7 @@ from ckanext.harvest.model import UPDATE_FREQUENCIES
 from ckanext.harvest.utils import (
     DATASET_TYPE_NAME
 )
-from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest import registry
 
 
 c = p.toolkit.c
@@ -107,7 +107,7 @@ def all_packages_for_source(source_id):
     query = logic.get_action('package_search')(context, search_dict)
 
     while query['results']:
-        out = out + query['results']
+        out.extend(query['results'])
         search_dict['start'] = search_dict['start'] + limit
         query = logic.get_action('package_search')(context, search_dict)
 
@@ -161,10 +161,10 @@ def link_for_harvest_object(id=None, guid=None, text=None):
 
 def harvest_source_extra_fields():
     fields = {}
-    for harvester in p.PluginImplementations(IHarvester):
+    for name, harvester in registry.get_harvesters().items():
         if not hasattr(harvester, 'extra_schema'):
             continue
-        fields[harvester.info()['name']] = list(harvester.extra_schema().keys())
+        fields[name] = list(harvester.extra_schema().keys())
     return fields
 
 
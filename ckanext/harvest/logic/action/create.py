@@ -83,6 +83,10 @@ def harvest_job_create(context, data_dict):
     :type source_id: string
     :param run: whether to also run it or not (default: True)
     :type run: bool
+    :param priority: whether the objects of the job go before the ones of
+        other jobs in the fetch queue, when fair queuing is enabled (default:
+        False)
+    :type priority: bool
     '''
     log.info('Harvest job create: %r', data_dict)
     check_access('harvest_job_create', context, data_dict)
@@ -117,7 +121,8 @@ def harvest_job_create(context, data_dict):
 
     if run_it:
         toolkit.get_action('harvest_send_job_to_gather_queue')(
-            context, {'id': job.id})
+            context, {'id': job.id,
+                      'priority': data_dict.get('priority', False)})
 
     return harvest_job_dictize(job, context)
 
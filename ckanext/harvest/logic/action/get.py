@@ -7,6 +7,7 @@ import datetime
 from ckan import logic
 from ckan.plugins import PluginImplementations
 from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest import registry
 
 import ckan.plugins as p
 from ckan.logic import NotFound, check_access, side_effect_free
@@ -185,10 +186,9 @@ def harvest_job_report(context, data_dict):
     # Check if the harvester for this job's source has a method for returning
     # the URL to the original document
     original_url_builder = None
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == job.source.type:
-            if hasattr(harvester, 'get_original_url'):
-                original_url_builder = harvester.get_original_url
+    harvester = registry.get_harvester(job.source.type)
+    if hasattr(harvester, 'get_original_url'):
+        original_url_builder = harvester.get_original_url
 
     q = model.Session.query(harvest_model.HarvestObjectError, harvest_model.HarvestObject.guid) \
         .join(harvest_model.HarvestObject) \
@@ -264,11 +264,7 @@ def harvest_object_show(context, data_dict):
         if not pkg:
             raise p.toolkit.ObjectNotFound('Dataset not found')
 
-        obj = model.Session.query(HarvestObject) \
-            .filter(HarvestObject.package_id == pkg.id) \
-            .filter(
-            HarvestObject.current == True  # noqa: E712
-        ).first()
+        obj = HarvestObject.get_current_for_package(pkg.id)
     else:
         raise p.toolkit.ValidationError(
             'Please provide either an "id" or a "dataset_id" parameter')
@@ -289,7 +285,7 @@ def harvest_object_list(context, data_dict):
     only_current = data_dict.get('only_current', True)
     source_id = data_dict.get('source_id', False)
 
-    query = session.query(HarvestObject)
+    query = session.query(HarvestObject.id)
 
     if source_id:
         query = query.filter(HarvestObject.harvest_source_id == source_id)
@@ -299,9 +295,7 @@ def harvest_object_list(context, data_dict):
             HarvestObject.current == True  # noqa: E712
         )
 
-    objects = query.all()
-
-    return [getattr(obj, 'id') for obj in objects]
+    return [id for id, in query]
 
 
 @side_effect_free
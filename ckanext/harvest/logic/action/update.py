@@ -8,13 +8,13 @@ import logging
 import datetime
 
 from ckantoolkit import config
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, bindparam, func, or_
 from six.moves.urllib.parse import urljoin
 
 from ckan.lib.search.index import PackageSearchIndex
-from ckan.plugins import toolkit, PluginImplementations
+from ckan.plugins import toolkit
 from ckan.logic import get_action
-from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest import registry
 from ckan.lib.search.common import SearchIndexError, make_connection
 
 from ckan.model import Package
@@ -26,14 +26,16 @@ from ckanext.harvest.utils import (
     DATASET_TYPE_NAME
 )
 from ckanext.harvest.queue import (
-    get_gather_publisher, resubmit_jobs, resubmit_objects)
+    get_gather_publisher, resubmit_jobs, resubmit_objects, notify_jobs_finished)
 
-from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, HarvestGatherError
+from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject, HarvestGatherError,
+                                   HarvestGuidState, HarvestJobStats,
+                                   rebuild_job_stats)
 from ckanext.harvest.logic import HarvestJobExists
 from ckanext.harvest.logic.dictization import harvest_job_dictize
 
 from ckanext.harvest.logic.action.get import (
-    harvest_source_show, harvest_job_list, _get_sources_for_user)
+    harvest_source_show, _get_sources_for_user)
 
 import ckan.lib.mailer as mailer
 from itertools import islice
@@ -248,6 +250,8 @@ def harvest_source_clear(context, data_dict):
     commit;
     '''
     model.Session.execute(sql)
+    # The deletes are not seen by the job stats listeners
+    rebuild_job_stats(source_id=harvest_source_id)
 
     # Refresh the index for this source to update the status object
     get_action('harvest_source_reindex')(context, {'id': harvest_source_id})
@@ -430,6 +434,8 @@ def harvest_source_job_history_clear(context, data_dict):
         '''.format(harvest_source_id=harvest_source_id)
 
     model.Session.execute(sql)
+    # The deletes are not seen by the job stats listeners
+    rebuild_job_stats(source_id=harvest_source_id)
 
     # Refresh the index for this source to update the status object
     get_action('harvest_source_reindex')(context, {'id': harvest_source_id})
@@ -521,9 +527,20 @@ def harvest_objects_import(context, data_dict):
 
     if guid:
         last_objects_ids = \
-            session.query(HarvestObject.id) \
-                   .filter(HarvestObject.guid == guid) \
-                   .filter(HarvestObject.current == True)  # noqa: E712
+            session.query(HarvestGuidState.harvest_object_id) \
+                   .filter(HarvestGuidState.guid == guid)
+        if join_datasets:
+            last_objects_ids = last_objects_ids \
+                .join(Package, Package.id == HarvestGuidState.package_id) \
+                .filter(Package.state == u'active')
+            join_datasets = False
+        if not last_objects_ids.first():
+            # No guid state, look for the current object
+            last_objects_ids = \
+                session.query(HarvestObject.id) \
+                       .filter(HarvestObject.guid == guid) \
+                       .filter(HarvestObject.current == True)  # noqa: E712
+            join_datasets = context.get('join_datasets', True)
 
     elif source_id:
         source = HarvestSource.get(source_id)
@@ -573,12 +590,11 @@ def harvest_objects_import(context, data_dict):
 
         obj = session.query(HarvestObject).get(obj_id)
 
-        for harvester in PluginImplementations(IHarvester):
-            if harvester.info()['name'] == obj.source.type:
-                if hasattr(harvester, 'force_import'):
-                    harvester.force_import = True
-                harvester.import_stage(obj)
-                break
+        harvester = registry.get_harvester(obj.source.type)
+        if harvester:
+            if hasattr(harvester, 'force_import'):
+                harvester.force_import = True
+            harvester.import_stage(obj)
         last_objects_count += 1
     log.info('Harvest objects imported: %s', last_objects_count)
     return last_objects_count
@@ -638,6 +654,11 @@ def harvest_jobs_run(context, data_dict):
     This should be called every few minutes (e.g. by a cron), or else jobs
     will never show as finished.
 
+    The jobs to finish are found with a single query for all the sources. The
+    harvest source datasets of the finished jobs are then reindexed and the
+    status notifications sent, as a background job if
+    ``ckan.harvest.finished_jobs_in_background`` is enabled.
+
     This used to also 'run' new jobs created by the web UI, putting them onto
     the gather queue, but now this is done by default when you create a job. If
     you need to send do this explicitly, then use
@@ -659,81 +680,38 @@ def harvest_jobs_run(context, data_dict):
     if not source_id:
         _make_scheduled_jobs(context, data_dict)
 
-    context['return_objects'] = False
-
     # Flag finished jobs as such
-    jobs = harvest_job_list(
-        context, {'source_id': source_id, 'status': u'Running'})
-    if len(jobs):
-        for job in jobs:
-            job_obj = HarvestJob.get(job['id'])
-            if timeout:
-                last_time = job_obj.get_last_action_time()
-                now = datetime.datetime.utcnow()
-                if now - last_time > datetime.timedelta(minutes=int(timeout)):
-                    msg = 'Job {} timeout ({} minutes)\n'.format(job_obj.id, timeout)
-                    msg += '\tJob created: {}\n'.format(job_obj.created)
-                    msg += '\tJob gather finished: {}\n'.format(job_obj.created)
-                    msg += '\tJob last action time: {}\n'.format(last_time)
-
-                    job_obj.status = u'Finished'
-                    job_obj.finished = now
-                    job_obj.save()
-
-                    err = HarvestGatherError(message=msg, job=job_obj)
-                    err.save()
-                    log.info('Marking job as finished due to error: %s %s',
-                             job_obj.source.url, job_obj.id)
-                    continue
-
-            if job['gather_finished']:
-                num_objects_in_progress = \
-                    session.query(HarvestObject.id) \
-                           .filter(HarvestObject.harvest_job_id == job['id']) \
-                           .filter(and_((HarvestObject.state != u'COMPLETE'),
-                                        (HarvestObject.state != u'ERROR'))) \
-                           .count()
-
-                if num_objects_in_progress == 0:
-
-                    job_obj.status = u'Finished'
-                    log.info('Marking job as finished %s %s',
-                             job_obj.source.url, job_obj.id)
-
-                    # save the time of finish, according to the last running
-                    # object
-                    last_object = session.query(HarvestObject) \
-                        .filter(HarvestObject.harvest_job_id == job['id']) \
-                        .filter(
-                        HarvestObject.import_finished != None  # noqa: E711
-                    ).order_by(HarvestObject.import_finished.desc()) \
-                        .first()
-                    if last_object:
-                        job_obj.finished = last_object.import_finished
-                    else:
-                        job_obj.finished = job['gather_finished']
-                    job_obj.save()
-
-                    # Reindex the harvest source dataset so it has the latest
-                    # status
-                    get_action('harvest_source_reindex')(
-                        context, {'id': job_obj.source.id})
-
-                    status = get_action('harvest_source_show_status')(
-                        context, {'id': job_obj.source.id})
-
-                    notify_all = toolkit.asbool(config.get('ckan.harvest.status_mail.all'))
-                    notify_errors = toolkit.asbool(config.get('ckan.harvest.status_mail.errored'))
-                    last_job_errors = status['last_job']['stats'].get('errored', 0)
-                    log.debug('Notifications: All:{} On error:{} Errors:{}'.format(notify_all, notify_errors, last_job_errors))
-
-                    if last_job_errors > 0 and (notify_all or notify_errors):
-                        send_error_email(context, job_obj.source.id, status)
-                    elif notify_all:
-                        send_summary_email(context, job_obj.source.id, status)
-                else:
-                    log.debug('%d Ongoing jobs for %s (source:%s)',
-                              num_objects_in_progress, job['id'], job['source_id'])
+    timed_out, finished = _get_jobs_to_finish(session, source_id, timeout)
+    now = datetime.datetime.utcnow()
+    if timed_out:
+        for job in timed_out:
+            msg = 'Job {} timeout ({} minutes)\n'.format(job.id, timeout)
+            msg += '\tJob created: {}\n'.format(job.created)
+            msg += '\tJob gather finished: {}\n'.format(job.gather_finished)
+            msg += '\tJob last action time: {}\n'.format(job.last_action)
+            session.add(HarvestGatherError(message=msg,
+                                           harvest_job_id=job.id))
+            log.info('Marking job as finished due to error: %s %s',
+                     job.url, job.id)
+        _mark_jobs_finished(session, [(job.id, now) for job in timed_out])
+
+    if finished:
+        for job in finished:
+            log.info('Marking job as finished %s %s', job.url, job.id)
+        # save the time of finish, according to the last running object
+        _mark_jobs_finished(session, [
+            (job.id, job.last_imported or job.gather_finished)
+            for job in finished])
+
+        # Reindex the harvest source datasets and send the notifications
+        source_ids = list(set(job.source_id for job in finished))
+        if toolkit.asbool(config.get(
+                'ckan.harvest.finished_jobs_in_background', False)):
+            toolkit.enqueue_job(_harvest_jobs_finished_tasks, [source_ids],
+                                title='Harvest finished jobs')
+        else:
+            _harvest_jobs_finished_tasks(source_ids, context)
+
     log.debug('No jobs to send to the gather queue')
 
     # Resubmit old redis tasks
@@ -745,6 +723,118 @@ def harvest_jobs_run(context, data_dict):
     return []  # merely for backwards compatibility
 
 
+def _get_jobs_to_finish(session, source_id=None, timeout=None):
+    '''
+    Returns the running jobs that have timed out and the ones that are
+    finished, ie that have finished the gather stage and have no objects
+    waiting or in progress, with a single query for all the jobs.
+
+    Whether a job has objects left is always checked on the harvest objects
+    (with the ``harvest_object_job_id_state_idx`` index), so a job is not
+    finished early if its counters in HarvestJobStats are out of sync. These
+    are used for the times of the last actions, or the harvest objects of
+    the job if it has no stats.
+    '''
+    objects = session.query(HarvestObject.harvest_job_id) \
+        .filter(HarvestObject.harvest_job_id == HarvestJob.id)
+    pending = objects.filter(
+        HarvestObject.state.notin_([u'COMPLETE', u'ERROR'])).exists()
+    last_imported = func.coalesce(
+        HarvestJobStats.last_imported,
+        objects.with_entities(func.max(HarvestObject.import_finished))
+        .as_scalar())
+    # See HarvestJob.get_last_action_time
+    last_action = func.coalesce(
+        HarvestJobStats.last_completed,
+        objects.filter(HarvestObject.state == u'COMPLETE')
+        .with_entities(func.max(HarvestObject.import_finished)).as_scalar(),
+        HarvestJob.gather_finished,
+        HarvestJobStats.last_gathered,
+        objects.with_entities(func.max(HarvestObject.gathered)).as_scalar(),
+        HarvestJob.created)
+
+    q = session.query(
+        HarvestJob.id, HarvestJob.source_id, HarvestJob.created,
+        HarvestJob.gather_finished, HarvestSource.url,
+        pending.label('pending'),
+        last_imported.label('last_imported'),
+        last_action.label('last_action')) \
+        .join(HarvestSource, HarvestSource.id == HarvestJob.source_id) \
+        .outerjoin(HarvestJobStats,
+                   HarvestJobStats.harvest_job_id == HarvestJob.id) \
+        .filter(HarvestJob.status == u'Running')
+    if source_id:
+        q = q.filter(HarvestJob.source_id == source_id)
+
+    timed_out = []
+    finished = []
+    now = datetime.datetime.utcnow()
+    for job in q:
+        if timeout and \
+                now - job.last_action > datetime.timedelta(minutes=int(timeout)):
+            timed_out.append(job)
+        elif job.gather_finished and not job.pending:
+            finished.append(job)
+        else:
+            log.debug('Ongoing job %s (source:%s)', job.id, job.source_id)
+    return timed_out, finished
+
+
+def _mark_jobs_finished(session, jobs):
+    '''
+    Sets the status of the given jobs, a list of (id, finished time), to
+    Finished with a single UPDATE, unless they have been finished already,
+    and notifies the fetch consumers (see `notify_jobs_finished`).
+    '''
+    from ckanext.harvest.model import harvest_job_table
+
+    table = harvest_job_table
+    session.execute(
+        table.update()
+        .where(and_(table.c.id == bindparam('job_id'),
+                    table.c.status == u'Running'))
+        .values(status=u'Finished', finished=bindparam('job_finished')),
+        [{'job_id': job_id, 'job_finished': finished}
+         for job_id, finished in jobs])
+    notify_jobs_finished([job_id for job_id, finished in jobs], session)
+    session.commit()
+
+
+def _harvest_jobs_finished_tasks(source_ids, context=None):
+    '''
+    Reindexes the harvest source datasets of jobs that have just finished, so
+    they have the latest status, and sends the status notifications if
+    enabled.
+
+    It is called by ``harvest_jobs_run``, or run as a background job if
+    ``ckan.harvest.finished_jobs_in_background`` is enabled.
+    '''
+    from ckan import model
+
+    if context is None:
+        site_user = get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {})
+        context = {'model': model, 'session': model.Session,
+                   'user': site_user['name'], 'ignore_auth': True}
+
+    notify_all = toolkit.asbool(config.get('ckan.harvest.status_mail.all'))
+    notify_errors = toolkit.asbool(config.get('ckan.harvest.status_mail.errored'))
+    for source_id in source_ids:
+        get_action('harvest_source_reindex')(context, {'id': source_id})
+
+        if not (notify_all or notify_errors):
+            continue
+        status = get_action('harvest_source_show_status')(
+            context, {'id': source_id})
+        last_job_errors = status['last_job']['stats'].get('errored', 0)
+        log.debug('Notifications: All:{} On error:{} Errors:{}'.format(notify_all, notify_errors, last_job_errors))
+
+        if last_job_errors > 0 and (notify_all or notify_errors):
+            send_error_email(context, source_id, status)
+        elif notify_all:
+            send_summary_email(context, source_id, status)
+
+
 def get_mail_extra_vars(context, source_id, status):
     last_job = status['last_job']
 
@@ -858,6 +948,10 @@ def harvest_send_job_to_gather_queue(context, data_dict):
 
     :param id: the id of the harvest job
     :type id: string
+    :param priority: whether the objects of the job go before the ones of
+        other jobs in the fetch queue, when fair queuing is enabled (default:
+        False)
+    :type priority: bool
     '''
     log.info('Send job to gather queue: %r', data_dict)
 
@@ -878,7 +972,10 @@ def harvest_send_job_to_gather_queue(context, data_dict):
     job_obj = HarvestJob.get(job['id'])
     job_obj.status = job['status'] = u'Running'
     job_obj.save()
-    publisher.send({'harvest_job_id': job['id']})
+    message = {'harvest_job_id': job['id']}
+    if toolkit.asbool(data_dict.get('priority', False)):
+        message['priority'] = True
+    publisher.send(message)
     log.info('Sent job %s to the gather queue', job['id'])
 
     return harvest_job_dictize(job_obj, context)
@@ -890,7 +987,8 @@ def harvest_job_abort(context, data_dict):
     one and (assuming it not already Finished) marks it as Finished. It also
     marks any of that source's harvest objects and (if not complete or error)
     marks them "ERROR", so any left in limbo are cleaned up. Does not actually
-    stop running any queued harvest fetchs/objects.
+    stop running any queued harvest fetchs/objects, but the fetch consumers
+    are notified so they skip the remaining objects of the job straight away.
 
     Specify either id or source_id.
 
@@ -929,6 +1027,7 @@ def harvest_job_abort(context, data_dict):
         # i.e. New or Running
         job_obj = HarvestJob.get(job['id'])
         job_obj.status = new_status = 'Finished'
+        notify_jobs_finished([job['id']])
         model.repo.commit_and_remove()
         log.info('Harvest job changed status from "%s" to "%s"',
                  job['status'], new_status)
@@ -936,19 +1035,18 @@ def harvest_job_abort(context, data_dict):
         log.info('Harvest job unchanged. Source %s status is: "%s"',
                  job['id'], job['status'])
 
-    # HarvestObjects set to ERROR
-    job_obj = HarvestJob.get(job['id'])
-    objs = job_obj.objects
-    for obj in objs:
-        if obj.state not in ('COMPLETE', 'ERROR'):
-            old_state = obj.state
-            obj.state = 'ERROR'
-            log.info('Harvest object changed state from "%s" to "%s": %s',
-                     old_state, obj.state, obj.id)
-        else:
-            log.info('Harvest object not changed from "%s": %s',
-                     obj.state, obj.id)
+    # HarvestObjects set to ERROR, with a single UPDATE instead of loading
+    # all the objects of the job
+    count = model.Session.query(HarvestObject) \
+        .filter(HarvestObject.harvest_job_id == job['id']) \
+        .filter(HarvestObject.state.notin_(['COMPLETE', 'ERROR'])) \
+        .update({'state': 'ERROR'}, synchronize_session=False)
+    log.info('%d harvest objects of job %s changed state to "ERROR"',
+             count, job['id'])
     model.repo.commit_and_remove()
+    # The bulk update is not seen by the job stats listeners
+    if count:
+        rebuild_job_stats(job['id'])
 
     job_obj = HarvestJob.get(job['id'])
     return harvest_job_dictize(job_obj, context)
@@ -3,7 +3,8 @@ from sqlalchemy import func, text
 from ckan.model import Group
 from ckan import logic
 from ckanext.harvest.model import (HarvestJob, HarvestObject,
-                                   HarvestGatherError, HarvestObjectError)
+                                   HarvestGatherError, HarvestObjectError,
+                                   HarvestJobStats)
 
 
 def harvest_source_dictize(source, context, last_job_status=False):
@@ -32,32 +33,11 @@ def harvest_job_dictize(job, context):
     model = context['model']
 
     if context.get('return_stats', True):
-        stats = model.Session.query(
-            HarvestObject.report_status,
-            func.count(HarvestObject.id).label('total_objects'))\
-            .filter_by(harvest_job_id=job.id)\
-            .group_by(HarvestObject.report_status).all()
-        out['stats'] = {'added': 0, 'updated': 0, 'not modified': 0,
-                        'errored': 0, 'deleted': 0}
-        for status, count in stats:
-            out['stats'][status] = count
-
-        # We actually want to check which objects had errors, because they
-        # could have been added/updated anyway (eg bbox errors)
-        count = model.Session.query(
-            func.distinct(HarvestObjectError.harvest_object_id)) \
-            .join(HarvestObject) \
-            .filter(HarvestObject.harvest_job_id == job.id) \
-            .count()
-        if count > 0:
-            out['stats']['errored'] = count
-
-        # Add gather errors to the error count
-        count = model.Session.query(HarvestGatherError) \
-            .filter(HarvestGatherError.harvest_job_id == job.id) \
-            .count()
-        if count > 0:
-            out['stats']['errored'] = out['stats'].get('errored', 0) + count
+        job_stats = HarvestJobStats.get(job.id)
+        if job_stats is not None:
+            out['stats'] = _job_stats_dictize(job_stats)
+        else:
+            out['stats'] = _count_job_stats(job, model)
 
     if context.get('return_error_summary', True):
         q = model.Session.query(
@@ -80,6 +60,57 @@ def harvest_job_dictize(job, context):
     return out
 
 
+def _job_stats_dictize(job_stats):
+    out = {'added': job_stats.added,
+           'updated': job_stats.updated,
+           'not modified': job_stats.unchanged,
+           'errored': job_stats.errored,
+           'deleted': job_stats.deleted}
+    # Objects without a report status yet
+    pending = job_stats.total - sum(out.values())
+    if pending > 0:
+        out[None] = pending
+
+    # We actually want to check which objects had errors, because they
+    # could have been added/updated anyway (eg bbox errors)
+    if job_stats.error_objects > 0:
+        out['errored'] = job_stats.error_objects
+
+    # Add gather errors to the error count
+    out['errored'] += job_stats.gather_errors
+    return out
+
+
+def _count_job_stats(job, model):
+    stats = model.Session.query(
+        HarvestObject.report_status,
+        func.count(HarvestObject.id).label('total_objects'))\
+        .filter_by(harvest_job_id=job.id)\
+        .group_by(HarvestObject.report_status).all()
+    out = {'added': 0, 'updated': 0, 'not modified': 0,
+           'errored': 0, 'deleted': 0}
+    for status, count in stats:
+        out[status] = count
+
+    # We actually want to check which objects had errors, because they
+    # could have been added/updated anyway (eg bbox errors)
+    count = model.Session.query(
+        func.distinct(HarvestObjectError.harvest_object_id)) \
+        .join(HarvestObject) \
+        .filter(HarvestObject.harvest_job_id == job.id) \
+        .count()
+    if count > 0:
+        out['errored'] = count
+
+    # Add gather errors to the error count
+    count = model.Session.query(HarvestGatherError) \
+        .filter(HarvestGatherError.harvest_job_id == job.id) \
+        .count()
+    if count > 0:
+        out['errored'] = out.get('errored', 0) + count
+    return out
+
+
 def harvest_object_dictize(obj, context):
     out = obj.as_dict()
     out['source'] = obj.harvest_source_id
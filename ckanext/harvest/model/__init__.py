@@ -7,9 +7,14 @@ from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import types
 from sqlalchemy import Index
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy.orm import backref, relation
+from sqlalchemy import orm
+from sqlalchemy.orm import backref, deferred, object_session, relation
 from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.sql import text
 
 from ckan import model
 from ckan.model.meta import metadata, mapper, Session
@@ -28,7 +33,10 @@ __all__ = [
     'HarvestObject', 'harvest_object_table',
     'HarvestGatherError', 'harvest_gather_error_table',
     'HarvestObjectError', 'harvest_object_error_table',
-    'HarvestLog', 'harvest_log_table'
+    'HarvestLog', 'harvest_log_table',
+    'HarvestGuidState', 'harvest_guid_state_table',
+    'HarvestJobStats', 'harvest_job_stats_table',
+    'harvest_queue_table'
 ]
 
 
@@ -39,6 +47,35 @@ harvest_gather_error_table = None
 harvest_object_error_table = None
 harvest_object_extra_table = None
 harvest_log_table = None
+harvest_guid_state_table = None
+harvest_queue_table = None
+harvest_job_stats_table = None
+
+# Indexes for the most frequent queries, as (table, name, definition). They
+# are created by setup() on new sites, and with the create-indexes command
+# on existing ones, where CREATE INDEX CONCURRENTLY doesn't lock the tables
+# for writes. Add new ones at the end, with a new name, rather than changing
+# existing ones, so the command creates them when upgrading.
+INDEXES = [
+    # harvest_jobs_run, harvest_job_abort
+    ('harvest_object', 'harvest_object_job_id_state_idx',
+     '(harvest_job_id, state)'),
+    # current objects of a dataset
+    ('harvest_object', 'harvest_object_package_id_current_idx',
+     '(package_id) WHERE current = true'),
+    # _check_for_existing_jobs, last_error_free_job
+    ('harvest_job', 'harvest_job_source_id_status_created_idx',
+     '(source_id, status, created)'),
+    ('harvest_object_error', 'harvest_object_error_harvest_object_id_idx',
+     '(harvest_object_id)'),
+    ('harvest_gather_error', 'harvest_gather_error_harvest_job_id_idx',
+     '(harvest_job_id)'),
+    # harvest_log_list, clean_harvest_log
+    ('harvest_log', 'harvest_log_created_level_idx', '(created, level)'),
+    # current objects of a source, HarvesterBase._get_packages_not_in
+    ('harvest_object', 'harvest_object_source_id_current_idx',
+     '(harvest_source_id) WHERE current = true'),
+]
 
 
 def setup():
@@ -62,8 +99,13 @@ def setup():
         harvest_object_error_table.create()
         harvest_object_extra_table.create()
         harvest_log_table.create()
+        harvest_guid_state_table.create()
+        harvest_queue_table.create()
+        harvest_job_stats_table.create()
 
         log.debug('Harvest tables created')
+        # The tables are empty, so there is no need to build them concurrently
+        create_indexes(concurrently=False)
     else:
         from ckan.model.meta import engine
         log.debug('Harvest tables already exist')
@@ -74,6 +116,10 @@ def setup():
         if 'harvest_log' not in inspector.get_table_names():
             harvest_log_table.create()
 
+        # Check if harvest_queue table exist - needed for the db queue backend
+        if 'harvest_queue' not in inspector.get_table_names():
+            harvest_queue_table.create()
+
         # Check if harvest_object has a index
         index_names = [index['name'] for index in inspector.get_indexes("harvest_object")]
         if "harvest_job_id_idx" not in index_names:
@@ -92,11 +138,101 @@ def setup():
             log.debug('Creating index for guid')
             Index("guid_idx", harvest_object_table.c.guid).create()
 
+        # Check if harvest_object has the content_hash column
+        column_names = [column['name'] for column in inspector.get_columns("harvest_object")]
+        if "content_hash" not in column_names:
+            log.debug('Adding content_hash column to harvest_object')
+            engine.execute('ALTER TABLE harvest_object ADD COLUMN content_hash text')
+
+        # Check if harvest_guid_state table exist, and fill it from the
+        # current harvest objects if not
+        if 'harvest_guid_state' not in inspector.get_table_names():
+            log.debug('Creating harvest_guid_state table')
+            harvest_guid_state_table.create()
+            engine.execute('''
+                INSERT INTO harvest_guid_state (harvest_source_id, guid,
+                    harvest_object_id, package_id, metadata_modified_date,
+                    content_hash)
+                SELECT DISTINCT ON (harvest_source_id, guid)
+                    harvest_source_id, guid, id, package_id,
+                    metadata_modified_date, content_hash
+                FROM harvest_object
+                WHERE current = true
+                    AND harvest_source_id IS NOT NULL
+                    AND guid IS NOT NULL AND guid != ''
+                ORDER BY harvest_source_id, guid, import_finished DESC NULLS LAST
+            ''')
+
+        # Check if harvest_job_stats table exist, and fill it from the
+        # existing harvest objects if not
+        if 'harvest_job_stats' not in inspector.get_table_names():
+            log.debug('Creating harvest_job_stats table')
+            harvest_job_stats_table.create()
+            rebuild_job_stats()
+
         index_names = [index['name'] for index in inspector.get_indexes("harvest_object_extra")]
         if "harvest_object_id_idx" not in index_names:
             log.debug('Creating index for harvest_object_extra')
             Index("harvest_object_id_idx", harvest_object_extra_table.c.harvest_object_id).create()
 
+        # Building the indexes may take a while on large tables, so it is
+        # left to the create-indexes command
+        missing_indexes = get_missing_indexes()
+        if missing_indexes:
+            log.warning('Missing harvest indexes: %s. Create them with the '
+                        '"harvester create-indexes" command',
+                        ', '.join(missing_indexes))
+
+
+def _get_indexes(connection):
+    '''Returns whether each of the `INDEXES` that exist is valid.'''
+    return dict(connection.execute(text('''
+        SELECT c.relname, i.indisvalid
+        FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = ANY(:names)
+        '''), names=[name for table, name, definition in INDEXES]).fetchall())
+
+
+def get_missing_indexes():
+    '''
+    Returns the names of the `INDEXES` that don't exist yet or were left
+    invalid by a concurrent build that failed.
+    '''
+    from ckan.model.meta import engine
+
+    valid = _get_indexes(engine)
+    return [name for table, name, definition in INDEXES
+            if not valid.get(name)]
+
+
+def create_indexes(concurrently=True):
+    '''
+    Creates the `INDEXES` that don't exist yet, and builds again the ones
+    left invalid by a previous concurrent build that failed. Errors are
+    raised, the invalid index left behind is built again on the next run.
+
+    On existing sites it is run with the ``harvester create-indexes``
+    command. The indexes are built ``concurrently``, so the tables are not
+    locked for writes meanwhile.
+    '''
+    from ckan.model.meta import engine
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        valid = _get_indexes(connection)
+        for table, name, definition in INDEXES:
+            if valid.get(name):
+                continue
+            if name in valid:
+                log.info('Dropping invalid index %s', name)
+                connection.execute(
+                    'DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(name))
+            log.info('Creating index %s on %s', name, table)
+            connection.execute('CREATE INDEX {0}{1} ON {2} {3}'.format(
+                'CONCURRENTLY ' if concurrently else '', name, table,
+                definition))
+
 
 class HarvestError(Exception):
     pass
@@ -190,6 +326,11 @@ class HarvestJob(HarvestDomainObject):
         return query
 
     def get_last_action_time(self):
+        stats = HarvestJobStats.get(self.id)
+        if stats is not None:
+            return (stats.last_completed or self.gather_finished or
+                    stats.last_gathered or self.created)
+
         last_object = self.get_last_finished_object()
         if last_object is not None:
             return last_object.import_finished
@@ -218,6 +359,22 @@ class HarvestObject(HarvestDomainObject):
 
     '''
 
+    @classmethod
+    def get_current_for_package(cls, package_id):
+        '''
+        Returns the current harvest object of a dataset, or None.
+
+        It is looked up in the harvest_guid_state table, or in the harvest
+        objects if it is not there, as objects without a guid have no guid
+        state.
+        '''
+        guid_state = HarvestGuidState.get_for_package(package_id)
+        if guid_state:
+            return cls.get(guid_state.harvest_object_id)
+        return Session.query(cls) \
+            .filter(cls.package_id == package_id) \
+            .filter(cls.current == True).first()  # noqa: E712
+
 
 class HarvestObjectExtra(HarvestDomainObject):
     '''Extra key value data for Harvest objects'''
@@ -280,6 +437,54 @@ class HarvestLog(HarvestDomainObject):
     pass
 
 
+class HarvestJobStats(HarvestDomainObject):
+    '''Counters of the harvest objects of a job by state and report status,
+       and of its errors, so the progress of a job can be shown without
+       counting its objects.
+
+       They are kept up to date by listeners when harvest objects and
+       errors are created, updated or deleted through the ORM, with one
+       upsert per job and flush. Objects inserted with plain SQL are
+       counted with `add_objects_job_stats`, use `rebuild_job_stats` after
+       other changes made with plain SQL.
+    '''
+    key_attr = 'harvest_job_id'
+
+
+class HarvestGuidState(HarvestDomainObject):
+    '''The current state of each guid of a harvest source: which harvest
+       object is the current one, the dataset it was imported to and the
+       remote modification date and content hash it had.
+
+       Rows are kept up to date automatically when harvest objects are
+       flagged as current (or stop being so), so they can be used instead
+       of looking for the current object in the ``harvest_object`` table.
+    '''
+    key_attr = 'harvest_object_id'
+
+    @classmethod
+    def get_for_guid(cls, source_id, guid):
+        return cls.filter(harvest_source_id=source_id, guid=guid).first()
+
+    @classmethod
+    def get_for_package(cls, package_id):
+        return cls.filter(package_id=package_id).first()
+
+    @classmethod
+    def for_source(cls, source_id):
+        return cls.filter(harvest_source_id=source_id)
+
+    @classmethod
+    def not_in_guids(cls, source_id, guids):
+        '''
+        Returns a query for the guids of the source that are not in the
+        ``guids`` given, ie the ones no longer available on the remote
+        source.
+        '''
+        return cls.for_source(source_id) \
+            .filter(~cls.guid.in_(list(guids)))
+
+
 def harvest_object_before_insert_listener(mapper, connection, target):
     '''
         For compatibility with old harvesters, check if the source id has
@@ -292,6 +497,287 @@ def harvest_object_before_insert_listener(mapper, connection, target):
         target.harvest_source_id = target.job.source.id
 
 
+_guid_state_attrs = ('current', 'guid', 'package_id', 'content_hash',
+                     'metadata_modified_date')
+
+
+def _save_guid_state(connection, target):
+    if not target.guid or not target.harvest_source_id:
+        return
+    table = harvest_guid_state_table
+    values = {
+        'harvest_object_id': target.id,
+        'package_id': target.package_id,
+        'metadata_modified_date': target.metadata_modified_date,
+        'content_hash': target.content_hash,
+    }
+    stmt = insert(table).values(harvest_source_id=target.harvest_source_id,
+                                guid=target.guid, **values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.harvest_source_id, table.c.guid],
+        set_=dict((key, stmt.excluded[key]) for key in values))
+    connection.execute(stmt)
+
+
+def harvest_object_after_insert_listener(mapper, connection, target):
+    '''
+        Record new objects flagged as current in the harvest_guid_state table.
+    '''
+    if target.current:
+        _save_guid_state(connection, target)
+
+
+def harvest_object_after_update_listener(mapper, connection, target):
+    '''
+        Keep the harvest_guid_state row of the object guid up to date when
+        the object becomes the current one, or stops being it.
+    '''
+    state = inspect(target)
+    if target.current:
+        if any(state.attrs[attr].history.has_changes()
+               for attr in _guid_state_attrs):
+            _save_guid_state(connection, target)
+    elif state.attrs.current.history.has_changes():
+        table = harvest_guid_state_table
+        connection.execute(
+            table.delete().where(table.c.harvest_object_id == target.id))
+
+
+# Key of the job stats changes pending in the info of a session
+_JOB_STATS_INFO_KEY = 'harvest_job_stats'
+_job_stats_counters = ('total', 'waiting', 'in_progress', 'added',
+                       'updated', 'unchanged', 'deleted', 'errored')
+_job_stats_report_counters = {
+    'added': 'added',
+    'updated': 'updated',
+    'not modified': 'unchanged',
+    'deleted': 'deleted',
+    'errored': 'errored',
+}
+
+
+def _job_stats_counts(state, report_status):
+    '''Returns the job counters a harvest object with the given state and
+    report status adds to.'''
+    counts = ['total']
+    if state == 'WAITING':
+        counts.append('waiting')
+    elif state not in (None, 'COMPLETE', 'ERROR'):
+        counts.append('in_progress')
+    if report_status in _job_stats_report_counters:
+        counts.append(_job_stats_report_counters[report_status])
+    return counts
+
+
+def _update_job_stats(connection, job_id, counts=None, dates=None):
+    '''Adds ``counts`` to the counters of a job, and sets its ``dates``
+    if they are later than the current ones.'''
+    counts = dict((key, value) for key, value in (counts or {}).items()
+                  if value)
+    dates = dict((key, value) for key, value in (dates or {}).items()
+                 if value)
+    if not job_id or not (counts or dates):
+        return
+    table = harvest_job_stats_table
+    stmt = insert(table).values(harvest_job_id=job_id,
+                                **dict(counts, **dates))
+    set_ = {}
+    for key in counts:
+        set_[key] = table.c[key] + stmt.excluded[key]
+    for key in dates:
+        set_[key] = func.greatest(table.c[key], stmt.excluded[key])
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.harvest_job_id], set_=set_))
+
+
+def _add_job_stats(pending, job_id, counts=None, dates=None):
+    '''Adds ``counts`` and ``dates`` to the ``pending`` changes of the job
+    stats, a dict of ``(counts, dates)`` by job id.'''
+    if not job_id:
+        return
+    job_counts, job_dates = pending.setdefault(job_id, ({}, {}))
+    for key, value in (counts or {}).items():
+        job_counts[key] = job_counts.get(key, 0) + value
+    for key, value in (dates or {}).items():
+        if value and (job_dates.get(key) is None or value > job_dates[key]):
+            job_dates[key] = value
+
+
+def _flush_job_stats(connection, pending):
+    # In the same order in all the processes, so concurrent writers of
+    # several jobs don't deadlock
+    for job_id in sorted(pending):
+        counts, dates = pending[job_id]
+        _update_job_stats(connection, job_id, counts, dates)
+
+
+def _session_job_stats(target):
+    '''Returns the changes of the job stats pending for the flush of the
+    session of ``target``, see `harvest_job_stats_after_flush_listener`.'''
+    return object_session(target).info.setdefault(_JOB_STATS_INFO_KEY, {})
+
+
+def harvest_job_stats_before_flush_listener(session, flush_context, instances):
+    # Changes left by a flush that failed were rolled back
+    session.info.pop(_JOB_STATS_INFO_KEY, None)
+
+
+def harvest_job_stats_after_flush_listener(session, flush_context):
+    '''
+    Applies the changes of the job stats of the objects flushed, with one
+    upsert per job rather than one per object.
+    '''
+    pending = session.info.pop(_JOB_STATS_INFO_KEY, None)
+    if pending:
+        _flush_job_stats(session.connection(), pending)
+
+
+def _attr_change(state, attr):
+    '''Returns the old and new values of an attribute of an instance.'''
+    history = state.attrs[attr].history
+    new = getattr(state.obj(), attr)
+    old = history.deleted[0] if history.deleted else new
+    return old, new
+
+
+def harvest_job_after_insert_listener(mapper, connection, target):
+    connection.execute(insert(harvest_job_stats_table)
+                       .values(harvest_job_id=target.id)
+                       .on_conflict_do_nothing())
+
+
+def harvest_object_stats_after_insert_listener(mapper, connection, target):
+    counts = dict((key, 1) for key in
+                  _job_stats_counts(target.state, target.report_status))
+    _add_job_stats(_session_job_stats(target), target.harvest_job_id, counts,
+                   {'last_gathered': target.gathered})
+
+
+def harvest_object_stats_after_update_listener(mapper, connection, target):
+    state = inspect(target)
+    old_state, new_state = _attr_change(state, 'state')
+    old_report, new_report = _attr_change(state, 'report_status')
+    counts = dict((key, 0) for key in _job_stats_counters)
+    for key in _job_stats_counts(old_state, old_report):
+        counts[key] -= 1
+    for key in _job_stats_counts(new_state, new_report):
+        counts[key] += 1
+
+    dates = {}
+    old_finished, import_finished = _attr_change(state, 'import_finished')
+    if import_finished and old_finished != import_finished:
+        dates['last_imported'] = import_finished
+    if new_state == 'COMPLETE' and import_finished and \
+            (old_state != new_state or old_finished != import_finished):
+        dates['last_completed'] = import_finished
+    _add_job_stats(_session_job_stats(target), target.harvest_job_id, counts,
+                   dates)
+
+
+def harvest_object_stats_after_delete_listener(mapper, connection, target):
+    counts = dict((key, -1) for key in
+                  _job_stats_counts(target.state, target.report_status))
+    _add_job_stats(_session_job_stats(target), target.harvest_job_id, counts)
+
+
+def add_objects_job_stats(connection, objects):
+    '''
+    Counts in the job stats harvest objects inserted without the ORM, eg
+    with a multi-row INSERT, which the listeners above don't see. The
+    objects are dicts with the columns inserted.
+    '''
+    pending = {}
+    for obj in objects:
+        counts = dict((key, 1) for key in
+                      _job_stats_counts(obj.get('state'),
+                                        obj.get('report_status')))
+        _add_job_stats(pending, obj['harvest_job_id'], counts,
+                       {'last_gathered': obj.get('gathered')})
+    _flush_job_stats(connection, pending)
+
+
+def harvest_gather_error_after_insert_listener(mapper, connection, target):
+    _add_job_stats(_session_job_stats(target), target.harvest_job_id,
+                   {'gather_errors': 1})
+
+
+def harvest_object_error_after_insert_listener(mapper, connection, target):
+    # Only the first error of each object is counted, also when several are
+    # inserted in the same flush
+    connection.execute(text('''
+        UPDATE harvest_job_stats SET error_objects = error_objects + 1
+        WHERE harvest_job_id = (SELECT harvest_job_id FROM harvest_object
+                                WHERE id = :object_id)
+            AND NOT EXISTS (
+                SELECT 1 FROM harvest_object_error
+                WHERE harvest_object_id = :object_id AND id != :id
+                    AND (created < :created OR
+                         (created = :created AND id < :id)))
+        '''), object_id=target.harvest_object_id, id=target.id,
+        created=target.created)
+
+
+def rebuild_job_stats(job_id=None, source_id=None):
+    '''
+    Works out again the counters in ``harvest_job_stats`` from the harvest
+    objects and errors, of all the jobs or only the given one, or the ones
+    of the given source.
+
+    Anything changing harvest objects or errors with plain SQL must call
+    it afterwards, as the listeners that keep the counters don't see it.
+    '''
+    from ckan.model.meta import engine
+
+    where = ''
+    if job_id:
+        where = 'WHERE j.id = :job_id'
+    elif source_id:
+        where = 'WHERE j.source_id = :source_id'
+    engine.execute(text('''
+        INSERT INTO harvest_job_stats (harvest_job_id, total, waiting,
+            in_progress, added, updated, unchanged, deleted, errored,
+            error_objects, gather_errors, last_gathered, last_imported,
+            last_completed)
+        SELECT j.id,
+            count(o.id),
+            count(CASE WHEN o.state = 'WAITING' THEN 1 END),
+            count(CASE WHEN o.state NOT IN ('WAITING', 'COMPLETE', 'ERROR')
+                  THEN 1 END),
+            count(CASE WHEN o.report_status = 'added' THEN 1 END),
+            count(CASE WHEN o.report_status = 'updated' THEN 1 END),
+            count(CASE WHEN o.report_status = 'not modified' THEN 1 END),
+            count(CASE WHEN o.report_status = 'deleted' THEN 1 END),
+            count(CASE WHEN o.report_status = 'errored' THEN 1 END),
+            (SELECT count(DISTINCT e.harvest_object_id)
+             FROM harvest_object_error e
+             JOIN harvest_object eo ON eo.id = e.harvest_object_id
+             WHERE eo.harvest_job_id = j.id),
+            (SELECT count(*) FROM harvest_gather_error g
+             WHERE g.harvest_job_id = j.id),
+            max(o.gathered),
+            max(o.import_finished),
+            max(CASE WHEN o.state = 'COMPLETE' THEN o.import_finished END)
+        FROM harvest_job j
+        LEFT JOIN harvest_object o ON o.harvest_job_id = j.id
+        {0}
+        GROUP BY j.id
+        ON CONFLICT (harvest_job_id) DO UPDATE SET
+            total = excluded.total,
+            waiting = excluded.waiting,
+            in_progress = excluded.in_progress,
+            added = excluded.added,
+            updated = excluded.updated,
+            unchanged = excluded.unchanged,
+            deleted = excluded.deleted,
+            errored = excluded.errored,
+            error_objects = excluded.error_objects,
+            gather_errors = excluded.gather_errors,
+            last_gathered = excluded.last_gathered,
+            last_imported = excluded.last_imported,
+            last_completed = excluded.last_completed
+        '''.format(where)), job_id=job_id, source_id=source_id)
+
+
 def define_harvester_tables():
 
     global harvest_source_table
@@ -301,6 +787,9 @@ def define_harvester_tables():
     global harvest_gather_error_table
     global harvest_object_error_table
     global harvest_log_table
+    global harvest_guid_state_table
+    global harvest_queue_table
+    global harvest_job_stats_table
 
     harvest_source_table = Table(
         'harvest_source',
@@ -363,6 +852,9 @@ def define_harvester_tables():
                nullable=True),
         # report_status: 'added', 'updated', 'not modified', 'deleted', 'errored'
         Column('report_status', types.UnicodeText, nullable=True),
+        # Fingerprint of the harvested content, used to skip the import of
+        # datasets that have not changed since they were last imported
+        Column('content_hash', types.UnicodeText, nullable=True),
         Index('harvest_job_id_idx', 'harvest_job_id'),
         Index('harvest_source_id_idx', 'harvest_source_id'),
         Index('package_id_idx', 'package_id'),
@@ -411,6 +903,67 @@ def define_harvester_tables():
         Column('level', types.Enum('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL', name='log_level')),
         Column('created', types.DateTime, default=datetime.datetime.utcnow),
     )
+    # Current harvest object of each guid of a source, maintained by
+    # the HarvestObject after insert/update listeners
+    harvest_guid_state_table = Table(
+        'harvest_guid_state',
+        metadata,
+        Column('harvest_source_id', types.UnicodeText,
+               ForeignKey('harvest_source.id', ondelete='CASCADE'),
+               primary_key=True),
+        Column('guid', types.UnicodeText, primary_key=True),
+        Column('harvest_object_id', types.UnicodeText,
+               ForeignKey('harvest_object.id', ondelete='CASCADE'),
+               nullable=False),
+        Column('package_id', types.UnicodeText, nullable=True),
+        Column('metadata_modified_date', types.DateTime),
+        Column('content_hash', types.UnicodeText, nullable=True),
+        Index('harvest_guid_state_guid_idx', 'guid'),
+        Index('harvest_guid_state_object_id_idx', 'harvest_object_id'),
+        Index('harvest_guid_state_package_id_idx', 'package_id'),
+    )
+    # Messages of the gather and fetch queues when using the db backend
+    harvest_queue_table = Table(
+        'harvest_queue',
+        metadata,
+        Column('id', types.Integer, primary_key=True),
+        Column('routing_key', types.UnicodeText, nullable=False),
+        # The harvest job or object id the message is about
+        Column('message_id', types.UnicodeText),
+        Column('body', types.UnicodeText, nullable=False),
+        Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        # Set while a consumer is processing the message. If it is not
+        # acknowledged before, the message is delivered again.
+        Column('lease_expires', types.DateTime),
+        Index('harvest_queue_routing_key_id_idx', 'routing_key', 'id'),
+        Index('harvest_queue_message_id_idx', 'routing_key', 'message_id'),
+    )
+
+    # Progress counters of each job, maintained by the listeners of the
+    # harvest objects and errors, see HarvestJobStats
+    harvest_job_stats_table = Table(
+        'harvest_job_stats',
+        metadata,
+        Column('harvest_job_id', types.UnicodeText,
+               ForeignKey('harvest_job.id', ondelete='CASCADE'),
+               primary_key=True),
+        Column('total', types.Integer, nullable=False, default=0),
+        Column('waiting', types.Integer, nullable=False, default=0),
+        # FETCH or IMPORT
+        Column('in_progress', types.Integer, nullable=False, default=0),
+        # by report_status
+        Column('added', types.Integer, nullable=False, default=0),
+        Column('updated', types.Integer, nullable=False, default=0),
+        Column('unchanged', types.Integer, nullable=False, default=0),
+        Column('deleted', types.Integer, nullable=False, default=0),
+        Column('errored', types.Integer, nullable=False, default=0),
+        # objects with at least one error, and gather errors
+        Column('error_objects', types.Integer, nullable=False, default=0),
+        Column('gather_errors', types.Integer, nullable=False, default=0),
+        Column('last_gathered', types.DateTime),
+        Column('last_imported', types.DateTime),
+        Column('last_completed', types.DateTime),
+    )
 
     mapper(
         HarvestSource,
@@ -449,7 +1002,9 @@ def define_harvester_tables():
                 lazy=True,
                 backref=u'objects',
             ),
-
+            # The content can be large, so it is only loaded when accessed
+            'content': deferred(harvest_object_table.c.content,
+                                group='content'),
         },
     )
 
@@ -491,7 +1046,34 @@ def define_harvester_tables():
         harvest_log_table,
     )
 
+    mapper(
+        HarvestGuidState,
+        harvest_guid_state_table,
+        properties={
+            'source': relation(
+                HarvestSource,
+                lazy=True,
+            ),
+        },
+    )
+
     event.listen(HarvestObject, 'before_insert', harvest_object_before_insert_listener)
+    event.listen(HarvestObject, 'after_insert', harvest_object_after_insert_listener)
+    event.listen(HarvestObject, 'after_update', harvest_object_after_update_listener)
+
+    mapper(
+        HarvestJobStats,
+        harvest_job_stats_table,
+    )
+
+    event.listen(HarvestJob, 'after_insert', harvest_job_after_insert_listener)
+    event.listen(HarvestObject, 'after_insert', harvest_object_stats_after_insert_listener)
+    event.listen(HarvestObject, 'after_update', harvest_object_stats_after_update_listener)
+    event.listen(HarvestObject, 'after_delete', harvest_object_stats_after_delete_listener)
+    event.listen(HarvestGatherError, 'after_insert', harvest_gather_error_after_insert_listener)
+    event.listen(HarvestObjectError, 'after_insert', harvest_object_error_after_insert_listener)
+    event.listen(orm.Session, 'before_flush', harvest_job_stats_before_flush_listener)
+    event.listen(orm.Session, 'after_flush', harvest_job_stats_after_flush_listener)
 
 
 class PackageIdHarvestSourceIdMismatch(Exception):
@@ -9,7 +9,6 @@ from six import string_types
 from collections import OrderedDict
 
 from ckan import logic
-from ckan import model
 import ckan.plugins as p
 from ckan.lib.plugins import DefaultDatasetForm
 
@@ -23,6 +22,7 @@ import ckanext.harvest
 from ckanext.harvest.model import setup as model_setup
 from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
 from ckanext.harvest.log import DBLogHandler
+from ckanext.harvest import registry
 
 from ckanext.harvest.utils import (
     DATASET_TYPE_NAME
@@ -47,11 +47,21 @@ class Harvest(MixinPlugin, p.SingletonPlugin, DefaultDatasetForm, DefaultTransla
     p.implements(p.IPackageController, inherit=True)
     p.implements(p.ITemplateHelpers)
     p.implements(p.IFacets, inherit=True)
+    p.implements(p.IPluginObserver, inherit=True)
     if p.toolkit.check_ckan_version(min_version='2.5.0'):
         p.implements(p.ITranslation, inherit=True)
 
     startup = False
 
+    # IPluginObserver
+
+    def after_load(self, service):
+        # Harvesters may have been added, look them up again
+        registry.reset()
+
+    def after_unload(self, service):
+        registry.reset()
+
     # ITranslation
     def i18n_directory(self):
         u'''Change the directory of the .mo translation files'''
@@ -118,9 +128,7 @@ class Harvest(MixinPlugin, p.SingletonPlugin, DefaultDatasetForm, DefaultTransla
 
     def before_dataset_index(self, pkg_dict):
 
-        harvest_object = model.Session.query(HarvestObject) \
-            .filter(HarvestObject.package_id == pkg_dict["id"]) \
-            .filter(HarvestObject.current == True).first() # noqa
+        harvest_object = HarvestObject.get_current_for_package(pkg_dict["id"])
 
         if harvest_object:
 
@@ -130,7 +138,7 @@ class Harvest(MixinPlugin, p.SingletonPlugin, DefaultDatasetForm, DefaultTransla
 
             harvest_extras = [
                 ("harvest_object_id", harvest_object.id),
-                ("harvest_source_id", harvest_object.source.id),
+                ("harvest_source_id", harvest_object.harvest_source_id),
                 ("harvest_source_title", harvest_object.source.title),
             ]
 
@@ -268,6 +276,8 @@ class Harvest(MixinPlugin, p.SingletonPlugin, DefaultDatasetForm, DefaultTransla
         # Configure database logger
         _configure_db_logger(config)
 
+        registry.reset()
+
         self.startup = False
 
     def update_config(self, config):
@@ -1,18 +1,33 @@
+import contextlib
 import logging
 import datetime
+import itertools
 import json
+import os
+import select
+import socket
+import threading
+import time
+import types
+import uuid
+import zlib
 
 
 import redis
 import pika
 import sqlalchemy
+from six.moves.urllib.parse import urlparse
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import text
 
 from ckan.lib.base import config
-from ckan.plugins import PluginImplementations
+from ckan.plugins import toolkit
 from ckan import model
 
-from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError
-from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.model import (HarvestJob, HarvestObject,
+                                   HarvestGatherError, HarvestGuidState)
+from ckanext.harvest import registry
+from ckanext.harvest.cache import LRUCache
 
 log = logging.getLogger(__name__)
 assert not log.disabled
@@ -34,13 +49,74 @@ REDIS_DB = 0
 EXCHANGE_TYPE = 'direct'
 EXCHANGE_NAME = 'ckan.harvest'
 
+# Number of messages sent to the queue in a single round trip by send_many
+SEND_BATCH_SIZE = 1000
+
+# Redis clients are reused, as each one keeps its own pool of connections
+_redis_connections = {}
+
+# settings for the Redis reliable queue mode: seconds a consumer has to
+# acknowledge a message before it is sent to the queue again
+GATHER_LEASE_TIME = 7200
+FETCH_LEASE_TIME = 180
+# seconds to wait before polling an empty queue again (Redis reliable
+# mode and db backend)
+POLL_INTERVAL = 1
+
+# settings for resubmit_objects: queued messages indexed and waiting objects
+# checked at a time, and seconds the temporary index is kept if the process
+# dies before removing it
+RESUBMIT_BATCH_SIZE = 10000
+RESUBMIT_SET_EXPIRES = 3600
+
+# settings for Redis Streams
+STREAM_GROUP_NAME = 'ckanext-harvest'
+# messages read by a consumer at a time
+STREAM_READ_COUNT = 10
+# milliseconds a consumer waits for new messages before checking again
+# for messages left pending by crashed consumers
+STREAM_BLOCK_TIME = 5000
+
+# settings for the db backend: fetch messages claimed by a consumer at a
+# time (gather messages are always claimed one by one)
+DB_CLAIM_COUNT = 10
+
+# settings for fair queuing (ckan.harvest.mq.fair): seconds the AMQP fair
+# consumer caches the list of sources with running jobs, and hours an unused
+# per-source AMQP queue is kept
+FAIR_SOURCES_REFRESH_TIME = 10
+FAIR_QUEUE_EXPIRES = 24
+
+# Status of the jobs of the fetched objects, see get_job_status. Jobs
+# finished or aborted are marked as finished straight away by a thread
+# listening to JOB_FINISHED_CHANNEL, which also calls the functions
+# registered with on_job_finished
+JOB_STATUS_CACHE_TTL = 10
+JOB_FINISHED_CHANNEL = 'harvest_job_finished'
+_job_status_cache = LRUCache(maxsize=1000, ttl=JOB_STATUS_CACHE_TTL)
+_job_finished_callbacks = []
+_job_finished_listener_pid = None
+_job_finished_listener_lock = threading.Lock()
+
+# settings for ckan.harvest.gather.max_per_host: first key of the
+# PostgreSQL advisory locks of the gathers running for each remote host (see
+# _gather_host_slot), and maximum seconds to wait before sending back to the
+# queue a job of a host with too many gathers running
+GATHER_HOST_LOCK_NAMESPACE = 0x68727374
+GATHER_HOST_BACKOFF_MAX = 60
+# Jobs waiting to be sent back to the gather queue, see _send_back_gather_job
+_gather_retry_timers = {}
+_gather_retry_lock = threading.Lock()
+
 
 def get_connection():
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
     if backend in ('amqp', 'ampq'):  # "ampq" is for compat with old typo
         return get_connection_amqp()
-    if backend == 'redis':
+    if backend in ('redis', 'redis-streams'):
         return get_connection_redis()
+    if backend == 'db':
+        return model.Session
     raise Exception('not a valid queue type %s' % backend)
 
 
@@ -67,19 +143,122 @@ def get_connection_amqp():
 
 def get_connection_redis():
     if not config.get('ckan.harvest.mq.hostname') and config.get('ckan.redis.url'):
-        return redis.Redis.from_url(
-            config['ckan.redis.url'],
-            decode_responses=True,
-        )
+        key = (config['ckan.redis.url'],)
     else:
-        return redis.Redis(
-            host=config.get('ckan.harvest.mq.hostname', HOSTNAME),
-            port=int(config.get('ckan.harvest.mq.port', REDIS_PORT)),
-            password=config.get('ckan.harvest.mq.password', None),
-            db=int(config.get('ckan.harvest.mq.redis_db', REDIS_DB)),
-            decode_responses=True,
+        key = (
+            config.get('ckan.harvest.mq.hostname', HOSTNAME),
+            int(config.get('ckan.harvest.mq.port', REDIS_PORT)),
+            config.get('ckan.harvest.mq.password', None),
+            int(config.get('ckan.harvest.mq.redis_db', REDIS_DB)),
         )
 
+    connection = _redis_connections.get(key)
+    if connection is None:
+        if len(key) == 1:
+            connection = redis.Redis.from_url(
+                key[0],
+                decode_responses=True,
+            )
+        else:
+            host, port, password, db = key
+            connection = redis.Redis(
+                host=host,
+                port=port,
+                password=password,
+                db=db,
+                decode_responses=True,
+            )
+        _redis_connections[key] = connection
+    return connection
+
+
+def is_reliable_queue():
+    '''
+    Whether the Redis queues use leases to make sure that the messages of
+    consumers that die before acknowledging them are processed again (the
+    ``ckan.harvest.mq.reliable`` option).
+    '''
+    return (config.get('ckan.harvest.mq.type', MQ_TYPE) == 'redis' and
+            toolkit.asbool(config.get('ckan.harvest.mq.reliable', False)))
+
+
+def is_fair_queue():
+    '''
+    Whether the fetch queue is split into one queue per source, consumed in
+    weighted round-robin, with the objects of manually triggered jobs
+    taking priority (the ``ckan.harvest.mq.fair`` option). Only supported
+    by the ``redis`` and ``amqp`` backends.
+    '''
+    return (config.get('ckan.harvest.mq.type', MQ_TYPE) in
+            ('redis', 'amqp', 'ampq') and
+            toolkit.asbool(config.get('ckan.harvest.mq.fair', False)))
+
+
+def get_lease_key(routing_key):
+    '''
+    Returns the key of the sorted set holding the messages of a queue that
+    are being processed, scored by the time their lease expires, eg
+    ``ckanext-harvest:default:leases:harvest_object_id``.
+    '''
+    prefix, message_key = routing_key.rsplit(':', 1)
+    return '{0}:leases:{1}'.format(prefix, message_key)
+
+
+def get_lease_body(member):
+    '''
+    Returns the message body of a member of the leases sorted set (see
+    `get_lease_key`). Members are prefixed with a unique delivery token, so
+    duplicate messages get a lease each.
+    '''
+    return member.split('|', 1)[1]
+
+
+def get_stream_key(routing_key):
+    '''
+    Returns the key of the stream used for a queue by the ``redis-streams``
+    backend, eg ``ckanext-harvest:default:stream:harvest_object_id``.
+    '''
+    prefix, message_key = routing_key.rsplit(':', 1)
+    return '{0}:stream:{1}'.format(prefix, message_key)
+
+
+def get_fair_key(routing_key, suffix=None):
+    '''
+    Returns the keys used by the Redis fair queues, eg
+    ``ckanext-harvest:default:fair:harvest_object_id`` for the list of
+    sources waiting their turn, or
+    ``ckanext-harvest:default:fair:harvest_object_id:priority`` for the
+    messages of manually triggered jobs.
+    '''
+    prefix, message_key = routing_key.rsplit(':', 1)
+    key = '{0}:fair:{1}'.format(prefix, message_key)
+    if suffix:
+        key += ':' + suffix
+    return key
+
+
+def get_fetch_weight(source):
+    '''
+    Returns how many messages of the given source are consumed in a row
+    from the fair fetch queue before moving on to the next source (the
+    ``fetch_weight`` option of the source configuration, default 1).
+    '''
+    try:
+        weight = int(json.loads(source.config or '{}').get('fetch_weight', 1))
+    except (ValueError, TypeError, AttributeError):
+        weight = 1
+    return max(weight, 1)
+
+
+def get_resubmit_key(routing_key):
+    '''
+    Returns the key of the temporary set holding the ids of the queued
+    messages while running `resubmit_objects`, eg
+    ``ckanext-harvest:default:resubmit:harvest_object_id``.
+    '''
+    prefix, message_key = routing_key.rsplit(':', 1)
+    return '{0}:resubmit:{1}'.format(prefix, message_key)
+
 
 def get_gather_queue_name():
     return 'ckan.harvest.{0}.gather'.format(config.get('ckan.site_id',
@@ -110,11 +289,25 @@ def purge_queues():
         log.info('AMQP queue purged: %s', get_gather_queue_name())
         channel.queue_purge(queue=get_fetch_queue_name())
         log.info('AMQP queue purged: %s', get_fetch_queue_name())
-    elif backend == 'redis':
+        if is_fair_queue():
+            # Deleting a queue that doesn't exist is not an error
+            from ckanext.harvest.model import HarvestSource
+            suffixes = ['priority'] + [
+                id for id, in model.Session.query(HarvestSource.id)]
+            for suffix in suffixes:
+                channel.queue_delete(
+                    queue='{0}.{1}'.format(get_fetch_queue_name(), suffix))
+            log.info('AMQP fair queues deleted')
+    elif backend in ('redis', 'redis-streams'):
         get_gather_consumer().queue_purge()
         log.info('Redis gather queue purged')
         get_fetch_consumer().queue_purge()
         log.info('Redis fetch queue purged')
+    elif backend == 'db':
+        get_gather_consumer().queue_purge()
+        log.info('Database gather queue purged')
+        get_fetch_consumer().queue_purge()
+        log.info('Database fetch queue purged')
 
 
 def resubmit_jobs():
@@ -123,10 +316,27 @@ def resubmit_jobs():
     These are removed from the queues and placed back on them afresh, to ensure
     the fetch & gather consumers are triggered to process it.
     '''
-    if config.get('ckan.harvest.mq.type') != 'redis':
+    backend = config.get('ckan.harvest.mq.type')
+    if backend == 'redis-streams':
+        redis = get_connection()
+        for routing_key in (get_fetch_routing_key(), get_gather_routing_key()):
+            count = requeue_expired_stream_messages(redis, routing_key)
+            if count:
+                log.debug('Re-sent {0} messages pending for too long to {1}'
+                          .format(count, routing_key))
+        return
+    if backend != 'redis':
         return
     redis = get_connection()
 
+    if is_reliable_queue():
+        for routing_key in (get_fetch_routing_key(), get_gather_routing_key()):
+            count = requeue_expired_leases(redis, routing_key)
+            if count:
+                log.debug('Re-sent {0} messages with expired leases to {1}'
+                          .format(count, routing_key))
+        return
+
     # fetch queue
     harvest_object_pending = redis.keys(get_fetch_routing_key() + ':*')
     for key in harvest_object_pending:
@@ -164,31 +374,209 @@ def resubmit_jobs():
             redis.delete(key)
 
 
+def requeue_expired_leases(redis, routing_key, batch_size=1000):
+    '''
+    Sends the messages whose lease has expired back to the queue, eg because
+    the consumer processing them died, and returns how many were sent.
+    '''
+    # Use a script so the messages are not lost or duplicated if another
+    # consumer acknowledges them at the same time
+    lua_code = b'''
+        local items = redis.call("zrangebyscore", KEYS[1], "-inf", ARGV[1],
+                                 "limit", 0, ARGV[2])
+        for i, item in ipairs(items) do
+            redis.call("zrem", KEYS[1], item)
+            -- Strip the delivery token, see get_lease_body
+            local body = string.sub(item, string.find(item, "|", 1, true) + 1)
+            redis.call("rpush", KEYS[2], body)
+        end
+        return #items
+    '''
+    script = redis.register_script(lua_code)
+    total = 0
+    while True:
+        count = script(keys=[get_lease_key(routing_key), routing_key],
+                       args=[time.time(), batch_size])
+        total += count
+        if count < batch_size:
+            return total
+
+
+def requeue_expired_stream_messages(redis, routing_key, batch_size=1000):
+    '''
+    Sends the messages of a ``redis-streams`` queue that have been pending
+    for longer than the lease time back to the end of the stream, eg because
+    the consumer processing them died and no other consumer has claimed
+    them, and returns how many were sent.
+    '''
+    consumer = RedisStreamsConsumer(redis, routing_key)
+    # Use a script so the messages are claimed, sent again and removed at
+    # once, leaving nothing pending for the consumer used to claim them
+    lua_code = b'''
+        local result = redis.call("xautoclaim", KEYS[1], ARGV[1], ARGV[2],
+                                  ARGV[3], ARGV[4], "count", ARGV[5])
+        local count = 0
+        for i, entry in ipairs(result[2]) do
+            -- The fields of messages deleted in the meantime are nil
+            if type(entry[2]) == "table" then
+                redis.call("xadd", KEYS[1], "*", unpack(entry[2]))
+                count = count + 1
+            end
+            redis.call("xack", KEYS[1], ARGV[1], entry[1])
+            redis.call("xdel", KEYS[1], entry[1])
+        end
+        return {result[1], count}
+    '''
+    script = redis.register_script(lua_code)
+    start = '0-0'
+    total = 0
+    while True:
+        start, count = script(
+            keys=[consumer.stream_key],
+            args=[consumer.group, 'resubmit', consumer.lease_time * 1000,
+                  start, batch_size])
+        total += count
+        if start == '0-0':
+            break
+    redis.xgroup_delconsumer(consumer.stream_key, consumer.group, 'resubmit')
+    return total
+
+
 def resubmit_objects():
     '''
     Resubmit all WAITING objects on the DB that are not present in Redis
+    (or in the queue table, when using the db backend)
     '''
-    if config.get('ckan.harvest.mq.type') != 'redis':
+    backend = config.get('ckan.harvest.mq.type')
+    if backend == 'db':
+        fetch_routing_key = get_fetch_routing_key()
+        result = model.Session.execute(text('''
+            INSERT INTO harvest_queue (routing_key, message_id, body, created)
+            SELECT :routing_key, obj.id,
+                '{"harvest_object_id": "' || obj.id || '"}',
+                timezone('utc', now())
+            FROM harvest_object AS obj
+            WHERE obj.state = 'WAITING'
+                AND NOT EXISTS (SELECT 1 FROM harvest_queue
+                                WHERE routing_key = :routing_key
+                                AND message_id = obj.id)
+            '''), {'routing_key': fetch_routing_key})
+        model.Session.commit()
+        log.debug('Re-sent {0} objects to the fetch queue'.format(result.rowcount))
+        return
+    if backend not in ('redis', 'redis-streams'):
         return
     redis = get_connection()
     publisher = get_fetch_publisher()
+    fetch_routing_key = get_fetch_routing_key()
+
+    # Index the ids of the queued messages in a temporary set, with a script
+    # that reads and decodes a slice of the queue on the server each time,
+    # so the whole queue never has to be transferred
+    queued_key = get_resubmit_key(fetch_routing_key)
+    redis.delete(queued_key)
+    if backend == 'redis-streams':
+        index_stream_message_ids(redis, fetch_routing_key, queued_key)
+    else:
+        index_list_message_ids(redis, fetch_routing_key, queued_key)
 
+    # Stream the waiting objects with a server side cursor, and check them
+    # against the set in pipelined batches
     waiting_objects = model.Session.query(HarvestObject.id) \
         .filter_by(state='WAITING') \
-        .all()
+        .yield_per(RESUBMIT_BATCH_SIZE)
+    total = 0
+    while True:
+        batch = [object_id for object_id, in
+                 itertools.islice(waiting_objects, RESUBMIT_BATCH_SIZE)]
+        if not batch:
+            break
+        pipe = redis.pipeline(transaction=False)
+        for object_id in batch:
+            pipe.sismember(queued_key, object_id)
+        missing = [object_id for object_id, queued
+                   in zip(batch, pipe.execute()) if not queued]
+        if missing:
+            publisher.send_many({'harvest_object_id': object_id}
+                                for object_id in missing)
+            total += len(missing)
+    redis.delete(queued_key)
+    log.debug('Re-sent {0} objects to the fetch queue'.format(total))
 
-    objects_in_queue = []
-    fetch_routing_key = get_fetch_routing_key()
+    publisher.close()
 
-    objects_in_queue = [json.loads(o)['harvest_object_id']
-                        for o in redis.lrange(fetch_routing_key, 0, -1)]
 
-    for object_id, in waiting_objects:
-        if object_id not in objects_in_queue:
-            log.debug('Re-sent object {} to the fetch queue'.format(object_id))
-            publisher.send({'harvest_object_id': object_id})
+def index_list_message_ids(redis, routing_key, set_key):
+    '''
+    Adds the ids of the messages queued in a Redis list queue, including
+    the fair queues, to the set ``set_key`` (see `resubmit_objects`).
+    '''
+    message_key = routing_key.split(':')[-1]
+    queue_keys = [routing_key]
+    if is_fair_queue():
+        queue_keys.extend(RedisConsumer(redis, routing_key).get_fair_keys())
+    index_script = redis.register_script(b'''
+        local items = redis.call("lrange", KEYS[1], ARGV[1], ARGV[2])
+        for i, item in ipairs(items) do
+            local ok, message = pcall(cjson.decode, item)
+            if ok and type(message) == "table"
+                    and type(message[ARGV[3]]) == "string" then
+                redis.call("sadd", KEYS[2], message[ARGV[3]])
+            end
+        end
+        redis.call("expire", KEYS[2], ARGV[4])
+        return #items
+    ''')
+    for key in queue_keys:
+        start = 0
+        while True:
+            count = index_script(
+                keys=[key, set_key],
+                args=[start, start + RESUBMIT_BATCH_SIZE - 1,
+                      message_key, RESUBMIT_SET_EXPIRES])
+            start += count
+            if count < RESUBMIT_BATCH_SIZE:
+                break
 
-    publisher.close()
+
+def index_stream_message_ids(redis, routing_key, set_key):
+    '''
+    Adds the ids of the messages in the stream of a ``redis-streams`` queue,
+    both the new and the pending ones, to the set ``set_key`` (see
+    `resubmit_objects`).
+    '''
+    message_key = routing_key.split(':')[-1]
+    index_script = redis.register_script(b'''
+        local entries = redis.call("xrange", KEYS[1], ARGV[1], "+",
+                                   "count", ARGV[2])
+        for i, entry in ipairs(entries) do
+            local fields = entry[2]
+            for j = 1, #fields, 2 do
+                if fields[j] == "body" then
+                    local ok, message = pcall(cjson.decode, fields[j + 1])
+                    if ok and type(message) == "table"
+                            and type(message[ARGV[3]]) == "string" then
+                        redis.call("sadd", KEYS[2], message[ARGV[3]])
+                    end
+                end
+            end
+        end
+        redis.call("expire", KEYS[2], ARGV[4])
+        if #entries == 0 then
+            return {0, ""}
+        end
+        return {#entries, entries[#entries][1]}
+    ''')
+    start = '-'
+    while True:
+        count, last_id = index_script(
+            keys=[get_stream_key(routing_key), set_key],
+            args=[start, RESUBMIT_BATCH_SIZE, message_key,
+                  RESUBMIT_SET_EXPIRES])
+        if count < RESUBMIT_BATCH_SIZE:
+            break
+        # The range is exclusive of the last message read
+        start = '(' + last_id
 
 
 class Publisher(object):
@@ -208,6 +596,43 @@ class Publisher(object):
             ),
             **kw)
 
+    def send_many(self, bodies, batch_size=SEND_BATCH_SIZE, source_id=None,
+                  priority=False, weight=1, **kw):
+        '''
+        Sends several messages. They are published in a transaction on a
+        separate channel, committed every ``batch_size`` messages, so the
+        broker confirms each batch with a single round trip.
+
+        With fair queuing, messages of a ``source_id`` are sent to the
+        queue of the source, and ``priority`` ones to the priority queue.
+        The ``weight`` of the source is read from its configuration by the
+        consumers instead.
+        '''
+        channel = self.connection.channel()
+        try:
+            routing_key = self.routing_key
+            if is_fair_queue() and (priority or source_id):
+                suffix = 'priority' if priority else source_id
+                routing_key = '{0}.{1}'.format(self.routing_key, suffix)
+                declare_fair_queue(channel, suffix)
+            channel.tx_select()
+            count = 0
+            for body in bodies:
+                channel.basic_publish(
+                    self.exchange,
+                    routing_key,
+                    json.dumps(body),
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # make message persistent
+                    ),
+                    **kw)
+                count += 1
+                if count % batch_size == 0:
+                    channel.tx_commit()
+            channel.tx_commit()
+        finally:
+            channel.close()
+
     def close(self):
         self.connection.close()
 
@@ -219,20 +644,154 @@ class RedisPublisher(object):
 
     def send(self, body, **kw):
         value = json.dumps(body)
-        # remove if already there
         if self.routing_key == get_gather_routing_key():
-            # it appears that both types of call are possible within the redis library depending on which version used
-            # for now support both versions
-            # https://github.com/andymccurdy/redis-py#client-classes-redis-and-strictredis
-            try:
-                self.redis.lrem(self.routing_key, 0, value)
-            except redis.ResponseError as e:
-                if 'value is not an integer' in e.message:
-                    self.redis.lrem(self.routing_key, value, 0)
-                else:
-                    raise
+            # remove the messages of the job if already there, even if the
+            # other fields (eg ``priority``) are different
+            lua_code = b'''
+                for i, item in ipairs(redis.call("lrange", KEYS[1], 0, -1)) do
+                    local ok, message = pcall(cjson.decode, item)
+                    if item == ARGV[2] or (ok and type(message) == "table"
+                            and message.harvest_job_id == ARGV[1]) then
+                        redis.call("lrem", KEYS[1], 0, item)
+                    end
+                end
+                return redis.call("rpush", KEYS[1], ARGV[2])
+            '''
+            script = self.redis.register_script(lua_code)
+            script(keys=[self.routing_key],
+                   args=[body.get('harvest_job_id') or '', value])
+            return
         self.redis.rpush(self.routing_key, value)
 
+    def send_many(self, bodies, batch_size=SEND_BATCH_SIZE, source_id=None,
+                  priority=False, weight=1, **kw):
+        '''
+        Sends several messages, pushing up to ``batch_size`` of them with a
+        single RPUSH.
+
+        With fair queuing, messages of a ``source_id`` are pushed to the list
+        of the source, which is added to the round-robin of sources if it
+        was not there, and ``priority`` ones to the priority list. The
+        consumers take ``weight`` messages in a row from the source.
+        '''
+        if self.routing_key == get_gather_routing_key():
+            # Gather messages need to be deduplicated one by one
+            for body in bodies:
+                self.send(body, **kw)
+            return
+
+        fair = is_fair_queue() and (priority or source_id)
+        bodies = iter(bodies)
+        while True:
+            values = [json.dumps(body)
+                      for body in itertools.islice(bodies, batch_size)]
+            if not values:
+                break
+            if not fair:
+                self.redis.rpush(self.routing_key, *values)
+            elif priority:
+                self.redis.rpush(get_fair_key(self.routing_key, 'priority'),
+                                 *values)
+            else:
+                self._fair_push(source_id, weight, values)
+
+    def _fair_push(self, source_id, weight, values):
+        # Use a script so the source is never left out of the round-robin
+        # while its list has messages, even if a consumer empties it at the
+        # same time
+        lua_code = b'''
+            redis.call("rpush", KEYS[1], unpack(ARGV, 3))
+            redis.call("hset", KEYS[4], ARGV[1], ARGV[2])
+            if redis.call("sadd", KEYS[3], ARGV[1]) == 1 then
+                redis.call("rpush", KEYS[2], ARGV[1])
+            end
+            return 1
+        '''
+        script = self.redis.register_script(lua_code)
+        script(keys=[get_fair_key(self.routing_key, 'source:' + source_id),
+                     get_fair_key(self.routing_key),
+                     get_fair_key(self.routing_key, 'sources'),
+                     get_fair_key(self.routing_key, 'weights')],
+               args=[source_id, weight] + values)
+
+    def close(self):
+        return
+
+
+class RedisStreamsPublisher(object):
+    def __init__(self, redis, routing_key):
+        self.redis = redis
+        self.routing_key = routing_key
+        self.stream_key = get_stream_key(routing_key)
+
+    def send(self, body, **kw):
+        self.redis.xadd(self.stream_key, {'body': json.dumps(body)})
+
+    def send_many(self, bodies, batch_size=SEND_BATCH_SIZE, **kw):
+        '''
+        Sends several messages, with a single pipelined round trip to Redis
+        every ``batch_size`` messages.
+        '''
+        bodies = iter(bodies)
+        while True:
+            batch = list(itertools.islice(bodies, batch_size))
+            if not batch:
+                break
+            pipe = self.redis.pipeline(transaction=False)
+            for body in batch:
+                pipe.xadd(self.stream_key, {'body': json.dumps(body)})
+            pipe.execute()
+
+    def close(self):
+        return
+
+
+class DBPublisher(object):
+    '''
+    Publisher for the ``db`` backend, which stores the messages in the
+    ``harvest_queue`` table.
+
+    Messages are written through the CKAN session, so they are committed
+    together with any pending change of the caller (eg the harvest objects
+    created by the gather stage).
+    '''
+    def __init__(self, session, routing_key):
+        self.session = session
+        self.routing_key = routing_key
+        self.message_key = routing_key.split(':')[-1]
+
+    def send(self, body, **kw):
+        self.send_many([body])
+
+    def send_many(self, bodies, batch_size=SEND_BATCH_SIZE, **kw):
+        '''
+        Sends several messages, with one multi-row INSERT every
+        ``batch_size`` messages, and commits them.
+        '''
+        from ckanext.harvest.model import harvest_queue_table
+
+        bodies = iter(bodies)
+        while True:
+            rows = [{
+                'routing_key': self.routing_key,
+                'message_id': body.get(self.message_key),
+                'body': json.dumps(body),
+                'created': datetime.datetime.utcnow(),
+            } for body in itertools.islice(bodies, batch_size)]
+            if not rows:
+                break
+            if self.routing_key == get_gather_routing_key():
+                # remove if already there and not being processed
+                table = harvest_queue_table
+                self.session.execute(
+                    table.delete()
+                    .where(table.c.routing_key == self.routing_key)
+                    .where(table.c.message_id.in_(
+                        [row['message_id'] for row in rows]))
+                    .where(table.c.lease_expires == None))  # noqa: E711
+            self.session.execute(harvest_queue_table.insert().values(rows))
+        self.session.commit()
+
     def close(self):
         return
 
@@ -249,6 +808,10 @@ def get_publisher(routing_key):
                          routing_key=routing_key)
     if backend == 'redis':
         return RedisPublisher(connection, routing_key)
+    if backend == 'redis-streams':
+        return RedisStreamsPublisher(connection, routing_key)
+    if backend == 'db':
+        return DBPublisher(connection, routing_key)
 
 
 class FakeMethod(object):
@@ -267,16 +830,164 @@ class RedisConsumer(object):
         # harvest_object_id for the fetch consumer
         self.message_key = routing_key.split(':')[-1]
 
+        self.reliable = is_reliable_queue()
+        if self.reliable:
+            self.lease_key = get_lease_key(routing_key)
+            self.lease_time = GATHER_LEASE_TIME \
+                if self.message_key == 'harvest_job_id' else FETCH_LEASE_TIME
+            # Pop the message and lease it atomically, so it can't be lost
+            # if the consumer dies in between. The lease is prefixed with a
+            # unique delivery token (see get_lease_body)
+            self._lease_script = self.redis.register_script(b'''
+                local body = redis.call("lpop", KEYS[1])
+                if body then
+                    local member = ARGV[2] .. "|" .. body
+                    redis.call("zadd", KEYS[2], ARGV[1], member)
+                    return member
+                end
+                return body
+            ''')
+            # Send back a leased message, unless its lease expired and it
+            # was already sent back by requeue_expired_leases
+            self._reject_script = self.redis.register_script(b'''
+                if redis.call("zrem", KEYS[1], ARGV[1]) == 1 and
+                        ARGV[2] ~= "" then
+                    redis.call("lpush", KEYS[2], ARGV[2])
+                end
+            ''')
+
+        self.fair = (is_fair_queue() and
+                     self.routing_key == get_fetch_routing_key())
+        if self.fair:
+            # Take the next message from the priority list, then from the
+            # main list (eg messages sent back by resubmit_jobs) and then
+            # from the list of the source at the head of the round-robin,
+            # which is moved to the tail after serving its weight. Sources
+            # with an empty list are removed from the round-robin. The lists
+            # of the sources are passed from KEYS[8] on, in the order of the
+            # source ids in ARGV[3] on.
+            self._fair_pop_script = self.redis.register_script(b'''
+                local function leased(body)
+                    if ARGV[1] ~= "" then
+                        local member = ARGV[2] .. "|" .. body
+                        redis.call("zadd", KEYS[7], ARGV[1], member)
+                        return member
+                    end
+                    return body
+                end
+                local body = redis.call("lpop", KEYS[1])
+                if body then
+                    return leased(body)
+                end
+                body = redis.call("lpop", KEYS[2])
+                if body then
+                    return leased(body)
+                end
+                local queues = {}
+                for i = 3, #ARGV do
+                    queues[ARGV[i]] = KEYS[i + 5]
+                end
+                for i = 1, redis.call("llen", KEYS[3]) do
+                    local source = redis.call("lindex", KEYS[3], 0)
+                    local queue = queues[source]
+                    if not queue then
+                        -- The source was added after the keys were read
+                        return -1
+                    end
+                    body = redis.call("lpop", queue)
+                    if body and redis.call("llen", queue) > 0 then
+                        local served = redis.call("hincrby", KEYS[6], source, 1)
+                        local weight = tonumber(redis.call("hget", KEYS[5], source)) or 1
+                        if served >= weight then
+                            redis.call("hdel", KEYS[6], source)
+                            redis.call("rpush", KEYS[3], redis.call("lpop", KEYS[3]))
+                        end
+                    else
+                        redis.call("lpop", KEYS[3])
+                        redis.call("srem", KEYS[4], source)
+                        redis.call("hdel", KEYS[5], source)
+                        redis.call("hdel", KEYS[6], source)
+                    end
+                    if body then
+                        return leased(body)
+                    end
+                end
+                return false
+            ''')
+
     def consume(self, queue):
         while True:
-            key, body = self.redis.blpop(self.routing_key)
-            try:
-                self.redis.set(self.persistance_key(body), str(datetime.datetime.now()))
-            except Exception as e:
-                log.error("Redis Exception: %s", e)
-                continue
+            if self.reliable or self.fair:
+                tag = self.fair_pop() if self.fair else self.lease()
+                if tag is None:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                if self.reliable:
+                    body = get_lease_body(tag)
+                else:
+                    body = tag
+                    try:
+                        self.redis.set(self.persistance_key(body),
+                                       str(datetime.datetime.now()))
+                    except Exception as e:
+                        log.error("Redis Exception: %s", e)
+                        continue
+            else:
+                key, body = self.redis.blpop(self.routing_key)
+                tag = body
+                try:
+                    self.redis.set(self.persistance_key(body), str(datetime.datetime.now()))
+                except Exception as e:
+                    log.error("Redis Exception: %s", e)
+                    continue
+
+            # In reliable mode, the delivery tag is the lease of the message
+            yield (FakeMethod(tag), self, body)
+
+    def lease(self):
+        '''
+        Takes the next message from the queue, leasing it until it is
+        acknowledged or the lease time runs out. Returns the lease (see
+        `get_lease_body`), or None if the queue is empty.
+        '''
+        return self._lease_script(
+            keys=[self.routing_key, self.lease_key],
+            args=[time.time() + self.lease_time, uuid.uuid4().hex])
 
-            yield (FakeMethod(body), self, body)
+    def fair_pop(self):
+        '''
+        Takes the next message from the fair queues (see
+        ``ckan.harvest.mq.fair``), leasing it in reliable mode. Returns None
+        if all of them are empty.
+        '''
+        while True:
+            source_ids = self.redis.lrange(get_fair_key(self.routing_key),
+                                           0, -1)
+            body = self._fair_pop_script(
+                keys=[get_fair_key(self.routing_key, 'priority'),
+                      self.routing_key,
+                      get_fair_key(self.routing_key),
+                      get_fair_key(self.routing_key, 'sources'),
+                      get_fair_key(self.routing_key, 'weights'),
+                      get_fair_key(self.routing_key, 'served'),
+                      self.lease_key if self.reliable else ''] + [
+                    get_fair_key(self.routing_key, 'source:' + source_id)
+                    for source_id in source_ids],
+                args=[time.time() + self.lease_time if self.reliable else '',
+                      uuid.uuid4().hex] + source_ids)
+            # Retry if the round-robin changed in the meantime
+            if body != -1:
+                return body
+
+    def get_fair_keys(self):
+        '''
+        Returns the keys of the lists of the fair queues holding messages:
+        the priority list and the lists of the sources in the round-robin.
+        '''
+        return [get_fair_key(self.routing_key, 'priority')] + [
+            get_fair_key(self.routing_key, 'source:' + source_id)
+            for source_id in self.redis.smembers(
+                get_fair_key(self.routing_key, 'sources'))]
 
     def persistance_key(self, message):
         # If you change this, make sure to update the script in `queue_purge`
@@ -284,8 +995,27 @@ class RedisConsumer(object):
         return self.routing_key + ':' + message[self.message_key]
 
     def basic_ack(self, message):
+        if self.reliable:
+            self.redis.zrem(self.lease_key, message)
+            return
         self.redis.delete(self.persistance_key(message))
 
+    def basic_reject(self, message, requeue=True):
+        '''
+        Gives back a message that was taken from the queue but not
+        processed, sending it back to the head of the queue if ``requeue``.
+        '''
+        if self.reliable:
+            self._reject_script(
+                keys=[self.lease_key, self.routing_key],
+                args=[message, get_lease_body(message) if requeue else ''])
+            return
+        pipe = self.redis.pipeline()
+        pipe.delete(self.persistance_key(message))
+        if requeue:
+            pipe.lpush(self.routing_key, message)
+        pipe.execute()
+
     def queue_purge(self, queue=None):
         '''
         Purge the consumer's queue.
@@ -312,11 +1042,331 @@ class RedisConsumer(object):
             return count
         '''
         script = self.redis.register_script(lua_code)
-        return script(keys=[self.routing_key], args=[self.message_key])
+        if self.reliable:
+            self.redis.delete(self.lease_key)
+        count = 0
+        if self.fair:
+            # Messages in the fair lists have not been consumed yet, so they
+            # have no persistence keys
+            keys = self.get_fair_keys()
+            pipe = self.redis.pipeline()
+            for key in keys:
+                pipe.llen(key)
+            pipe.delete(*(keys + [get_fair_key(self.routing_key, suffix)
+                                  for suffix in (None, 'sources', 'weights',
+                                                 'served')]))
+            count = sum(pipe.execute()[:-1])
+        return count + script(keys=[self.routing_key], args=[self.message_key])
 
     def basic_get(self, queue):
-        body = self.redis.lpop(self.routing_key)
-        return (FakeMethod(body), self, body)
+        if self.fair:
+            tag = self.fair_pop()
+        elif self.reliable:
+            tag = self.lease()
+        else:
+            tag = self.redis.lpop(self.routing_key)
+        body = tag
+        if self.reliable and tag is not None:
+            body = get_lease_body(tag)
+        return (FakeMethod(tag), self, body)
+
+
+class AMQPFairConsumer(object):
+    '''
+    Consumer for the AMQP fetch queue with fair queuing (see
+    ``ckan.harvest.mq.fair``).
+
+    Messages are taken with ``basic_get`` from the priority queue first,
+    then from the main fetch queue (for messages sent without a source) and
+    then from the queues of the sources with running jobs, in weighted
+    round-robin, so it wraps the channel instead of using ``basic_consume``.
+    '''
+    def __init__(self, channel, queue_name):
+        self.channel = channel
+        self.queue_name = queue_name
+        self.priority_queue_name = declare_fair_queue(channel, 'priority')
+        # (queue name, weight) of the sources with running jobs
+        self.sources = []
+        self.sources_refreshed = 0
+        self.turn = 0
+        self.served = 0
+
+    def consume(self, queue):
+        while True:
+            method, header, body = self.basic_get(queue)
+            if method is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            yield (method, header, body)
+
+    def refresh_sources(self):
+        if time.time() - self.sources_refreshed < FAIR_SOURCES_REFRESH_TIME:
+            return
+        from ckanext.harvest.model import HarvestSource
+
+        running = model.Session.query(HarvestJob.source_id) \
+            .filter(HarvestJob.status == u'Running')
+        sources = model.Session.query(HarvestSource) \
+            .filter(HarvestSource.id.in_(running.subquery())) \
+            .order_by(HarvestSource.id) \
+            .all()
+        self.sources = [(declare_fair_queue(self.channel, source.id),
+                         get_fetch_weight(source))
+                        for source in sources]
+        # Don't keep a transaction open while polling
+        model.Session.remove()
+        self.sources_refreshed = time.time()
+        if self.turn >= len(self.sources):
+            self.turn = 0
+            self.served = 0
+
+    def next_turn(self):
+        self.turn = (self.turn + 1) % len(self.sources)
+        self.served = 0
+
+    def basic_get(self, queue=None):
+        self.refresh_sources()
+        for queue_name in (self.priority_queue_name, self.queue_name):
+            method, header, body = self.channel.basic_get(queue=queue_name)
+            if method is not None:
+                return (method, header, body)
+        for i in range(len(self.sources)):
+            queue_name, weight = self.sources[self.turn]
+            method, header, body = self.channel.basic_get(queue=queue_name)
+            if method is not None:
+                self.served += 1
+                if self.served >= weight:
+                    self.next_turn()
+                return (method, header, body)
+            self.next_turn()
+        return (None, None, None)
+
+    def basic_ack(self, delivery_tag):
+        return self.channel.basic_ack(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        return self.channel.basic_reject(delivery_tag, requeue=requeue)
+
+    def queue_purge(self, queue=None):
+        return self.channel.queue_purge(queue=self.queue_name)
+
+
+class RedisStreamsConsumer(object):
+    '''
+    Consumer for the ``redis-streams`` backend.
+
+    All the consumers of a queue belong to the same consumer group, so each
+    message is delivered to only one of them, and it stays in the group
+    pending entries list until it is acknowledged. Messages left pending by
+    a consumer for longer than the lease time (eg because it crashed) are
+    claimed by the other consumers.
+    '''
+    def __init__(self, redis, routing_key, count=STREAM_READ_COUNT):
+        self.redis = redis
+        self.routing_key = routing_key
+        self.message_key = routing_key.split(':')[-1]
+        self.stream_key = get_stream_key(routing_key)
+        self.group = STREAM_GROUP_NAME
+        # Consumers are created in the thread using them, and each one needs
+        # its own name so they don't read each other's pending messages
+        self.consumer = '{0}-{1}-{2}'.format(
+            socket.gethostname(), os.getpid(),
+            threading.current_thread().name)
+        self.count = count
+        self.lease_time = GATHER_LEASE_TIME \
+            if self.message_key == 'harvest_job_id' else FETCH_LEASE_TIME
+        self._create_group()
+
+    def _create_group(self):
+        try:
+            self.redis.xgroup_create(self.stream_key, self.group, id='0',
+                                     mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def consume(self, queue):
+        last_claim = 0
+        while True:
+            messages = []
+            if time.time() - last_claim >= self.lease_time:
+                messages = self.claim()
+                last_claim = time.time()
+            if not messages:
+                messages = self.read(block=STREAM_BLOCK_TIME)
+
+            for message_id, body in messages:
+                yield (FakeMethod(message_id), self, body)
+
+    def read(self, count=None, block=None):
+        '''
+        Returns a list of ``(message_id, body)`` tuples with the new messages
+        for this consumer, waiting up to ``block`` milliseconds for them.
+        '''
+        response = self.redis.xreadgroup(
+            self.group, self.consumer, {self.stream_key: '>'},
+            count=count or self.count, block=block)
+        return [(message_id, fields['body'])
+                for stream, entries in response or []
+                for message_id, fields in entries]
+
+    def claim(self):
+        '''
+        Claims for this consumer the messages that have been pending for
+        longer than the lease time, and returns them like `read`.
+        '''
+        response = self.redis.xautoclaim(
+            self.stream_key, self.group, self.consumer,
+            min_idle_time=self.lease_time * 1000, start_id='0-0',
+            count=self.count)
+        messages = []
+        for message_id, fields in response[1]:
+            if fields:
+                log.debug('Claimed pending message %s from %s',
+                          message_id, self.stream_key)
+                messages.append((message_id, fields['body']))
+        return messages
+
+    def basic_ack(self, message_id):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xack(self.stream_key, self.group, message_id)
+        pipe.xdel(self.stream_key, message_id)
+        pipe.execute()
+
+    def queue_purge(self, queue=None):
+        '''
+        Purge the consumer's queue, including the pending messages.
+
+        The ``queue`` parameter exists only for compatibility and is
+        ignored.
+        '''
+        pipe = self.redis.pipeline()
+        pipe.xlen(self.stream_key)
+        pipe.delete(self.stream_key)
+        count = pipe.execute()[0]
+        self._create_group()
+        return count
+
+    def basic_get(self, queue):
+        messages = self.read(count=1)
+        message_id, body = messages[0] if messages else (None, None)
+        return (FakeMethod(message_id), self, body)
+
+    def stats(self):
+        '''
+        Returns the number of messages in the queue, the number of them
+        pending acknowledgement and how many are pending for each consumer.
+        '''
+        pending = self.redis.xpending(self.stream_key, self.group)
+        return {
+            'length': self.redis.xlen(self.stream_key),
+            'pending': pending['pending'],
+            'consumers': dict((consumer['name'], consumer['pending'])
+                              for consumer in pending['consumers']),
+        }
+
+
+class DBConsumer(object):
+    '''
+    Consumer for the ``db`` backend.
+
+    Consumers claim messages with ``SELECT ... FOR UPDATE SKIP LOCKED``, so
+    several of them can work on the same queue without blocking each other,
+    and lease them for a time. Messages not acknowledged before the lease
+    expires (eg because the consumer died) are delivered again.
+    '''
+    def __init__(self, session, routing_key, count=DB_CLAIM_COUNT):
+        self.session = session
+        self.routing_key = routing_key
+        self.message_key = routing_key.split(':')[-1]
+        if self.message_key == 'harvest_job_id':
+            self.count = 1
+            self.lease_time = GATHER_LEASE_TIME
+        else:
+            self.count = count
+            self.lease_time = FETCH_LEASE_TIME
+
+    def consume(self, queue):
+        while True:
+            messages = self._claim(self.count)
+            if not messages:
+                time.sleep(POLL_INTERVAL)
+                continue
+            for i, (message_id, body, lease_expires) in enumerate(messages):
+                # Each message is leased for the lease time from the moment
+                # it is delivered, not from the moment it was claimed
+                if i and not self._renew(message_id, lease_expires):
+                    # The lease expired and another consumer claimed it
+                    continue
+                yield (FakeMethod(message_id), self, body)
+
+    def claim(self, count=None):
+        '''
+        Leases the next messages of the queue and returns them as a list of
+        ``(message_id, body)`` tuples.
+        '''
+        return [(message_id, body) for message_id, body, lease_expires
+                in self._claim(count or self.count)]
+
+    def _claim(self, count):
+        result = self.session.execute(text('''
+            UPDATE harvest_queue
+            SET lease_expires = timezone('utc', now()) + :lease_time * interval '1 second'
+            WHERE id IN (
+                SELECT id FROM harvest_queue
+                WHERE routing_key = :routing_key
+                    AND (lease_expires IS NULL
+                         OR lease_expires < timezone('utc', now()))
+                ORDER BY id
+                LIMIT :count
+                FOR UPDATE SKIP LOCKED)
+            RETURNING id, body, lease_expires
+            '''), {'routing_key': self.routing_key,
+                   'lease_time': self.lease_time,
+                   'count': count})
+        messages = sorted((row.id, row.body, row.lease_expires)
+                          for row in result)
+        self.session.commit()
+        return messages
+
+    def _renew(self, message_id, lease_expires):
+        '''
+        Extends the lease of a claimed message to the lease time from now,
+        unless it has been claimed again since. Returns whether it was
+        extended.
+        '''
+        result = self.session.execute(text('''
+            UPDATE harvest_queue
+            SET lease_expires = timezone('utc', now()) + :lease_time * interval '1 second'
+            WHERE id = :id AND lease_expires = :lease_expires
+            '''), {'id': message_id, 'lease_time': self.lease_time,
+                   'lease_expires': lease_expires})
+        self.session.commit()
+        return result.rowcount == 1
+
+    def basic_ack(self, message_id):
+        self.session.execute(
+            text('DELETE FROM harvest_queue WHERE id = :id'),
+            {'id': message_id})
+        self.session.commit()
+
+    def queue_purge(self, queue=None):
+        '''
+        Purge the consumer's queue, including the messages being processed.
+
+        The ``queue`` parameter exists only for compatibility and is
+        ignored.
+        '''
+        result = self.session.execute(
+            text('DELETE FROM harvest_queue WHERE routing_key = :routing_key'),
+            {'routing_key': self.routing_key})
+        self.session.commit()
+        return result.rowcount
+
+    def basic_get(self, queue):
+        messages = self.claim(count=1)
+        message_id, body = messages[0] if messages else (None, None)
+        return (FakeMethod(message_id), self, body)
 
 
 def get_consumer(queue_name, routing_key):
@@ -329,15 +1379,21 @@ def get_consumer(queue_name, routing_key):
         channel.exchange_declare(exchange=EXCHANGE_NAME, durable=True)
         channel.queue_declare(queue=queue_name, durable=True)
         channel.queue_bind(queue=queue_name, exchange=EXCHANGE_NAME, routing_key=routing_key)
+        if is_fair_queue() and routing_key == get_fetch_routing_key():
+            return AMQPFairConsumer(channel, queue_name)
         return channel
     if backend == 'redis':
         return RedisConsumer(connection, routing_key)
+    if backend == 'redis-streams':
+        return RedisStreamsConsumer(connection, routing_key)
+    if backend == 'db':
+        return DBConsumer(connection, routing_key)
 
 
 def gather_callback(channel, method, header, body):
-
     try:
-        id = json.loads(body)['harvest_job_id']
+        message = json.loads(body)
+        id = message['harvest_job_id']
         log.debug('Received harvest job id: %s' % id)
     except KeyError:
         log.error('No harvest job id received')
@@ -368,11 +1424,29 @@ def gather_callback(channel, method, header, body):
     # matches
     harvester = get_harvester(job.source.type)
     if harvester:
-        try:
-            harvest_object_ids = gather_stage(harvester, job)
-        except (Exception, KeyboardInterrupt):
+        with _gather_host_slot(job.source.url) as acquired:
+            if acquired:
+                try:
+                    harvest_object_ids = gather_stage(
+                        harvester, job, publisher,
+                        priority=message.get('priority', False))
+                except (Exception, KeyboardInterrupt):
+                    channel.basic_ack(method.delivery_tag)
+                    raise
+
+        if not acquired:
+            # Back off a bit more every time the job is sent back, so the
+            # consumers don't keep passing it around
+            retries = message.get('host_retries', 0)
+            delay = min(POLL_INTERVAL * 2 ** retries, GATHER_HOST_BACKOFF_MAX)
+            log.info('Too many gathers running for the host of job %s, '
+                     'sending it back to the queue in %s seconds', id, delay)
+            _send_back_gather_job(dict(message, host_retries=retries + 1),
+                                  delay)
+            model.Session.remove()
+            publisher.close()
             channel.basic_ack(method.delivery_tag)
-            raise
+            return False
 
         if not isinstance(harvest_object_ids, list):
             log.error('Gather stage failed')
@@ -388,9 +1462,6 @@ def gather_callback(channel, method, header, body):
 
         log.debug('Received from plugin gather_stage: {0} objects (first: {1} last: {2})'.format(
             len(harvest_object_ids), harvest_object_ids[:1], harvest_object_ids[-1:]))
-        for id in harvest_object_ids:
-            # Send the id to the fetch queue
-            publisher.send({'harvest_object_id': id})
         log.debug('Sent {0} objects to the fetch queue'.format(len(harvest_object_ids)))
 
     else:
@@ -411,37 +1482,184 @@ def gather_callback(channel, method, header, body):
     channel.basic_ack(method.delivery_tag)
 
 
+@contextlib.contextmanager
+def _gather_host_slot(url):
+    '''
+    Takes a gather slot for the host of the given source URL while in the
+    context, and gives False if there are already
+    ``ckan.harvest.gather.max_per_host`` gathers (default 0, no limit)
+    running for it, in any gather consumer.
+
+    Slots are PostgreSQL advisory locks held by a connection of their own,
+    so they are released even if the process dies.
+    '''
+    max_per_host = toolkit.asint(
+        config.get('ckan.harvest.gather.max_per_host', 0))
+    if not max_per_host:
+        yield True
+        return
+    from ckan.model.meta import engine
+
+    host = urlparse(url).netloc.lower()
+    # Don't keep a transaction open while gathering
+    connection = engine.connect().execution_options(
+        isolation_level='AUTOCOMMIT')
+    try:
+        for slot in range(max_per_host):
+            params = {'namespace': GATHER_HOST_LOCK_NAMESPACE,
+                      'key': _gather_host_lock_key(host, slot)}
+            if not connection.execute(
+                    text('SELECT pg_try_advisory_lock(:namespace, :key)'),
+                    params).scalar():
+                continue
+            try:
+                yield True
+            finally:
+                connection.execute(
+                    text('SELECT pg_advisory_unlock(:namespace, :key)'),
+                    params)
+            return
+        yield False
+    finally:
+        connection.close()
+
+
+def _gather_host_lock_key(host, slot):
+    # Advisory lock keys are signed 32-bit integers
+    key = zlib.crc32('{0} {1}'.format(host, slot).encode('utf-8')) & 0xffffffff
+    return key - 0x100000000 if key >= 0x80000000 else key
+
+
+def _send_back_gather_job(message, delay):
+    '''
+    Sends a gather job back to the queue after ``delay`` seconds, without
+    blocking the consumer meanwhile. The jobs still waiting when the
+    consumer stops are sent straight away by `send_back_gather_jobs`.
+    '''
+    def send():
+        with _gather_retry_lock:
+            if _gather_retry_timers.pop(timer, None) is None:
+                # Already sent by send_back_gather_jobs
+                return
+        _send_gather_jobs([message])
+
+    timer = threading.Timer(delay, send)
+    timer.daemon = True
+    with _gather_retry_lock:
+        _gather_retry_timers[timer] = message
+    timer.start()
+
+
+def send_back_gather_jobs():
+    '''
+    Sends back to the queue the gather jobs waiting to be sent back, see
+    `_send_back_gather_job`.
+    '''
+    with _gather_retry_lock:
+        timers = dict(_gather_retry_timers)
+        _gather_retry_timers.clear()
+    for timer in timers:
+        timer.cancel()
+    if timers:
+        _send_gather_jobs(list(timers.values()))
+
+
+def _send_gather_jobs(messages):
+    publisher = get_gather_publisher()
+    try:
+        for message in messages:
+            publisher.send(message)
+    finally:
+        publisher.close()
+        model.Session.remove()
+
+
 def get_harvester(harvest_source_type):
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == harvest_source_type:
-            return harvester
+    return registry.get_harvester(harvest_source_type)
 
 
-def gather_stage(harvester, job):
+def gather_stage(harvester, job, publisher=None, priority=False):
     '''Calls the harvester's gather_stage, returning harvest object ids, with
     some error handling.
 
+    If a publisher for the fetch queue is provided, the harvest object ids
+    are also sent to it. Harvesters can return a generator of lists of ids
+    from their gather_stage, in which case each list is sent as soon as it
+    is yielded, so the fetch consumers can start working before the gather
+    stage is finished. With fair queuing, the ids are sent to the queue of
+    the job source, or to the priority queue if ``priority`` is set (for
+    manually triggered jobs).
+
     This is split off from gather_callback so that tests can call it without
     dealing with queue stuff.
     '''
     job.gather_started = datetime.datetime.utcnow()
 
+    # Ids already sent to the fetch queue by a streaming gather
+    published = set()
+    streamed = False
     try:
         harvest_object_ids = harvester.gather_stage(job)
+        if isinstance(harvest_object_ids, types.GeneratorType):
+            streamed = True
+            harvest_object_ids_batches = harvest_object_ids
+            harvest_object_ids = []
+            for batch in harvest_object_ids_batches:
+                if publisher:
+                    _send_harvest_object_ids(publisher, batch, job, priority)
+                    published.update(batch)
+                harvest_object_ids.extend(batch)
     except (Exception, KeyboardInterrupt):
+        # The objects already in the fetch queue are kept, so they are
+        # fetched and imported as usual
         harvest_objects = model.Session.query(HarvestObject).filter_by(
             harvest_job_id=job.id
         )
         for harvest_object in harvest_objects:
-            model.Session.delete(harvest_object)
+            if harvest_object.id not in published:
+                model.Session.delete(harvest_object)
         model.Session.commit()
         raise
     finally:
         job.gather_finished = datetime.datetime.utcnow()
         job.save()
+
+    if publisher and not streamed and isinstance(harvest_object_ids, list):
+        _send_harvest_object_ids(publisher, harvest_object_ids, job,
+                                 priority)
     return harvest_object_ids
 
 
+def declare_fair_queue(channel, suffix):
+    '''
+    Declares the AMQP fair queue of a source (or the priority queue, if
+    ``suffix`` is ``priority``), eg ``ckan.harvest.default.fetch.<source id>``
+    bound to ``ckanext-harvest:default:harvest_object_id.<source id>``.
+
+    The queue is deleted by the broker after `FAIR_QUEUE_EXPIRES` hours
+    without being used, eg once the source has been deleted.
+    '''
+    queue_name = '{0}.{1}'.format(get_fetch_queue_name(), suffix)
+    channel.queue_declare(
+        queue=queue_name, durable=True,
+        arguments={'x-expires': FAIR_QUEUE_EXPIRES * 3600 * 1000})
+    channel.queue_bind(queue=queue_name, exchange=EXCHANGE_NAME,
+                       routing_key='{0}.{1}'.format(get_fetch_routing_key(),
+                                                    suffix))
+    return queue_name
+
+
+def _send_harvest_object_ids(publisher, harvest_object_ids, job=None,
+                             priority=False):
+    # Send the ids to the fetch queue
+    kw = {}
+    if job is not None:
+        kw = {'source_id': job.source_id, 'priority': priority,
+              'weight': get_fetch_weight(job.source)}
+    publisher.send_many(({'harvest_object_id': id}
+                         for id in harvest_object_ids), **kw)
+
+
 def fetch_callback(channel, method, header, body):
     try:
         id = json.loads(body)['harvest_object_id']
@@ -452,7 +1670,12 @@ def fetch_callback(channel, method, header, body):
         return False
 
     try:
-        obj = HarvestObject.get(id)
+        # The source is needed to dispatch the object (the content is
+        # deferred, so it is only loaded if the harvester uses it)
+        obj = model.Session.query(HarvestObject) \
+            .options(joinedload(HarvestObject.source)) \
+            .filter(HarvestObject.id == id) \
+            .first()
     except sqlalchemy.exc.DatabaseError:
         # Occasionally we see: sqlalchemy.exc.OperationalError
         # "SSL connection has been closed unexpectedly"
@@ -468,7 +1691,9 @@ def fetch_callback(channel, method, header, body):
         return False
 
     obj.retry_times += 1
-    obj.save()
+    if not is_lean_transitions():
+        # In lean mode it is saved when the fetch stage starts
+        obj.save()
 
     if obj.retry_times >= 5:
         obj.state = "ERROR"
@@ -478,27 +1703,145 @@ def fetch_callback(channel, method, header, body):
         return False
 
     # check if job has been set to finished
-    job = HarvestJob.get(obj.harvest_job_id)
-    if job.status == 'Finished':
+    if get_job_status(obj.harvest_job_id) == 'Finished':
         obj.state = "ERROR"
         obj.report_status = "errored"
         obj.save()
-        log.error('Job {0} was aborted or timed out, object {1} set to error'.format(job.id, obj.id))
+        log.error('Job {0} was aborted or timed out, object {1} set to error'.format(obj.harvest_job_id, obj.id))
         channel.basic_ack(method.delivery_tag)
         return False
 
     # Send the harvest object to the plugins that implement
     # the Harvester interface, only if the source type
     # matches
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == obj.source.type:
-            fetch_and_import_stages(harvester, obj)
+    harvester = get_harvester(obj.source.type)
+    if harvester:
+        fetch_and_import_stages(harvester, obj)
 
     model.Session.remove()
     channel.basic_ack(method.delivery_tag)
 
 
+def get_job_status(job_id):
+    '''
+    Returns the status of a harvest job, cached for JOB_STATUS_CACHE_TTL
+    seconds so the fetch consumers don't query it for every object. Jobs
+    finished or aborted with `notify_jobs_finished` are seen as finished
+    immediately.
+    '''
+    _start_job_finished_listener()
+    status = _job_status_cache.get(job_id)
+    if status is None:
+        status = model.Session.query(HarvestJob.status) \
+            .filter(HarvestJob.id == job_id) \
+            .scalar()
+        _job_status_cache.set(job_id, status)
+    return status
+
+
+def notify_jobs_finished(job_ids, session=None):
+    '''
+    Tells the fetch consumers that jobs have finished or been aborted, with
+    PostgreSQL notifications sent when the current transaction is
+    committed, so they stop processing their objects without waiting for
+    their cached status to expire, and drop anything kept for them (see
+    `on_job_finished`).
+    '''
+    if not job_ids:
+        return
+    (session or model.Session).execute(
+        text('''SELECT pg_notify(:channel, job_id)
+                FROM unnest(CAST(:job_ids AS text[])) AS job_id'''),
+        {'channel': JOB_FINISHED_CHANNEL, 'job_ids': list(job_ids)})
+    for job_id in job_ids:
+        _job_finished(job_id)
+
+
+def on_job_finished(callback):
+    '''
+    Registers a function to be called with the id of each harvest job
+    finished or aborted from now on, in this process or in any other (see
+    `notify_jobs_finished`), eg to drop the caches kept for the job.
+    '''
+    _start_job_finished_listener()
+    _job_finished_callbacks.append(callback)
+
+
+def _job_finished(job_id):
+    _job_status_cache.set(job_id, u'Finished')
+    for callback in list(_job_finished_callbacks):
+        try:
+            callback(job_id)
+        except Exception:
+            log.exception('Error handling finished harvest job %s', job_id)
+
+
+def _start_job_finished_listener():
+    # The listener runs in a thread of its own in each process, so it needs
+    # to be started again in forked workers
+    global _job_finished_listener_pid
+    if _job_finished_listener_pid == os.getpid():
+        return
+    with _job_finished_listener_lock:
+        if _job_finished_listener_pid == os.getpid():
+            return
+        _job_finished_listener_pid = os.getpid()
+        thread = threading.Thread(target=_listen_job_finished,
+                                  name='harvest-job-finished-listener')
+        thread.daemon = True
+        thread.start()
+
+
+def _listen_job_finished():
+    '''
+    Marks the jobs as finished in the status cache and calls the functions
+    registered with `on_job_finished` when a notification that they have
+    finished or been aborted is received.
+    '''
+    while True:
+        connection = None
+        try:
+            # Use a connection of its own, not returned to the pool, as it
+            # keeps listening
+            connection = model.meta.engine.raw_connection()
+            connection.detach()
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute('LISTEN {0}'.format(JOB_FINISHED_CHANNEL))
+            while True:
+                if select.select([dbapi_connection], [], [], 60) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    log.debug('Job %s has finished', notify.payload)
+                    _job_finished(notify.payload)
+        except Exception:
+            log.exception('Error listening for finished harvest jobs')
+            time.sleep(JOB_STATUS_CACHE_TTL)
+        finally:
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+
+def is_lean_transitions():
+    '''
+    Whether the state changes of the harvest objects during the fetch and
+    import stages are committed together (the
+    ``ckan.harvest.lean_transitions`` option), see
+    `lean_fetch_and_import_stages`.
+    '''
+    return toolkit.asbool(config.get('ckan.harvest.lean_transitions', False))
+
+
 def fetch_and_import_stages(harvester, obj):
+    if is_lean_transitions():
+        return lean_fetch_and_import_stages(harvester, obj)
+
     obj.fetch_started = datetime.datetime.utcnow()
     obj.state = "FETCH"
     obj.save()
@@ -534,7 +1877,7 @@ def fetch_and_import_stages(harvester, obj):
     elif obj.current is False:
         obj.report_status = 'deleted'
     elif len(
-        model.Session.query(HarvestObject)
+        model.Session.query(HarvestObject.id)
             .filter_by(package_id=obj.package_id)
             .limit(2)
             .all()
@@ -545,6 +1888,52 @@ def fetch_and_import_stages(harvester, obj):
     obj.save()
 
 
+def lean_fetch_and_import_stages(harvester, obj):
+    '''
+    Like `fetch_and_import_stages`, but only commits twice: when the fetch
+    stage starts, so an object whose consumer crashes is left in the FETCH
+    state with its retries counted, and when the final state is known. The
+    other timestamps are kept in memory until then.
+
+    The report status is worked out from whether the guid had a current
+    harvest object before the import, instead of querying the objects of
+    the package afterwards.
+    '''
+    obj.fetch_started = datetime.datetime.utcnow()
+    obj.state = "FETCH"
+    obj.save()
+    success_fetch = harvester.fetch_stage(obj)
+    obj.fetch_finished = datetime.datetime.utcnow()
+    if success_fetch is True:
+        existed = HarvestGuidState.get_for_guid(
+            obj.harvest_source_id, obj.guid) is not None
+        obj.import_started = datetime.datetime.utcnow()
+        obj.state = "IMPORT"
+        success_import = harvester.import_stage(obj)
+        obj.import_finished = datetime.datetime.utcnow()
+        if not success_import:
+            obj.state = "ERROR"
+            obj.report_status = 'errored'
+        elif success_import == 'unchanged':
+            obj.state = "COMPLETE"
+            obj.report_status = 'not modified'
+        else:
+            obj.state = "COMPLETE"
+            if obj.current is False:
+                obj.report_status = 'deleted'
+            elif existed:
+                obj.report_status = 'updated'
+            else:
+                obj.report_status = 'added'
+    elif success_fetch == 'unchanged':
+        obj.state = 'COMPLETE'
+        obj.report_status = 'not modified'
+    else:
+        obj.state = "ERROR"
+        obj.report_status = 'errored'
+    obj.save()
+
+
 def get_gather_consumer():
     gather_routing_key = get_gather_routing_key()
     consumer = get_consumer(get_gather_queue_name(), gather_routing_key)
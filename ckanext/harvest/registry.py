@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from collections import OrderedDict
+
+from ckan.plugins import PluginImplementations
+
+from ckanext.harvest.interfaces import IHarvester
+
+log = logging.getLogger(__name__)
+
+# Harvester plugins keyed by the name of the source type they handle, see
+# get_harvesters
+_harvesters = None
+_harvesters_lock = threading.Lock()
+
+
+def get_harvesters():
+    '''
+    Returns the loaded harvester plugins as an ordered dict keyed by the
+    ``name`` in their ``info()``, ie the source type they handle.
+
+    It is built the first time it's needed, so ``info()`` is only called
+    once per harvester, and rebuilt after plugins are loaded or unloaded
+    (see `reset`). If several harvesters have the same name, the first one
+    wins.
+    '''
+    global _harvesters
+    harvesters = _harvesters
+    if harvesters is not None:
+        return harvesters
+
+    with _harvesters_lock:
+        if _harvesters is None:
+            harvesters = OrderedDict()
+            for harvester in PluginImplementations(IHarvester):
+                try:
+                    info = harvester.info()
+                except AttributeError:
+                    continue
+                if not info or 'name' not in info:
+                    log.error('Harvester %s does not provide the harvester '
+                              'name in the info response' % harvester)
+                    continue
+                harvesters.setdefault(info['name'], harvester)
+            _harvesters = harvesters
+        return _harvesters
+
+
+def get_harvester(harvest_source_type):
+    '''
+    Returns the harvester plugin for the given source type, or None if there
+    isn't one.
+    '''
+    return get_harvesters().get(harvest_source_type)
+
+
+def reset():
+    '''
+    Forgets the registered harvesters, so they are looked up again on the
+    next call to `get_harvesters`.
+    '''
+    global _harvesters
+    with _harvesters_lock:
+        _harvesters = None
@@ -94,12 +94,13 @@ class MockCkanHandler(SimpleHTTPRequestHandler):
         # /api/3/action/package_search?fq=metadata_modified:[2015-10-23T14:51:13.282361Z TO *]&rows=1000
         if self.path.startswith('/api/action/package_search'):
             params = self.get_url_params()
+            count = None
 
             if self.test_name == 'datasets_added':
                 if params['start'] == '0':
                     # when page 1 is retrieved, the site only has 1 dataset
                     datasets = [DATASETS[0]['name']]
-                elif params['start'] == '100':
+                elif params['start'] == '1':
                     # when page 2 is retrieved, the site now has new datasets,
                     # and so the second page has the original dataset, pushed
                     # onto this page now, plus a new one
@@ -111,7 +112,23 @@ class MockCkanHandler(SimpleHTTPRequestHandler):
                 # ignore sort param for now
                 if 'sort' in params:
                     del params['sort']
-                if params['start'] != '0':
+                keyset_match = re.match(r'^\+id:\{"(.*)" TO \*\]$',
+                                        params.get('fq', ''))
+                if params['rows'] != '100' or keyset_match:
+                    # custom page size or keyset paging - page through the
+                    # datasets sorted by id
+                    last_id = keyset_match.group(1) if keyset_match else ''
+                    start = int(params['start'])
+                    rows = int(params['rows'])
+                    if self.test_name == 'rows_max':
+                        # the site returns at most 1 dataset per page,
+                        # whatever the rows requested
+                        rows = 1
+                    datasets = [d['id'] for d in sorted(DATASETS, key=lambda d: d['id'])
+                                if d['id'] > last_id]
+                    count = len(datasets)
+                    datasets = datasets[start:start + rows]
+                elif params['start'] != '0':
                     datasets = []
                 elif set(params.keys()) == set(['rows', 'start']):
                     datasets = ['dataset1', DATASETS[1]['name']]
@@ -139,7 +156,7 @@ class MockCkanHandler(SimpleHTTPRequestHandler):
                         'Not implemented search params %s' % params,
                         status=400)
 
-            out = {'count': len(datasets),
+            out = {'count': count if count is not None else len(datasets),
                    'results': [self.get_dataset(dataset_ref_)
                                for dataset_ref_ in datasets]}
             return self.respond_action(out)
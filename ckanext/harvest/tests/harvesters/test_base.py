@@ -8,6 +8,8 @@ except ImportError:
 
 
 from ckanext.harvest.harvesters.base import HarvesterBase, munge_tag
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.tests.factories import HarvestJobObj
 from ckantoolkit.tests import factories
 
 _ensure_name_is_unique = HarvesterBase._ensure_name_is_unique
@@ -113,6 +115,38 @@ class TestEnsureNameIsUnique(object):
         assert re.match(r'trees[\da-f]{5}', name)
 
 
+@pytest.mark.usefixtures('clean_db', 'clean_index', 'harvest_setup')
+class TestBulkCreateHarvestObjects(object):
+
+    def test_create_objects(self):
+        job = HarvestJobObj()
+        rows = [
+            {'guid': 'guid-1', 'content': '{"id": "guid-1"}'},
+            {'guid': 'guid-2', 'extras': {'status': 'delete'}},
+            {'guid': 'guid-3'},
+        ]
+
+        object_ids = HarvesterBase()._bulk_create_harvest_objects(
+            job, rows, batch_size=2)
+
+        assert len(object_ids) == 3
+        objects = [HarvestObject.get(object_id) for object_id in object_ids]
+        assert [obj.guid for obj in objects] == ['guid-1', 'guid-2', 'guid-3']
+        for obj in objects:
+            assert obj.harvest_job_id == job.id
+            assert obj.harvest_source_id == job.source.id
+            assert obj.state == 'WAITING'
+            assert obj.current is False
+        assert objects[0].content == '{"id": "guid-1"}'
+        assert objects[0].extras == []
+        assert [(e.key, e.value) for e in objects[1].extras] == [('status', 'delete')]
+
+    def test_no_rows(self):
+        job = HarvestJobObj()
+
+        assert HarvesterBase()._bulk_create_harvest_objects(job, []) == []
+
+
 # taken from ckan/tests/lib/test_munge.py
 class TestMungeTag:
 
@@ -17,10 +17,12 @@ from ckan.plugins import toolkit
 from ckanext.harvest.harvesters.ckanharvester import ContentFetchError
 from ckanext.harvest.tests.factories import (HarvestSourceObj, HarvestJobObj,
                                              HarvestObjectObj)
-from ckanext.harvest.tests.lib import run_harvest
+from ckanext.harvest.tests.lib import run_harvest, run_harvest_job
 import ckanext.harvest.model as harvest_model
+from ckanext.harvest.harvesters import ckanharvester
 from ckanext.harvest.harvesters.base import HarvesterBase
-from ckanext.harvest.harvesters.ckanharvester import CKANHarvester
+from ckanext.harvest.harvesters.ckanharvester import (CKANHarvester,
+                                                      get_source_config)
 
 from . import mock_ckan
 
@@ -55,6 +57,88 @@ class TestCkanHarvester(object):
         assert harvest_object.guid == mock_ckan.DATASETS[0]['id']
         assert json.loads(harvest_object.content) == mock_ckan.DATASETS[0]
 
+    def test_gather_stream(self):
+        source = HarvestSourceObj(url='http://localhost:%s/' % mock_ckan.PORT,
+                                  config=json.dumps({'stream_gather': True}))
+        job = HarvestJobObj(source=source)
+
+        harvester = CKANHarvester()
+        obj_ids_pages = list(harvester.gather_stage(job))
+
+        assert job.gather_errors == []
+        obj_ids = [obj_id for page in obj_ids_pages for obj_id in page]
+        assert len(obj_ids) == len(mock_ckan.DATASETS)
+        harvest_object = harvest_model.HarvestObject.get(obj_ids[0])
+        assert harvest_object.guid == mock_ckan.DATASETS[0]['id']
+        assert json.loads(harvest_object.content) == mock_ckan.DATASETS[0]
+
+    def test_harvest_stream_gather(self):
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester(),
+            config=json.dumps({'stream_gather': True}))
+
+        assert len(results_by_guid) == len(mock_ckan.DATASETS)
+        for dataset in mock_ckan.DATASETS:
+            result = results_by_guid[dataset['id']]
+            assert result['state'] == 'COMPLETE'
+            assert result['report_status'] == 'added'
+            assert result['errors'] == []
+
+    @pytest.mark.parametrize('paging', ['offset', 'keyset'])
+    def test_gather_search_paging(self, paging):
+        config = {'search_paging': paging, 'search_rows': 1}
+        source = HarvestSourceObj(url='http://localhost:%s/' % mock_ckan.PORT,
+                                  config=json.dumps(config))
+        job = HarvestJobObj(source=source)
+
+        harvester = CKANHarvester()
+        obj_ids = harvester.gather_stage(job)
+
+        assert job.gather_errors == []
+        guids = [harvest_model.HarvestObject.get(obj_id).guid
+                 for obj_id in obj_ids]
+        assert sorted(guids) == sorted(d['id'] for d in mock_ckan.DATASETS)
+
+    @pytest.mark.parametrize('paging', ['offset', 'keyset'])
+    def test_gather_search_rows_over_remote_max(self, paging):
+        config = {'search_paging': paging, 'search_rows': 2}
+        source = HarvestSourceObj(
+            url='http://localhost:%s/rows_max' % mock_ckan.PORT,
+            config=json.dumps(config))
+        job = HarvestJobObj(source=source)
+
+        harvester = CKANHarvester()
+        obj_ids = harvester.gather_stage(job)
+
+        assert job.gather_errors == []
+        guids = [harvest_model.HarvestObject.get(obj_id).guid
+                 for obj_id in obj_ids]
+        assert sorted(guids) == sorted(d['id'] for d in mock_ckan.DATASETS)
+
+    def test_gather_search_concurrency(self):
+        config = {'search_rows': 1, 'search_concurrency': 2}
+        source = HarvestSourceObj(url='http://localhost:%s/' % mock_ckan.PORT,
+                                  config=json.dumps(config))
+        job = HarvestJobObj(source=source)
+
+        harvester = CKANHarvester()
+        obj_ids = harvester.gather_stage(job)
+
+        assert job.gather_errors == []
+        guids = [harvest_model.HarvestObject.get(obj_id).guid
+                 for obj_id in obj_ids]
+        assert guids == sorted(d['id'] for d in mock_ckan.DATASETS)
+
+    def test_search_concurrency_shared_by_host(self):
+        semaphore = ckanharvester._get_host_semaphore(
+            'http://shared-host.example.com/a', 2)
+
+        assert ckanharvester._get_host_semaphore(
+            'http://SHARED-HOST.example.com/b', 5) is semaphore
+        assert ckanharvester._get_host_semaphore(
+            'http://other-host.example.com/', 2) is not semaphore
+
     def test_fetch_normal(self):
         source = HarvestSourceObj(url='http://localhost:%s/' % mock_ckan.PORT)
         job = HarvestJobObj(source=source)
@@ -103,6 +187,29 @@ class TestCkanHarvester(object):
         assert result['errors'] == []
         assert was_last_job_considered_error_free()
 
+    def test_harvest_caches_lookups_per_job(self):
+        harvester = CKANHarvester()
+        stats_by_job = {}
+        drop_job_caches = harvester._drop_job_caches
+
+        def record_stats(job_id):
+            stats_by_job[job_id] = harvester.get_job_cache_stats(job_id)
+            drop_job_caches(job_id)
+
+        with patch.object(harvester, '_drop_job_caches',
+                          side_effect=record_stats):
+            results_by_guid = run_harvest(
+                url='http://localhost:%s/' % mock_ckan.PORT,
+                harvester=harvester)
+
+        obj = harvest_model.HarvestObject.get(results_by_guid['dataset1-id']['obj_id'])
+        stats = stats_by_job[obj.harvest_job_id]
+        # the source owner org is only looked up for the first dataset
+        assert stats['source']['misses'] == 1
+        assert stats['source']['hits'] == len(mock_ckan.DATASETS) - 1
+        # the caches are dropped once the job has finished
+        assert harvester.get_job_cache_stats(obj.harvest_job_id) == {}
+
     def test_harvest_twice(self):
         run_harvest(
             url='http://localhost:%s/' % mock_ckan.PORT,
@@ -128,6 +235,192 @@ class TestCkanHarvester(object):
         assert mock_ckan.DATASETS[0]['id'] not in result
         assert was_last_job_considered_error_free()
 
+    @pytest.mark.ckan_config('ckan.harvest.lean_transitions', 'true')
+    def test_harvest_twice_lean_transitions(self):
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester())
+
+        result = results_by_guid[mock_ckan.DATASETS[1]['id']]
+        assert result['state'] == 'COMPLETE'
+        assert result['report_status'] == 'added'
+
+        datasets = copy.deepcopy(mock_ckan.DATASETS)
+        datasets[1]['metadata_modified'] = '2050-05-09T22:00:01.486366'
+        with patch('ckanext.harvest.tests.harvesters.mock_ckan.DATASETS',
+                   datasets):
+            results_by_guid = run_harvest(
+                url='http://localhost:%s/' % mock_ckan.PORT,
+                harvester=CKANHarvester())
+
+        result = results_by_guid[mock_ckan.DATASETS[1]['id']]
+        assert result['state'] == 'COMPLETE'
+        assert result['report_status'] == 'updated'
+        obj = harvest_model.HarvestObject.get(result['obj_id'])
+        assert obj.fetch_finished is not None
+        assert obj.import_finished is not None
+        assert was_last_job_considered_error_free()
+
+    def test_harvest_twice_guid_state(self):
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester())
+        first_obj = harvest_model.HarvestObject.get(
+            results_by_guid[mock_ckan.DATASETS[1]['id']]['obj_id'])
+
+        guid_state = harvest_model.HarvestGuidState.get_for_guid(
+            first_obj.harvest_source_id, first_obj.guid)
+        assert guid_state.harvest_object_id == first_obj.id
+        assert guid_state.package_id == first_obj.package_id
+
+        datasets = copy.deepcopy(mock_ckan.DATASETS)
+        datasets[1]['metadata_modified'] = '2050-05-09T22:00:01.486366'
+        with patch('ckanext.harvest.tests.harvesters.mock_ckan.DATASETS',
+                   datasets):
+            job = HarvestJobObj(source=first_obj.source, run=False)
+            results_by_guid = run_harvest_job(job, CKANHarvester())
+
+        second_obj_id = results_by_guid[mock_ckan.DATASETS[1]['id']]['obj_id']
+        guid_states = harvest_model.HarvestGuidState.for_source(
+            first_obj.harvest_source_id).all()
+        assert len(guid_states) == len(mock_ckan.DATASETS)
+        guid_state = harvest_model.HarvestGuidState.get_for_package(
+            first_obj.package_id)
+        assert guid_state.harvest_object_id == second_obj_id
+
+        missing = harvest_model.HarvestGuidState.not_in_guids(
+            first_obj.harvest_source_id, [first_obj.guid]).all()
+        assert first_obj.guid not in [s.guid for s in missing]
+        assert len(missing) == len(mock_ckan.DATASETS) - 1
+
+    def test_harvest_twice_deleted_remotely(self):
+        config = json.dumps({'force_all': True, 'search_rows': 50})
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester(),
+            config=config)
+        first_obj = harvest_model.HarvestObject.get(
+            results_by_guid[mock_ckan.DATASETS[1]['id']]['obj_id'])
+
+        # the second dataset is no longer available on the remote CKAN
+        with patch('ckanext.harvest.tests.harvesters.mock_ckan.DATASETS',
+                   mock_ckan.DATASETS[:1]):
+            job = HarvestJobObj(source=first_obj.source, run=False)
+            results_by_guid = run_harvest_job(job, CKANHarvester())
+
+        result = results_by_guid[mock_ckan.DATASETS[1]['id']]
+        assert result['state'] == 'COMPLETE'
+        assert result['report_status'] == 'deleted'
+        assert model.Package.get(first_obj.package_id).state == 'deleted'
+
+        result = results_by_guid['dataset1-id']
+        assert result['state'] == 'COMPLETE'
+
+    def test_packages_not_in_migrated_guid_state(self):
+        config = json.dumps({'force_all': True, 'search_rows': 50})
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester(),
+            config=config)
+        first_obj = harvest_model.HarvestObject.get(
+            results_by_guid[mock_ckan.DATASETS[1]['id']]['obj_id'])
+        source_id = first_obj.harvest_source_id
+
+        # Sites upgraded from a version without harvest_guid_state get it
+        # populated by the migration, which skips the objects with no guid
+        model.Session.execute(
+            "UPDATE harvest_object SET guid = '' WHERE id = :id",
+            {'id': first_obj.id})
+        model.Session.execute(
+            'DELETE FROM harvest_guid_state WHERE harvest_source_id = :id',
+            {'id': source_id})
+        model.Session.execute("""
+            INSERT INTO harvest_guid_state (harvest_source_id, guid,
+                harvest_object_id, package_id)
+            SELECT harvest_source_id, guid, id, package_id
+            FROM harvest_object
+            WHERE current = true AND harvest_source_id = :id
+                AND guid IS NOT NULL AND guid != ''""", {'id': source_id})
+        model.Session.commit()
+
+        # pending changes of the caller are not committed
+        model.Session.add(model.Package(name='not-committed'))
+        model.Session.flush()
+
+        remote_ids = [d['id'] for d in mock_ckan.DATASETS
+                      if d['id'] != first_obj.package_id]
+        packages = CKANHarvester()._get_packages_not_in(source_id, remote_ids)
+
+        assert [p['id'] for p in packages] == [first_obj.package_id]
+        model.Session.rollback()
+        assert model.Package.by_name('not-committed') is None
+
+    def test_harvest_twice_unchanged_content(self):
+        config = json.dumps({'skip_unchanged': True})
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester(),
+            config=config)
+        first_obj = harvest_model.HarvestObject.get(
+            results_by_guid['dataset1-id']['obj_id'])
+
+        # change the content of one dataset only, and gather all of them
+        datasets = copy.deepcopy(mock_ckan.DATASETS)
+        datasets[1]['notes'] = 'Updated notes'
+        with patch('ckanext.harvest.tests.harvesters.mock_ckan.DATASETS',
+                   datasets), \
+                patch.object(CKANHarvester, '_get_fq_since_last_time',
+                             return_value=None):
+            job = HarvestJobObj(source=first_obj.source, run=False)
+            results_by_guid = run_harvest_job(job, CKANHarvester())
+
+        result = results_by_guid['dataset1-id']
+        assert result['state'] == 'COMPLETE'
+        assert result['report_status'] == 'not modified'
+        assert result['errors'] == []
+        # the first object is still the current one
+        assert harvest_model.HarvestObject.get(first_obj.id).current is True
+
+        result = results_by_guid[mock_ckan.DATASETS[1]['id']]
+        assert result['state'] == 'COMPLETE'
+        assert result['report_status'] == 'updated'
+        assert result['dataset']['notes'] == 'Updated notes'
+
+    def test_harvest_twice_force_all_not_skipped(self):
+        config = json.dumps({'skip_unchanged': True, 'force_all': True})
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester(),
+            config=config)
+        source = harvest_model.HarvestObject.get(
+            results_by_guid['dataset1-id']['obj_id']).source
+
+        with patch.object(CKANHarvester, '_is_unchanged') as is_unchanged:
+            job = HarvestJobObj(source=source, run=False)
+            results_by_guid = run_harvest_job(job, CKANHarvester())
+
+        assert not is_unchanged.called
+        assert results_by_guid['dataset1-id']['state'] == 'COMPLETE'
+
+    def test_unchanged_with_force_import(self):
+        config = json.dumps({'skip_unchanged': True})
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester(),
+            config=config)
+        first_obj = harvest_model.HarvestObject.get(
+            results_by_guid['dataset1-id']['obj_id'])
+
+        job = HarvestJobObj(source=first_obj.source, run=False)
+        obj = HarvestObjectObj(guid=first_obj.guid, job=job,
+                               content=first_obj.content)
+        obj.content_hash = first_obj.content_hash
+        harvester = CKANHarvester()
+        assert harvester._is_unchanged(obj)
+
+        job.force_import = first_obj.guid
+        assert not harvester._is_unchanged(obj)
+
     def test_exclude_organizations(self):
         config = {'organizations_filter_exclude': ['org1']}
         results_by_guid = run_harvest(
@@ -323,9 +616,15 @@ class TestCkanHarvester(object):
                 config=json.dumps(config))
         assert 'default_extras must be a dictionary' in str(harvest_context.value)
 
-    @patch('ckanext.harvest.harvesters.ckanharvester.pyopenssl.inject_into_urllib3')
+    @pytest.mark.parametrize('weight', ['2', 0, -1])
+    def test_fetch_weight_invalid(self, weight):
+        with pytest.raises(ValueError) as context:
+            CKANHarvester().validate_config(json.dumps({'fetch_weight': weight}))
+        assert 'fetch_weight must be a positive integer' in str(context.value)
+
+    @patch('ckanext.harvest.harvesters.base.pyopenssl.inject_into_urllib3')
     @patch('ckanext.harvest.harvesters.ckanharvester.CKANHarvester.config')
-    @patch('ckanext.harvest.harvesters.ckanharvester.requests.get', side_effect=RequestException('Test.value'))
+    @patch('ckanext.harvest.harvesters.base.requests.Session.get', side_effect=RequestException('Test.value'))
     def test_get_content_handles_request_exception(
         self, mock_requests_get, mock_config, mock_pyopenssl_inject
     ):
@@ -338,6 +637,22 @@ class TestCkanHarvester(object):
 
         assert str(context.value) == 'Request error: Test.value'
 
+    def test_get_content_reuses_http_session(self):
+        harvester = CKANHarvester()
+        harvester.config = {'http_timeout': [5, 30], 'http_retries': 0}
+        url = 'http://localhost:%s/api/action/package_list' % mock_ckan.PORT
+
+        harvester._get_content(url)
+        session = harvester._get_http_session(url)
+        stats_before = harvester.get_http_stats()
+        harvester._get_content(url)
+        stats_after = harvester.get_http_stats()
+
+        assert harvester._get_http_session(url) is session
+        assert stats_after['requests'] == stats_before['requests'] + 1
+        assert stats_after['bytes'] > stats_before['bytes']
+        assert stats_after['errors'] == stats_before['errors']
+
     class MockHTTPError(HTTPError):
         def __init__(self):
             self.response = Mock()
@@ -345,9 +660,9 @@ class TestCkanHarvester(object):
             self.request = Mock()
             self.request.url = "http://test.example.gov.uk"
 
-    @patch('ckanext.harvest.harvesters.ckanharvester.pyopenssl.inject_into_urllib3')
+    @patch('ckanext.harvest.harvesters.base.pyopenssl.inject_into_urllib3')
     @patch('ckanext.harvest.harvesters.ckanharvester.CKANHarvester.config')
-    @patch('ckanext.harvest.harvesters.ckanharvester.requests.get', side_effect=MockHTTPError())
+    @patch('ckanext.harvest.harvesters.base.requests.Session.get', side_effect=MockHTTPError())
     def test_get_content_handles_http_error(
         self, mock_requests_get, mock_config, mock_pyopenssl_inject
     ):
@@ -359,3 +674,43 @@ class TestCkanHarvester(object):
             harvester._get_content("http://test.example.gov.uk")
 
         assert str(context.value) == 'HTTP error: 404 http://test.example.gov.uk'
+
+
+class TestSourceConfig(object):
+
+    def test_parsed_once_per_source_and_config(self):
+        config = json.dumps({'organizations_filter_exclude': ['org1', 'org2'],
+                             'default_extras': {'url': '{harvest_source_url}/x',
+                                                'count': 1}})
+
+        source_config = get_source_config('source-1', config)
+
+        assert get_source_config('source-1', config) is source_config
+        assert get_source_config('source-2', config) is not source_config
+        assert get_source_config('source-1', '{}') is not source_config
+        assert source_config.fq_terms == ('-organization:org1', '-organization:org2')
+        assert sorted(source_config.default_extras) == [
+            ('count', 1, False), ('url', '{harvest_source_url}/x', True)]
+
+    def test_read_only(self):
+        source_config = get_source_config('source-1', '{"read_only": true}')
+
+        with pytest.raises(TypeError):
+            source_config.config['read_only'] = False
+        assert source_config.config == {'read_only': True}
+
+    def test_harvester_config_is_a_mutable_copy(self):
+        harvester = CKANHarvester()
+        harvester._set_config('{"default_tags": [{"name": "a"}]}', 'source-1')
+
+        harvester.config['default_tags'].append({'name': 'b'})
+        harvester.config['api_key'] = 'xyz'
+
+        source_config = get_source_config(
+            'source-1', '{"default_tags": [{"name": "a"}]}')
+        assert source_config.config == {'default_tags': [{'name': 'a'}]}
+        assert harvester._get_source_config().default_tags == (
+            {'name': 'a'}, {'name': 'b'})
+
+        harvester.config = {}
+        assert harvester._get_source_config().default_tags == ()
@@ -1,6 +1,10 @@
 import json
 import datetime
 import pytest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
 
 from ckan import plugins as p
 from ckan import model
@@ -506,6 +510,103 @@ class TestActions():
         assert dataset_from_db_2
         assert dataset_from_db_2.id == dataset2['id']
 
+    @pytest.mark.parametrize('guid', ['object-guid', None])
+    def test_harvest_object_show_by_dataset(self, guid):
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        dataset = ckan_factories.Dataset()
+        obj = factories.HarvestObjectObj(
+            job=job, source=source, guid=guid, package_id=dataset['id'])
+        obj.current = True
+        obj.save()
+
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True, 'user': ''}
+        result = get_action('harvest_object_show')(
+            context, {'dataset_id': dataset['id']})
+
+        assert result['id'] == obj.id
+
+    def test_harvest_job_abort(self):
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        waiting = factories.HarvestObjectObj(job=job, source=source)
+        complete = factories.HarvestObjectObj(job=job, source=source)
+        complete.state = 'COMPLETE'
+        complete.save()
+        job_id, waiting_id, complete_id = job.id, waiting.id, complete.id
+
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True, 'user': ''}
+        result = get_action('harvest_job_abort')(context, {'id': job_id})
+
+        assert result['status'] == 'Finished'
+        assert harvest_model.HarvestObject.get(waiting_id).state == 'ERROR'
+        assert harvest_model.HarvestObject.get(complete_id).state == 'COMPLETE'
+        stats = harvest_model.HarvestJobStats.get(job_id)
+        assert (stats.total, stats.waiting) == (2, 0)
+
+    @pytest.mark.parametrize('action', ['harvest_source_clear',
+                                        'harvest_source_job_history_clear'])
+    def test_raw_sql_deletes_rebuild_job_stats(self, action):
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True, 'user': ''}
+
+        with patch('ckanext.harvest.logic.action.update.rebuild_job_stats') \
+                as rebuild_job_stats:
+            get_action(action)(context, {'id': source.id})
+
+        rebuild_job_stats.assert_called_once_with(source_id=source.id)
+
+    def test_harvest_jobs_run_finishes_jobs(self):
+        jobs = []
+        for i in range(2):
+            data_dict = SOURCE_DICT.copy()
+            data_dict['name'] = 'test-source-jobs-run-{}'.format(i)
+            data_dict['url'] = 'http://jobs-run-{}.test.com'.format(i)
+            source = factories.HarvestSourceObj(**data_dict)
+            job = factories.HarvestJobObj(source=source)
+            obj = factories.HarvestObjectObj(job=job, source=source)
+            job.status = 'Running'
+            job.gather_finished = datetime.datetime.utcnow()
+            job.save()
+            jobs.append((job, obj))
+        finished_job, finished_obj = jobs[0]
+        finished_obj.state = 'COMPLETE'
+        finished_obj.import_finished = datetime.datetime.utcnow()
+        finished_obj.save()
+        finished_id, running_id = finished_job.id, jobs[1][0].id
+        import_finished = finished_obj.import_finished
+
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True, 'user': ''}
+        get_action('harvest_jobs_run')(context, {})
+
+        finished_job = harvest_model.HarvestJob.get(finished_id)
+        assert finished_job.status == 'Finished'
+        assert finished_job.finished == import_finished
+        assert harvest_model.HarvestJob.get(running_id).status == 'Running'
+
+    def test_harvest_jobs_run_checks_objects_over_stats(self):
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        factories.HarvestObjectObj(job=job, source=source)
+        job.status = 'Running'
+        job.gather_finished = datetime.datetime.utcnow()
+        job.save()
+        job_id = job.id
+        # the counters are out of sync, eg after changes made with plain SQL
+        model.Session.execute(
+            "UPDATE harvest_job_stats SET waiting = 0, in_progress = 0")
+        model.Session.commit()
+
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True, 'user': ''}
+        get_action('harvest_jobs_run')(context, {})
+
+        assert harvest_model.HarvestJob.get(job_id).status == 'Running'
+
     def test_harvest_abort_failed_jobs_without_failed_jobs(self):
         # prepare
         data_dict = SOURCE_DICT.copy()
@@ -0,0 +1,53 @@
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from ckanext.harvest.cache import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_get_and_set(self):
+        cache = LRUCache(maxsize=10)
+        cache.set('a', 1)
+
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('b', 'default') == 'default'
+        assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 1, 'maxsize': 10}
+
+    def test_least_recently_used_is_discarded(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert len(cache) == 2
+
+    def test_get_or_set(self):
+        cache = LRUCache()
+        calls = []
+
+        def lookup():
+            calls.append(1)
+            return None
+
+        assert cache.get_or_set('a', lookup) is None
+        assert cache.get_or_set('a', lookup) is None
+        assert len(calls) == 1
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=60)
+        with patch('ckanext.harvest.cache.time.time', return_value=1000):
+            cache.set('a', 1)
+        with patch('ckanext.harvest.cache.time.time', return_value=1059):
+            assert cache.get('a') == 1
+        with patch('ckanext.harvest.cache.time.time', return_value=1061):
+            assert cache.get('a') is None
@@ -0,0 +1,123 @@
+import datetime
+
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+
+import ckanext.harvest.model as harvest_model
+from ckanext.harvest.harvesters.base import HarvesterBase
+from ckanext.harvest.tests import factories
+
+
+@pytest.mark.usefixtures('clean_db', 'harvest_setup')
+class TestIndexes(object):
+
+    def _valid_indexes(self):
+        return dict(model.Session.execute('''
+            SELECT c.relname, i.indisvalid
+            FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+            ''').fetchall())
+
+    def test_indexes_created(self):
+        indexes = self._valid_indexes()
+        for table, name, definition in harvest_model.INDEXES:
+            assert indexes.get(name) is True
+
+    def test_missing_indexes_created_again(self):
+        model.Session.execute(
+            'DROP INDEX harvest_object_job_id_state_idx')
+        model.Session.commit()
+
+        assert harvest_model.get_missing_indexes() == [
+            'harvest_object_job_id_state_idx']
+
+        harvest_model.create_indexes()
+
+        assert self._valid_indexes().get(
+            'harvest_object_job_id_state_idx') is True
+        assert harvest_model.get_missing_indexes() == []
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_harvester')
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup')
+class TestJobStats(object):
+
+    def _stats(self, job_id):
+        model.Session.expire_all()
+        stats = harvest_model.HarvestJobStats.get(job_id)
+        return dict((column.name, getattr(stats, column.name))
+                    for column in harvest_model.harvest_job_stats_table.c)
+
+    def test_counters_match_rebuild(self):
+        job = factories.HarvestJobObj()
+        waiting = factories.HarvestObjectObj(job=job)
+        added = factories.HarvestObjectObj(job=job)
+        errored = factories.HarvestObjectObj(job=job)
+        added.state = 'COMPLETE'
+        added.report_status = 'added'
+        added.import_finished = datetime.datetime.utcnow()
+        added.save()
+        errored.state = 'ERROR'
+        errored.report_status = 'errored'
+        errored.save()
+        for message in ('First error', 'Second error'):
+            harvest_model.HarvestObjectError(
+                message=message, object=errored).save()
+        harvest_model.HarvestGatherError(message='Error', job=job).save()
+        job_id, waiting_id = job.id, waiting.id
+
+        stats = self._stats(job_id)
+        assert stats['total'] == 3
+        assert stats['waiting'] == 1
+        assert stats['added'] == 1
+        assert stats['errored'] == 1
+        assert stats['error_objects'] == 1
+        assert stats['gather_errors'] == 1
+        assert stats['last_completed'] == added.import_finished
+
+        harvest_model.HarvestObject.get(waiting_id).delete()
+        model.Session.commit()
+        stats = self._stats(job_id)
+        assert stats['total'] == 2
+        assert stats['waiting'] == 0
+
+        harvest_model.rebuild_job_stats(job_id)
+        assert self._stats(job_id) == stats
+
+    def test_objects_of_one_flush_are_counted(self):
+        job = factories.HarvestJobObj()
+        job_id = job.id
+        for i in range(3):
+            model.Session.add(harvest_model.HarvestObject(
+                guid='guid-%s' % i, job=job, source=job.source))
+        model.Session.commit()
+
+        stats = self._stats(job_id)
+        assert stats['total'] == 3
+        assert stats['waiting'] == 3
+        harvest_model.rebuild_job_stats(job_id)
+        assert self._stats(job_id) == stats
+
+    def test_bulk_created_objects_are_counted(self):
+        job = factories.HarvestJobObj()
+        job_id = job.id
+        HarvesterBase()._bulk_create_harvest_objects(
+            job, [{'guid': 'guid-%s' % i} for i in range(3)], batch_size=2)
+
+        stats = self._stats(job_id)
+        assert stats['total'] == 3
+        assert stats['waiting'] == 3
+        assert stats['last_gathered'] is not None
+        harvest_model.rebuild_job_stats(job_id)
+        assert self._stats(job_id) == stats
+
+        # the job is not finished while its objects are waiting
+        job = harvest_model.HarvestJob.get(job_id)
+        job.status = 'Running'
+        job.gather_finished = datetime.datetime.utcnow()
+        job.save()
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True, 'user': ''}
+        toolkit.get_action('harvest_jobs_run')(context, {})
+        assert harvest_model.HarvestJob.get(job_id).status == 'Running'
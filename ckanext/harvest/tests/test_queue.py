@@ -5,6 +5,7 @@ except ImportError:
     from mock import patch
 
 from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+from ckanext.harvest.tests.factories import HarvestObjectObj, HarvestJobObj
 from ckanext.harvest.interfaces import IHarvester
 import ckanext.harvest.queue as queue
 from ckan.plugins.core import SingletonPlugin, implements
@@ -259,6 +260,230 @@ class TestHarvestQueue(object):
         finally:
             redis.delete('ckanext-harvest:some-random-key')
 
+    def test_redis_send_many(self):
+        '''
+        Test that messages sent in batches arrive to the fetch queue in order.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        fetch_routing_key = queue.get_fetch_routing_key()
+        ids = [str(uuid.uuid4()) for i in range(5)]
+
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send_many(
+            ({'harvest_object_id': id} for id in ids), batch_size=2)
+
+        assert redis.llen(fetch_routing_key) == 5
+        assert [json.loads(value)['harvest_object_id'] for value
+                in redis.lrange(fetch_routing_key, 0, -1)] == ids
+        assert queue.get_connection() is redis
+
+    def test_redis_gather_queue_deduplication(self):
+        '''
+        Test that a job sent again to the gather queue replaces the message
+        already there, even if it is sent with a different priority.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        gather_routing_key = queue.get_gather_routing_key()
+        redis.delete(gather_routing_key)
+        job_id, other_job_id = str(uuid.uuid4()), str(uuid.uuid4())
+
+        gather_publisher = queue.get_gather_publisher()
+        gather_publisher.send({'harvest_job_id': job_id})
+        gather_publisher.send({'harvest_job_id': other_job_id})
+        gather_publisher.send({'harvest_job_id': job_id, 'priority': True})
+
+        assert [json.loads(value) for value
+                in redis.lrange(gather_routing_key, 0, -1)] == [
+            {'harvest_job_id': other_job_id},
+            {'harvest_job_id': job_id, 'priority': True}]
+        redis.delete(gather_routing_key)
+
+    @pytest.mark.ckan_config('ckan.harvest.mq.reliable', 'true')
+    def test_redis_reliable_queue_leases(self):
+        '''
+        Test that leased messages are requeued if they are not acknowledged
+        in time.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        fetch_routing_key = queue.get_fetch_routing_key()
+        lease_key = queue.get_lease_key(fetch_routing_key)
+        redis.delete(lease_key)
+
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send({'harvest_object_id': str(uuid.uuid4())})
+
+        fetch_consumer = queue.get_fetch_consumer()
+        method, _, body = fetch_consumer.basic_get(queue.get_fetch_queue_name())
+        assert redis.llen(fetch_routing_key) == 0
+        assert redis.zcard(lease_key) == 1
+
+        # the lease has not expired yet
+        queue.resubmit_jobs()
+        assert redis.llen(fetch_routing_key) == 0
+
+        # the consumer died and the lease expired
+        redis.zadd(lease_key, {method.delivery_tag: 0})
+        queue.resubmit_jobs()
+        assert redis.lrange(fetch_routing_key, 0, -1) == [body]
+        assert redis.zcard(lease_key) == 0
+
+        method, _, body = fetch_consumer.basic_get(queue.get_fetch_queue_name())
+        fetch_consumer.basic_ack(method.delivery_tag)
+        assert redis.llen(fetch_routing_key) == 0
+        assert redis.zcard(lease_key) == 0
+
+        # duplicate messages get a lease each
+        message = {'harvest_object_id': str(uuid.uuid4())}
+        fetch_publisher.send(message)
+        fetch_publisher.send(message)
+        method, _, _ = fetch_consumer.basic_get(queue.get_fetch_queue_name())
+        other_method, _, _ = fetch_consumer.basic_get(queue.get_fetch_queue_name())
+        assert redis.zcard(lease_key) == 2
+        fetch_consumer.basic_ack(method.delivery_tag)
+        assert redis.zcard(lease_key) == 1
+        fetch_consumer.basic_ack(other_method.delivery_tag)
+        assert redis.zcard(lease_key) == 0
+
+    @pytest.mark.parametrize('reliable', [
+        False,
+        pytest.param(True, marks=pytest.mark.ckan_config(
+            'ckan.harvest.mq.reliable', 'true'))])
+    def test_redis_basic_reject(self, reliable):
+        '''
+        Test that a rejected message is sent back to the head of the queue.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        fetch_routing_key = queue.get_fetch_routing_key()
+        redis.delete(fetch_routing_key)
+        ids = [str(uuid.uuid4()) for i in range(2)]
+
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send_many({'harvest_object_id': id} for id in ids)
+        fetch_consumer = queue.get_fetch_consumer()
+        method, _, body = fetch_consumer.basic_get(queue.get_fetch_queue_name())
+        fetch_consumer.basic_reject(method.delivery_tag)
+        if reliable:
+            # the lease is gone, so it is not sent back twice
+            fetch_consumer.basic_reject(method.delivery_tag)
+            assert redis.zcard(queue.get_lease_key(fetch_routing_key)) == 0
+
+        assert [json.loads(value)['harvest_object_id'] for value
+                in redis.lrange(fetch_routing_key, 0, -1)] == ids
+        redis.delete(fetch_routing_key)
+
+    @pytest.mark.ckan_config('ckan.harvest.mq.fair', 'true')
+    def test_redis_fair_queue(self):
+        '''
+        Test that the fetch messages of each source are consumed in turns,
+        according to their weight, and that priority ones go first.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        fetch_consumer = queue.get_fetch_consumer()
+        fetch_consumer.queue_purge()
+
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send_many(
+            ({'harvest_object_id': 'big-%s' % i} for i in range(5)),
+            source_id='big', weight=2)
+        fetch_publisher.send_many(
+            ({'harvest_object_id': 'small-%s' % i} for i in range(2)),
+            source_id='small')
+        fetch_publisher.send_many([{'harvest_object_id': 'manual'}],
+                                  source_id='manual', priority=True)
+
+        received = []
+        while True:
+            method, _, body = fetch_consumer.basic_get(
+                queue.get_fetch_queue_name())
+            if body is None:
+                break
+            received.append(json.loads(body)['harvest_object_id'])
+
+        assert received == ['manual', 'big-0', 'big-1', 'small-0',
+                            'big-2', 'big-3', 'small-1', 'big-4']
+        assert fetch_consumer.get_fair_keys() == [
+            queue.get_fair_key(queue.get_fetch_routing_key(), 'priority')]
+
+    @pytest.mark.ckan_config('ckan.harvest.gather.max_per_host', '1')
+    def test_gather_host_limit(self):
+        with queue._gather_host_slot('http://remote.example.com/a') as acquired:
+            assert acquired
+            with queue._gather_host_slot('http://REMOTE.example.com/b') as acquired:
+                assert not acquired
+            with queue._gather_host_slot('http://other.example.com/') as acquired:
+                assert acquired
+
+        with queue._gather_host_slot('http://remote.example.com/b') as acquired:
+            assert acquired
+
+    def test_send_back_gather_jobs(self):
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        gather_consumer = queue.get_gather_consumer()
+        gather_consumer.queue_purge()
+        message = {'harvest_job_id': str(uuid.uuid4()), 'host_retries': 1}
+
+        queue._send_back_gather_job(message, 60)
+        method, _, body = gather_consumer.basic_get(
+            queue.get_gather_queue_name())
+        assert body is None
+
+        # the jobs waiting are sent when the consumer stops
+        queue.send_back_gather_jobs()
+        method, _, body = gather_consumer.basic_get(
+            queue.get_gather_queue_name())
+        assert json.loads(body) == message
+        gather_consumer.basic_ack(method.delivery_tag)
+        assert queue._gather_retry_timers == {}
+
+    def test_gather_stage_failure_keeps_published_objects(self):
+        job = HarvestJobObj()
+
+        class FailingHarvester(object):
+            def gather_stage(self, harvest_job):
+                published = HarvestObject(guid='published', job=harvest_job)
+                published.save()
+                yield [published.id]
+                HarvestObject(guid='unpublished', job=harvest_job).save()
+                raise Exception('Remote server gone')
+
+        class MockPublisher(object):
+            sent = []
+
+            def send_many(self, bodies, **kw):
+                self.sent.extend(bodies)
+
+        publisher = MockPublisher()
+        with pytest.raises(Exception):
+            queue.gather_stage(FailingHarvester(), job, publisher)
+
+        guids = [obj.guid for obj in model.Session.query(HarvestObject)
+                 .filter_by(harvest_job_id=job.id)]
+        assert guids == ['published']
+        assert len(publisher.sent) == 1
+
+    def test_job_status_cache(self):
+        job = HarvestJobObj()
+        assert queue.get_job_status(job.id) == 'New'
+
+        job.status = 'Running'
+        job.save()
+        # still cached
+        assert queue.get_job_status(job.id) == 'New'
+
+        queue.notify_jobs_finished([job.id])
+        model.Session.commit()
+        assert queue.get_job_status(job.id) == 'Finished'
+
     def test_resubmit_objects(self):
         '''
         Test that only harvest objects re-submitted which were not be present in the redis fetch queue.
@@ -416,3 +641,82 @@ class TestHarvestCorruptRedis(object):
 
         finally:
             redis.delete('ckanext-harvest:some-random-key-2')
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'harvest_setup', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_harvester')
+@pytest.mark.ckan_config('ckan.harvest.mq.type', 'db')
+class TestHarvestDBQueue(object):
+
+    def test_send_claim_and_ack(self):
+        ids = [str(uuid.uuid4()) for i in range(3)]
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send_many({'harvest_object_id': id} for id in ids)
+
+        consumer = queue.get_fetch_consumer()
+        other_consumer = queue.get_fetch_consumer()
+        method, channel, body = consumer.basic_get(queue.get_fetch_queue_name())
+        assert json.loads(body)['harvest_object_id'] == ids[0]
+
+        # leased messages are not delivered to other consumers
+        messages = other_consumer.claim()
+        assert [json.loads(body)['harvest_object_id']
+                for message_id, body in messages] == ids[1:]
+        assert other_consumer.claim() == []
+
+        channel.basic_ack(method.delivery_tag)
+        for message_id, body in messages:
+            other_consumer.basic_ack(message_id)
+        assert consumer.queue_purge() == 0
+
+    def test_expired_lease(self):
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send({'harvest_object_id': str(uuid.uuid4())})
+
+        consumer = queue.get_fetch_consumer()
+        method, _, body = consumer.basic_get(queue.get_fetch_queue_name())
+        assert consumer.claim() == []
+
+        # the consumer died and the lease expired
+        model.Session.execute(
+            "UPDATE harvest_queue SET lease_expires = '2000-01-01'")
+        model.Session.commit()
+
+        assert consumer.claim() == [(method.delivery_tag, body)]
+
+    def test_lease_per_message(self):
+        ids = [str(uuid.uuid4()) for i in range(3)]
+        fetch_publisher = queue.get_fetch_publisher()
+        fetch_publisher.send_many({'harvest_object_id': id} for id in ids)
+
+        consumer = queue.get_fetch_consumer()
+        other_consumer = queue.get_fetch_consumer()
+        messages = consumer.consume(queue.get_fetch_queue_name())
+        _, _, body = next(messages)
+        assert json.loads(body)['harvest_object_id'] == ids[0]
+
+        # the lease of the second message expired while the consumer was
+        # busy with the first one, so it was claimed by another consumer
+        model.Session.execute(
+            "UPDATE harvest_queue SET lease_expires = '2000-01-01' "
+            "WHERE body LIKE :id", {'id': '%' + ids[1] + '%'})
+        model.Session.commit()
+        assert [json.loads(body)['harvest_object_id']
+                for message_id, body in other_consumer.claim()] == [ids[1]]
+
+        _, _, body = next(messages)
+        assert json.loads(body)['harvest_object_id'] == ids[2]
+
+    def test_resubmit_objects(self):
+        harvest_object = HarvestObjectObj()
+        queue.get_fetch_publisher().send(
+            {'harvest_object_id': harvest_object.id})
+        other_harvest_object = HarvestObjectObj()
+
+        queue.resubmit_objects()
+
+        consumer = queue.get_fetch_consumer()
+        messages = consumer.claim()
+        assert sorted(json.loads(body)['harvest_object_id']
+                      for message_id, body in messages) == \
+            sorted([harvest_object.id, other_harvest_object.id])
@@ -0,0 +1,123 @@
+import json
+import threading
+
+import pytest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import ckanext.harvest.queue as queue
+
+fakeredis = pytest.importorskip('fakeredis')
+
+ROUTING_KEY = 'ckanext-harvest:default:harvest_object_id'
+
+
+class TestRedisStreamsQueue(object):
+
+    def setup_method(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        self.publisher = queue.RedisStreamsPublisher(self.redis, ROUTING_KEY)
+
+    def _consumer(self, name):
+        consumer = queue.RedisStreamsConsumer(self.redis, ROUTING_KEY)
+        consumer.consumer = name
+        return consumer
+
+    def test_send_and_consume(self):
+        ids = [str(i) for i in range(15)]
+        self.publisher.send_many(
+            ({'harvest_object_id': id} for id in ids), batch_size=4)
+        self.publisher.send({'harvest_object_id': 'last'})
+
+        consumer = self._consumer('worker-1')
+        messages = consumer.consume(queue.get_fetch_queue_name())
+        received = [json.loads(next(messages)[2])['harvest_object_id']
+                    for i in range(16)]
+
+        assert received == ids + ['last']
+
+    def test_ack(self):
+        self.publisher.send({'harvest_object_id': '1'})
+        self.publisher.send({'harvest_object_id': '2'})
+        consumer = self._consumer('worker-1')
+
+        method, channel, body = consumer.basic_get(queue.get_fetch_queue_name())
+        assert json.loads(body)['harvest_object_id'] == '1'
+        assert consumer.stats() == {
+            'length': 2, 'pending': 1, 'consumers': {'worker-1': 1}}
+
+        channel.basic_ack(method.delivery_tag)
+        assert consumer.stats() == {
+            'length': 1, 'pending': 0, 'consumers': {}}
+
+    def test_claim_messages_of_crashed_consumer(self):
+        self.publisher.send({'harvest_object_id': '1'})
+        crashed = self._consumer('worker-1')
+        crashed.basic_get(queue.get_fetch_queue_name())
+
+        consumer = self._consumer('worker-2')
+        # the lease of the crashed consumer has not expired yet
+        assert consumer.claim() == []
+
+        consumer.lease_time = 0
+        messages = consumer.claim()
+        assert [json.loads(body)['harvest_object_id']
+                for message_id, body in messages] == ['1']
+        assert consumer.stats()['consumers'] == {'worker-2': 1}
+
+    def test_queue_purge(self):
+        self.publisher.send_many({'harvest_object_id': str(i)} for i in range(3))
+        consumer = self._consumer('worker-1')
+        consumer.basic_get(queue.get_fetch_queue_name())
+
+        assert consumer.queue_purge() == 3
+        assert consumer.stats() == {'length': 0, 'pending': 0, 'consumers': {}}
+        method, channel, body = consumer.basic_get(queue.get_fetch_queue_name())
+        assert body is None
+
+    def test_consumer_names_per_thread(self):
+        consumers = []
+
+        def create_consumer():
+            consumers.append(
+                queue.RedisStreamsConsumer(self.redis, ROUTING_KEY))
+
+        threads = [threading.Thread(target=create_consumer) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert consumers[0].consumer != consumers[1].consumer
+
+    def test_requeue_expired_messages(self):
+        self.publisher.send_many({'harvest_object_id': str(i)} for i in range(3))
+        crashed = self._consumer('worker-1')
+        crashed.read(count=2)
+
+        # the messages have not been pending for long enough
+        assert queue.requeue_expired_stream_messages(
+            self.redis, ROUTING_KEY) == 0
+
+        with patch.object(queue, 'FETCH_LEASE_TIME', 0):
+            assert queue.requeue_expired_stream_messages(
+                self.redis, ROUTING_KEY, batch_size=1) == 2
+
+        consumer = self._consumer('worker-2')
+        assert consumer.stats() == {'length': 3, 'pending': 0, 'consumers': {}}
+        assert [json.loads(body)['harvest_object_id']
+                for message_id, body in consumer.read()] == ['2', '0', '1']
+
+    def test_index_message_ids(self):
+        self.publisher.send_many({'harvest_object_id': str(i)} for i in range(5))
+        self._consumer('worker-1').read(count=2)
+        self.redis.xadd(queue.get_stream_key(ROUTING_KEY), {'body': 'invalid'})
+
+        with patch.object(queue, 'RESUBMIT_BATCH_SIZE', 2):
+            queue.index_stream_message_ids(self.redis, ROUTING_KEY, 'queued')
+
+        # both the new and the pending messages
+        assert self.redis.smembers('queued') == set(
+            str(i) for i in range(5))
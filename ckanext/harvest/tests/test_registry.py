@@ -0,0 +1,28 @@
+import pytest
+
+from ckan import plugins as p
+
+from ckanext.harvest import registry
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_action_harvester')
+@pytest.mark.usefixtures('with_plugins')
+class TestHarvesterRegistry(object):
+
+    def test_get_harvester(self):
+        harvester = registry.get_harvester('test-for-action')
+
+        assert harvester.info()['name'] == 'test-for-action'
+        assert registry.get_harvester('unknown-type') is None
+
+    def test_rebuilt_when_plugins_change(self):
+        assert 'test-for-action' in registry.get_harvesters()
+        assert 'test' not in registry.get_harvesters()
+
+        p.load('test_harvester')
+        try:
+            assert registry.get_harvester('test').info()['name'] == 'test'
+        finally:
+            p.unload('test_harvester')
+
+        assert 'test' not in registry.get_harvesters()
@@ -0,0 +1,107 @@
+from ckanext.harvest.queue import FakeMethod
+from ckanext.harvest.workers import ConsumerWorker
+
+
+class MockConsumer(object):
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.acked = []
+
+    def consume(self, queue):
+        i = 0
+        while True:
+            i += 1
+            if self.fail_after and i > self.fail_after:
+                raise Exception('Connection lost')
+            yield (i, self, 'message %s' % i)
+
+
+class MockRejectConsumer(object):
+
+    def __init__(self, on_message=None):
+        self.on_message = on_message
+        self.acked = []
+        self.rejected = []
+
+    def consume(self, queue):
+        i = 0
+        while True:
+            i += 1
+            if self.on_message:
+                self.on_message(i)
+            yield (FakeMethod(i), self, 'message %s' % i)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.rejected.append((delivery_tag, requeue))
+
+
+class TestConsumerWorker(object):
+
+    def test_recycled_after_max_messages(self):
+        consumer = MockConsumer()
+
+        def callback(channel, method, header, body):
+            channel.acked.append(method)
+
+        worker = ConsumerWorker('Fetch', 0, lambda: consumer, 'queue',
+                                callback, max_messages=5)
+        worker.run()
+
+        assert worker.count == 5
+        assert consumer.acked == [1, 2, 3, 4, 5]
+        assert worker.busy == 0
+
+    def test_stops_when_the_consumer_fails(self):
+        consumer = MockConsumer(fail_after=3)
+
+        def callback(channel, method, header, body):
+            channel.acked.append(method)
+
+        worker = ConsumerWorker('Fetch', 0, lambda: consumer, 'queue',
+                                callback)
+        worker.run()
+
+        assert worker.count == 3
+        assert consumer.acked == [1, 2, 3]
+
+    def test_message_received_while_stopping_is_processed(self):
+        worker = None
+
+        def on_message(i):
+            # The worker is stopped while the second message is taken
+            if i == 2:
+                worker.stop()
+
+        consumer = MockRejectConsumer(on_message)
+
+        def callback(channel, method, header, body):
+            channel.acked.append(method.delivery_tag)
+
+        worker = ConsumerWorker('Fetch', 0, lambda: consumer, 'queue',
+                                callback)
+        worker.run()
+
+        assert worker.count == 2
+        assert consumer.acked == [1, 2]
+        assert consumer.rejected == []
+
+    def test_message_received_when_finished_is_sent_back(self):
+        worker = None
+
+        def on_message(i):
+            if i == 2:
+                worker.finished = True
+
+        consumer = MockRejectConsumer(on_message)
+
+        def callback(channel, method, header, body):
+            channel.acked.append(method.delivery_tag)
+
+        worker = ConsumerWorker('Fetch', 0, lambda: consumer, 'queue',
+                                callback)
+        worker._consume()
+
+        assert worker.count == 1
+        assert consumer.acked == [1]
+        assert consumer.rejected == [(2, True)]
@@ -117,6 +117,12 @@ def initdb():
     db_setup()
 
 
+def create_indexes():
+    from ckanext.harvest.model import create_indexes
+
+    create_indexes()
+
+
 def create_harvest_source(
     name,
     url,
@@ -289,7 +295,8 @@ def create_job(source_id_or_name):
     }
     job = tk.get_action("harvest_job_create")(context, {
         "source_id": source["id"],
-        "run": True
+        "run": True,
+        "priority": True
     })
 
     output = StringIO()
@@ -325,22 +332,35 @@ def abort_job(job_or_source_id_or_name):
     return "Job status: {0}".format(job["status"])
 
 
-def gather_consumer():
+def gather_consumer(workers=1):
     import logging
     from ckanext.harvest.queue import (
         get_gather_consumer,
         gather_callback,
         get_gather_queue_name,
+        send_back_gather_jobs,
     )
 
     logging.getLogger("amqplib").setLevel(logging.INFO)
+    if workers > 1:
+        # Run each gather in its own worker process, as the harvesters
+        # are not expected to be thread-safe
+        from ckanext.harvest.workers import run_consumer_pool
+        run_consumer_pool(
+            "Gather", get_gather_consumer, get_gather_queue_name(),
+            gather_callback, workers=workers, on_exit=send_back_gather_jobs)
+        return
+
     consumer = get_gather_consumer()
-    for method, header, body in consumer.consume(
-            queue=get_gather_queue_name()):
-        gather_callback(consumer, method, header, body)
+    try:
+        for method, header, body in consumer.consume(
+                queue=get_gather_queue_name()):
+            gather_callback(consumer, method, header, body)
+    finally:
+        send_back_gather_jobs()
 
 
-def fetch_consumer():
+def fetch_consumer(workers=1, threads=1, max_messages=None, max_rss=None):
     import logging
 
     logging.getLogger("amqplib").setLevel(logging.INFO)
@@ -350,6 +370,14 @@ def fetch_consumer():
         get_fetch_queue_name,
     )
 
+    if workers > 1 or threads > 1 or max_messages or max_rss:
+        from ckanext.harvest.workers import run_consumer_pool
+        run_consumer_pool(
+            "Fetch", get_fetch_consumer, get_fetch_queue_name(),
+            fetch_callback, workers=workers, threads=threads,
+            max_messages=max_messages, max_rss=max_rss)
+        return
+
     consumer = get_fetch_consumer()
     for method, header, body in consumer.consume(queue=get_fetch_queue_name()):
         fetch_callback(consumer, method, header, body)
@@ -493,6 +521,12 @@ def clean_harvest_log():
     clean_harvest_log(condition=condition)
 
 
+def rebuild_job_stats(job_id=None):
+    from ckanext.harvest.model import rebuild_job_stats as rebuild
+
+    rebuild(job_id)
+
+
 def harvesters_info():
     harvesters_info = tk.get_action("harvesters_info_show")()
     return harvesters_info
@@ -652,7 +686,8 @@ def refresh_view(id):
         context = {'model': model, 'user': tk.c.user, 'session': model.Session}
         tk.get_action('harvest_job_create')(context, {
             'source_id': id,
-            'run': True
+            'run': True,
+            'priority': True
         })
         h.flash_success(
             _('Harvest will start shortly. Refresh this page for updates.'))
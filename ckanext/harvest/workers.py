@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import logging
+import os
+import resource
+import signal
+import threading
+import time
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+# Seconds between the throughput reports of each worker
+REPORT_INTERVAL = 60
+
+
+def _get_max_rss():
+    '''Returns the peak resident set size of the process, in MB.'''
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class ConsumerWorker(object):
+    '''
+    A worker process that consumes messages from a queue with one or more
+    threads, each with its own consumer.
+
+    The worker stops when it receives SIGTERM or SIGINT, or when it has
+    processed ``max_messages`` messages or its memory usage is over
+    ``max_rss`` MB. The messages being processed, and any received while
+    stopping, are finished before exiting. Messages received once the
+    worker has finished are sent back to the queue with the consumer's
+    ``basic_reject``, or delivered again when their lease expires for
+    consumers without one. ``on_exit`` is called after that, if given.
+    '''
+
+    def __init__(self, name, index, get_consumer, queue_name, callback,
+                 threads=1, max_messages=None, max_rss=None, on_exit=None):
+        self.name = name
+        self.index = index
+        self.get_consumer = get_consumer
+        self.queue_name = queue_name
+        self.callback = callback
+        self.threads = threads
+        self.max_messages = max_messages
+        self.max_rss = max_rss
+        self.on_exit = on_exit
+
+        self.count = 0
+        self.busy = 0
+        self.finished = False
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        started = time.time()
+        for i in range(self.threads):
+            thread = threading.Thread(
+                target=self._consume,
+                name='{0}-worker-{1}-{2}'.format(self.name, self.index, i))
+            thread.daemon = True
+            thread.start()
+
+        last_report = started
+        while not self.stopping.wait(1):
+            if time.time() - last_report >= REPORT_INTERVAL:
+                self.report(started)
+                last_report = time.time()
+
+        # Threads waiting for messages are left behind, but the ones
+        # processing a message are waited for
+        while True:
+            with self.lock:
+                if not self.busy:
+                    self.finished = True
+                    break
+            time.sleep(0.1)
+
+        if self.on_exit:
+            self.on_exit()
+        self.report(started)
+
+    def stop(self, signum=None, frame=None):
+        if not self.stopping.is_set():
+            log.info('%s worker %d (pid %d) stopping after the messages in '
+                     'progress', self.name, self.index, os.getpid())
+        self.stopping.set()
+
+    def report(self, started):
+        elapsed = max(time.time() - started, 1)
+        log.info('%s worker %d (pid %d): %d messages in %d seconds '
+                 '(%.2f messages/s)', self.name, self.index, os.getpid(),
+                 self.count, elapsed, self.count / elapsed)
+
+    def _consume(self):
+        try:
+            consumer = self.get_consumer()
+            for method, header, body in consumer.consume(queue=self.queue_name):
+                with self.lock:
+                    finished = self.finished
+                    if not finished:
+                        self.busy += 1
+                if finished:
+                    # The message was taken from the queue after the worker
+                    # stopped waiting for the ones in progress
+                    self._send_back(consumer, method)
+                    return
+                try:
+                    self.callback(consumer, method, header, body)
+                finally:
+                    with self.lock:
+                        self.busy -= 1
+                        self.count += 1
+                self._check_limits()
+                # Don't take more messages once stopping
+                if self.stopping.is_set():
+                    return
+        except Exception:
+            log.exception('%s worker %d (pid %d) failed', self.name,
+                          self.index, os.getpid())
+            self.stop()
+
+    def _send_back(self, consumer, method):
+        basic_reject = getattr(consumer, 'basic_reject', None)
+        if basic_reject is None:
+            return
+        try:
+            basic_reject(method.delivery_tag, requeue=True)
+        except Exception:
+            log.exception('%s worker %d (pid %d) could not send back a '
+                          'message', self.name, self.index, os.getpid())
+
+    def _check_limits(self):
+        if self.max_messages and self.count >= self.max_messages:
+            log.info('%s worker %d (pid %d) processed %d messages, '
+                     'recycling it', self.name, self.index, os.getpid(),
+                     self.count)
+            self.stop()
+        elif self.max_rss and _get_max_rss() > self.max_rss:
+            log.info('%s worker %d (pid %d) is using %d MB, recycling it',
+                     self.name, self.index, os.getpid(), _get_max_rss())
+            self.stop()
+
+
+def run_consumer_pool(name, get_consumer, queue_name, callback, workers=1,
+                      threads=1, max_messages=None, max_rss=None,
+                      on_exit=None):
+    '''
+    Runs ``workers`` forked processes consuming messages from a queue with
+    ``callback``, each of them with ``threads`` threads (see
+    `ConsumerWorker`).
+
+    Workers that exit (eg because they were recycled) are started again.
+    On SIGTERM or SIGINT the workers are asked to finish the messages in
+    progress, and this function returns once all of them have exited.
+    '''
+    # Don't share the database connections with the workers
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+    children = {}
+    stopping = []
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                ConsumerWorker(name, index, get_consumer, queue_name,
+                               callback, threads=threads,
+                               max_messages=max_messages,
+                               max_rss=max_rss, on_exit=on_exit).run()
+            except BaseException:
+                log.exception('%s worker %d failed', name, index)
+                code = 1
+            finally:
+                os._exit(code)
+        log.info('Started %s worker %d (pid %d)', name, index, pid)
+        children[pid] = (index, time.time())
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(workers):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                break
+            raise
+        if pid not in children:
+            continue
+        index, started = children.pop(pid)
+        if stopping:
+            continue
+        if time.time() - started < 1:
+            # Don't restart workers that fail straight away too fast
+            time.sleep(1)
+        spawn(index)
+
+    log.info('All %s workers stopped', name)